@@ -0,0 +1,145 @@
+"""A content-addressed cache of analysis results, so that re-running analysis on a runfolder after a crash, a settings
+change or a backfill only costs a hash per unchanged shot.
+
+Results are keyed by the sha256 of the image file(s), the analysis (analysis mode, backend and, for the numpy backend, its
+calibration, see analysis_tag) and the marqueeBox and normBox analyzed with, and stored in an sqlite file, by default analysis_cache.sqlite in the day folder next to the
+runfolders. Shots whose settings can't be told, e.g. MATLAB analyses using the settings stored in MATLAB, aren't cached.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from analysis_engines import AnalysisEngine
+from matlab_bridge import is_matlab_array, to_numpy
+
+SETTINGS_KEYS = ['marqueeBox', 'normBox']
+CACHE_FILENAME = 'analysis_cache.sqlite'
+
+
+def default_cache_path(runfolder):
+    return os.path.join(os.path.dirname(os.path.normpath(runfolder)), CACHE_FILENAME)
+
+
+def plain(value):
+    """Converts MATLAB and NumPy arrays to nested lists, so that settings can be hashed as JSON."""
+    if is_matlab_array(value):
+        value = to_numpy(value)
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def analysis_tag(analysis_mode, backend):
+    """Returns the part of the cache key which tells analyses apart, e.g. 'y:matlab'. For the numpy backend, it includes a
+    hash of its calibration and frame layout, so that results analyzed with a previous calibration aren't served."""
+    tag = '{mode}:{backend}'.format(mode=analysis_mode, backend=backend)
+    if backend == 'numpy' and analysis_mode != 'testing':
+        import numpy_analysis
+        constants = {'calibration': numpy_analysis.load_calibration(), 'frames': numpy_analysis.FRAMES}
+        tag += ':' + hashlib.sha256(json.dumps(constants, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return tag
+
+
+def file_digest(filepaths, chunk_size=2 ** 20):
+    digest = hashlib.sha256()
+    for filepath in filepaths:
+        with open(filepath, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnalysisCache():
+    """AnalysisCache stores analysis dictionaries of scalars by key in an sqlite file, evicting the least recently used
+    entries beyond max_entries. Safe to share between threads."""
+
+    def __init__(self, cache_path, max_entries=20000):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS analyses '
+                                    '(key TEXT PRIMARY KEY, analysis TEXT, last_used REAL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS last_used_index ON analyses (last_used)')
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def key(self, filepath, analysis_tag, settings=None):
+        """Returns the cache key of the image(s) at filepath (a path or a list of paths), analysis_tag, e.g. 'y:matlab',
+        and the marqueeBox and normBox in settings."""
+        filepaths = [filepath] if isinstance(filepath, str) else list(filepath)
+        settings_json = json.dumps({key: plain((settings or {}).get(key)) for key in SETTINGS_KEYS},
+                                   sort_keys=True, default=str)
+        return hashlib.sha256('\n'.join([file_digest(filepaths), analysis_tag, settings_json]).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached analysis dictionary for key, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT analysis FROM analyses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute('UPDATE analyses SET last_used = ? WHERE key = ?',
+                                        (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, analysis_dict, eviction_interval=100):
+        """Caches the scalar values of analysis_dict, the values AnalysisLogger uploads to breadboard. Least recently
+        used entries beyond max_entries are evicted every eviction_interval puts."""
+        scalars = {}
+        for name, value in analysis_dict.items():
+            try:
+                scalars[name] = float(value)
+            except (TypeError, ValueError):
+                continue
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)',
+                                    (key, json.dumps(scalars), time.time()))
+            self.puts += 1
+            if self.puts % eviction_interval == 0:
+                self.connection.execute('DELETE FROM analyses WHERE key IN (SELECT key FROM analyses '
+                                        'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CachedAnalysisEngine(AnalysisEngine):
+    """Wraps an AnalysisEngine, answering shots whose images and settings were analyzed before from an AnalysisCache.
+    A cache hit returns settings None, so the previous settings stay in place for the next shot. Shots for which the
+    engine can't tell its effective settings (see AnalysisEngine.effective_settings) bypass the cache, as a settings
+    tweak would otherwise return stale results."""
+
+    def __init__(self, engine, cache, analysis_tag):
+        self.engine = engine
+        self.cache = cache
+        self.analysis_tag = analysis_tag
+
+    def analyze(self, filepath, previous_settings=None):
+        settings = self.engine.effective_settings(previous_settings)
+        if settings is None:
+            return self.engine.analyze(filepath, previous_settings)
+        key = self.cache.key(filepath, self.analysis_tag, settings)
+        analysis_dict = self.cache.get(key)
+        if analysis_dict is not None:
+            return analysis_dict, None
+        analysis_dict, settings = self.engine.analyze(
+            filepath, previous_settings)
+        self.cache.put(key, analysis_dict)
+        return analysis_dict, settings
+
+    def effective_settings(self, previous_settings=None):
+        return self.engine.effective_settings(previous_settings)
+
+    def close(self):
+        self.engine.close()
@@ -0,0 +1,148 @@
+"""Analysis engines and a worker pool to run several of them concurrently.
+
+An engine wraps one analysis backend behind analyze(filepath, previous_settings), which returns (analysis_dict, settings)
+like the analysis_function of AnalysisLogger. MatlabAnalysisEngine owns one MATLAB engine and calls one of the
+matlab_wrapper functions, FunctionAnalysisEngine wraps a plain Python function, e.g. matlab_wrapper.fake_analysis1, so the
+pool can be tested without MATLAB.
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY
+from matlab_engine_server import release_engine
+
+ANALYSIS_SECONDS = REGISTRY.histogram('enrico_analysis_seconds',
+                                      'Duration of the analysis function per shot, by analysis mode.')
+
+
+class AnalysisEngine():
+    """Interface of an analysis backend. Engines are used by one thread at a time."""
+
+    def analyze(self, filepath, previous_settings=None):
+        """Analyzes filepath (a list of filepaths for multiple images per shot) and returns (analysis_dict, settings).
+        settings can be passed back in as previous_settings for the next shot, None if there are none to keep."""
+        raise NotImplementedError
+
+    def effective_settings(self, previous_settings=None):
+        """Returns the settings analyze(filepath, previous_settings) analyzes with, e.g. to key cached results by, or
+        None if they can't be told from here."""
+        return None
+
+    def close(self):
+        pass
+
+
+class FunctionAnalysisEngine(AnalysisEngine):
+    """Wraps analysis_function, whose result only depends on the image(s) and previous_settings."""
+
+    def __init__(self, analysis_function):
+        self.analysis_function = analysis_function
+
+    def analyze(self, filepath, previous_settings=None):
+        return self.analysis_function(filepath, previous_settings)
+
+    def effective_settings(self, previous_settings=None):
+        return previous_settings or {}
+
+
+class MatlabAnalysisEngine(AnalysisEngine):
+    """Calls matlab_func, one of the matlab_wrapper functions taking (eng, filepath, marqueeBox=, normBox=), on its own
+    MATLAB engine."""
+
+    def __init__(self, matlab_func, eng, save_previous_settings=True, uses_boxes=True):
+        """
+        Args:
+            - eng: MATLAB engine, e.g. from matlab_wrapper.load_matlab_engine. None when debugging without MATLAB, every
+              analysis then fails. Closing the engine quits eng only if it isn't a shared session of
+              matlab_engine_server.py.
+            - save_previous_settings: if False, settings are never returned, so marqueeBox and normBox are reset on each shot.
+            - uses_boxes: False if matlab_func ignores marqueeBox and normBox (see matlab_wrapper.box_settings_modes), so
+              its results only depend on the image(s).
+        """
+        self.eng = eng
+        self.matlab_func = matlab_func
+        self.save_previous_settings = save_previous_settings
+        self.uses_boxes = uses_boxes
+
+    def analyze(self, filepath, previous_settings=None):
+        if previous_settings is None or not self.uses_boxes:
+            matlab_dict = self.matlab_func(self.eng, filepath)
+        else:
+            matlab_dict = self.matlab_func(self.eng, filepath, marqueeBox=previous_settings['marqueeBox'],
+                                           normBox=previous_settings['normBox'])
+        analysis_dict, settings = matlab_dict['analysis'], matlab_dict['settings']
+        if not self.save_previous_settings:
+            settings = None
+        return analysis_dict, settings
+
+    def effective_settings(self, previous_settings=None):
+        if not self.uses_boxes:
+            return {}
+        # without a marqueeBox and normBox passed in, MATLAB uses those it stored, e.g. from AnalysisSettingsUpdater
+        if previous_settings is None or not all(key in previous_settings for key in ['marqueeBox', 'normBox']):
+            return None
+        return previous_settings
+
+    def close(self):
+        if self.eng is not None:
+            release_engine(self.eng)
+
+
+class AnalysisWorkerPool():
+    """AnalysisWorkerPool runs shots on num_workers engines concurrently. submit returns a concurrent.futures.Future of
+    (analysis_dict, settings).
+
+    Each shot is analyzed with the newest settings returned so far. If ordered is True, e.g. when settings such as
+    marqueeBox are chained from shot to shot, a shot starts only after the previously submitted one has finished, so
+    every shot sees the settings of the shot before it, as with a single engine."""
+
+    def __init__(self, engine_factory, num_workers=1, ordered=False, previous_settings=None, metric_labels=None):
+        """
+        Args:
+            - engine_factory: function without arguments returning a new AnalysisEngine, called num_workers times.
+            - metric_labels: labels of the analysis duration metric, e.g. {'analysis_mode': 'y'}.
+        """
+        self.num_workers = num_workers
+        self.metric_labels = metric_labels or {}
+        self.ordered = ordered
+        self.previous_settings = previous_settings
+        self.engines = queue.Queue()
+        for _ in range(num_workers):
+            self.engines.put(engine_factory())
+        self.executor = ThreadPoolExecutor(max_workers=num_workers,
+                                           thread_name_prefix='analysis_worker')
+        self.lock = threading.Lock()
+        self.last_future = None
+
+    def submit(self, filepath):
+        with self.lock:
+            predecessor = self.last_future if self.ordered else None
+            future = self.executor.submit(self._run, filepath, predecessor)
+            self.last_future = future
+        return future
+
+    def _run(self, filepath, predecessor):
+        if predecessor is not None:
+            try:
+                predecessor.result()
+            except:
+                pass  # a failed shot doesn't change the settings
+        engine = self.engines.get()
+        start_time = time.monotonic()
+        try:
+            analysis_dict, settings = engine.analyze(
+                filepath, self.previous_settings)
+        finally:
+            self.engines.put(engine)
+            ANALYSIS_SECONDS.observe(
+                time.monotonic() - start_time, **self.metric_labels)
+        if settings is not None:
+            self.previous_settings = settings
+        return analysis_dict, settings
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        while not self.engines.empty():
+            self.engines.get().close()
@@ -11,6 +11,7 @@ import enrico_bot
 import logging
 from matlab_wrapper import load_matlab_engine
 from math import isnan
+from write_completion import WriteCompletionDetector
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -41,7 +42,7 @@ def main(analysis_type, watchfolder, load_matlab=True, images_per_shot=1, save_i
 
     # define subfunction analysis_function which outputs analysis and settings dictionaries
     # define analyzed_var_names list manually, these are the scalar values most easily parsed from Carsten's analysis MATLAB structs.
-    # TODO: parse all of Carsten's MATLAB struct, not just scalar values.
+    # the matlab_wrapper functions return all fields of the structs, see matlab_bridge.py.
     if analysis_type == 'fake analysis':
         from matlab_wrapper import fake_analysis1_var_names as analyzed_var_names
         from matlab_wrapper import fake_analysis1 as analysis_function
@@ -118,6 +119,7 @@ def main(analysis_type, watchfolder, load_matlab=True, images_per_shot=1, save_i
     unanalyzed_ids = []
     done_ids = []
     append_mode = True
+    write_completion = WriteCompletionDetector()
 
     # Main Loop
     while True:
@@ -144,6 +146,12 @@ def main(analysis_type, watchfolder, load_matlab=True, images_per_shot=1, save_i
                 else:  # for triple imaging
                     file = ['{run_id}_{idx}.spe'.format(
                         run_id=run_id, idx=idx) for idx in range(images_per_shot)]
+                # wait for file(s) to finish writing to hard disk before opening in MATLAB
+                pending_files = [file] if isinstance(file, str) else file
+                settle_times = write_completion.wait(
+                    [os.path.join(watchfolder, f) for f in pending_files])
+                logger.debug('write completion times in seconds: {times}'.format(
+                    times=str({os.path.basename(path): round(settle_time, 3) for path, settle_time in settle_times.items()})))
                 if append_mode:
                     run_dict = bc._send_message(
                         'get', '/runs/' + str(run_id) + '/').json()
@@ -6,8 +6,30 @@ import warnings
 import enrico_bot
 from math import isnan
 import sys
-import pickle
-from measurement_directory import run_ids_from_filenames
+import queue
+import itertools
+import threading
+from run_id_tracker import RunIdTracker
+from shot_scheduler import ShotScheduler, LANES
+from analyzed_runs import AnalyzedRunsChecker
+from write_completion import WriteCompletionDetector
+from analysis_engines import AnalysisWorkerPool, FunctionAnalysisEngine, MatlabAnalysisEngine
+from analysis_cache import AnalysisCache, CachedAnalysisEngine, default_cache_path, analysis_tag
+from metrics import REGISTRY, BREADBOARD_REQUEST_SECONDS, start_metrics_server
+
+METRICS_PORT = 9111
+SHOTS_ANALYZED = REGISTRY.counter('enrico_analysis_shots_total',
+                                  'Shots analyzed, by analysis mode and result (ok, badshot or skipped).')
+ANALYSIS_BACKLOG = REGISTRY.gauge('enrico_analysis_backlog',
+                                  'Run_ids waiting to be analyzed, by analysis mode.')
+STAGE_QUEUE_DEPTH = REGISTRY.gauge('enrico_analysis_stage_queue_depth',
+                                   'Shots waiting for each stage of the analysis pipeline, by analysis mode and stage.')
+ANALYSIS_IDLE_SECONDS = REGISTRY.gauge('enrico_analysis_idle_seconds',
+                                       'Time since the last shot was analyzed, by analysis mode.')
+LANE_WAITING = REGISTRY.gauge('enrico_analysis_lane_waiting',
+                              'Run_ids waiting in each scheduler lane, by analysis mode and lane.')
+LANE_LAG_SECONDS = REGISTRY.gauge('enrico_analysis_lane_lag_seconds',
+                                  'Time the longest waiting run_id of each scheduler lane has waited, by analysis mode and lane.')
 
 
 class AnalysisLogger():
@@ -18,7 +40,9 @@ class AnalysisLogger():
 
     def __init__(self, analysis_mode=None, watchfolder=None, load_matlab=True,
                  save_images=None, refresh_time=0.2, save_previous_settings=True,
-                 append_mode=True):
+                 append_mode=True, metrics_port=METRICS_PORT, num_workers=1, stage_queue_size=2,
+                 backend='matlab', use_analysis_cache=True, live_policy='lifo', backfill_policy='fifo',
+                 live_deadline=None, lag_report_interval=60, engine_factory=None, analyzed_var_names=None):
         """
         Args:
             - analysis_mode: determines which MATLAB function to perform analysis with.
@@ -27,6 +51,24 @@ class AnalysisLogger():
             - save_images: if set to False, images are discarded after analysis.
             - save_previous_settings: set to False if analysis settings, e.g. normBox, needs to be reset on each shot
             - append_mode: set to True to check breadboard for existing analysis before analyzing
+            - metrics_port: local port serving analysis metrics at http://localhost:metrics_port/metrics (see metrics.py).
+              None to not start a metrics server.
+            - num_workers: number of analysis engines (MATLAB engines, unless testing) analyzing shots concurrently.
+              With save_previous_settings, shots are still analyzed one after the other, each with the settings of
+              the previous shot.
+            - stage_queue_size: number of shots which can wait between stages of the analysis pipeline (see start_pipeline).
+              Small queues keep the newest shots first in line, as waiting shots stay in the scheduler.
+            - backend: 'matlab' for Carsten's MATLAB analysis functions, 'numpy' for the equivalent analyses of
+              numpy_analysis.py, which need no MATLAB engine but a calibration in analysis_config.json.
+            - use_analysis_cache: if True, results are cached by image content and settings in the day folder (see
+              analysis_cache.py), so reanalyzing unchanged shots costs only a hash.
+            - live_policy, backfill_policy: 'lifo', 'fifo' or 'deadline', order in which the live lane (the newest
+              num_workers shots) and the backfill lane (older shots, analyzed when no live shot waits) are served,
+              see shot_scheduler.py.
+            - live_deadline: sec after which a live shot still waiting moves to the backfill lane, None to never move it.
+            - lag_report_interval: sec between printed reports of how far behind each lane is, while shots are waiting.
+            - engine_factory, analyzed_var_names: a function returning a new AnalysisEngine for each worker and the names
+              of its results, to analyze with instead of the analysis of analysis_mode, e.g. in benchmarks.
         """
 
         # ycam, zcam double imaging, zcam triple imaging, and default images_per_shot
@@ -60,18 +102,79 @@ class AnalysisLogger():
         print("\n\n Watching this folder for changes: " +
               self.watchfolder + "\n\n")
         self.init_logger()
-        if load_matlab:
-            self.load_matlab_engine()
+        self.load_matlab = load_matlab
+        if backend not in ['matlab', 'numpy']:
+            raise ValueError(str(backend) + " is not an analysis backend, i.e. 'matlab' or 'numpy'")
+        self.backend = backend
+        self.save_previous_settings = save_previous_settings
         self.load_matlab_wrapper()
+        if engine_factory is not None:
+            self.engine_factory = engine_factory
+        if analyzed_var_names is not None:
+            self.analyzed_var_names = analyzed_var_names
+        self.init_analysis_cache(use_analysis_cache)
         self.load_breadboard_client()
         self.save_images = save_images  # TODO delete images from BECserver
         self.refresh_time = refresh_time
-        self.previous_settings = None
-        self.unanalyzed_ids = []
-        self.done_ids = []
+        self.scheduler = ShotScheduler(live_policy=live_policy, backfill_policy=backfill_policy,
+                                       live_capacity=num_workers, live_deadline=live_deadline)
+        self.lag_report_interval = lag_report_interval
+        self.last_lag_report_time = time.monotonic()
+        self.in_flight = set()  # run_ids handed to the analysis pipeline and not done yet
+        self.state_lock = threading.Lock()
+        self.write_completion = WriteCompletionDetector()
         # check breadboard if analysis has already been done on image, e.g. if analysis is restarted
         self.append_mode = append_mode
-        self.save_previous_settings = save_previous_settings
+        # run_ids done in a previous session are skipped without asking breadboard, unless reanalyzing
+        self.run_id_tracker = RunIdTracker(self.watchfolder, state_path=os.path.join(
+            self.watchfolder, 'analysis_done_ids_{mode}.json'.format(mode=self.analysis_mode)), load_state=append_mode)
+        self.done_ids = self.run_id_tracker.done_ids
+        if append_mode:
+            self.analyzed_runs = AnalyzedRunsChecker(
+                self.bc, self.analyzed_var_names)
+        self.worker_pool = AnalysisWorkerPool(self.engine_factory, num_workers=num_workers,
+                                              ordered=save_previous_settings and self.analysis_mode != 'testing'
+                                              and backend == 'matlab',
+                                              metric_labels={'analysis_mode': self.analysis_mode})
+        self.init_pipeline(stage_queue_size)
+        self.init_metrics(metrics_port)
+
+    def init_analysis_cache(self, use_analysis_cache):
+        self.analysis_cache = None
+        if not use_analysis_cache or self.analysis_mode == 'testing':
+            return
+        self.analysis_cache = AnalysisCache(
+            default_cache_path(self.watchfolder))
+        engine_factory = self.engine_factory
+        tag = analysis_tag(self.analysis_mode, self.backend)
+        self.engine_factory = lambda: CachedAnalysisEngine(
+            engine_factory(), self.analysis_cache, tag)
+
+    def init_pipeline(self, stage_queue_size):
+        self.analysis_queue = queue.Queue(
+            maxsize=stage_queue_size)  # (run_id, file(s))
+        # (run_id, future of the analysis, file(s)), in order of completion
+        self.upload_queue = queue.Queue(maxsize=stage_queue_size)
+        # an analysis is only submitted when a worker is free, so waiting shots stay in the bounded queues
+        self.worker_slots = threading.Semaphore(self.worker_pool.num_workers)
+        self.pipeline_threads = []
+
+    def init_metrics(self, metrics_port):
+        self.last_analysis_time = time.monotonic()
+        ANALYSIS_BACKLOG.set_function(lambda: len(
+            self.scheduler), analysis_mode=self.analysis_mode)
+        for lane in LANES:
+            LANE_WAITING.set_function(lambda lane=lane: self.scheduler.lag()[lane]['waiting'],
+                                      analysis_mode=self.analysis_mode, lane=lane)
+            LANE_LAG_SECONDS.set_function(lambda lane=lane: self.scheduler.lag()[lane]['oldest_wait_seconds'],
+                                          analysis_mode=self.analysis_mode, lane=lane)
+        ANALYSIS_IDLE_SECONDS.set_function(lambda: time.monotonic() - self.last_analysis_time,
+                                           analysis_mode=self.analysis_mode)
+        for stage, stage_queue in [('analyze', self.analysis_queue), ('upload', self.upload_queue)]:
+            STAGE_QUEUE_DEPTH.set_function(stage_queue.qsize, analysis_mode=self.analysis_mode,
+                                           stage=stage)
+        if metrics_port is not None:
+            start_metrics_server(metrics_port)
 
     def init_logger(self):
         import logging
@@ -135,155 +238,267 @@ class AnalysisLogger():
         watchfolder = os.path.abspath(watchfolder)
         return watchfolder
 
-    def load_matlab_engine(self):
+    def load_matlab_engine(self, engine_index=0):
         import matlab_wrapper
-        self.eng = matlab_wrapper.load_matlab_engine()
+        return matlab_wrapper.load_matlab_engine(engine_index=engine_index)
 
     def load_matlab_wrapper(self):
         """
-        Generically maps one of Carsten's MATLAB analysis functions to self.analysis_function, based on self.analysis_mode.
+        Generically maps one of Carsten's MATLAB analysis functions to self.engine_factory, based on self.analysis_mode.
+        The factory returns a new AnalysisEngine (see analysis_engines.py) for each analysis worker; MATLAB engines are
+        only loaded if self.load_matlab, as MATLAB can take a while to load.
         Also sets self.analyzed_var_names, keys to scalar values in analysis_dict which can be JSON serialized and uploaded to breadboard.
         """
 
         # key, val pairs of analysis_mode string and tuple (matlab wrapper function, analyzed variable names)
         import matlab_wrapper
-        analysis_modes_dict = {
-            'y': ('getYcamAnalysis', 'ycam_analyzed_var_names'),
-            'zd': ('getDualImagingAnalysis', 'dual_imaging_analyzed_var_names'),
-            'zt': ('getTripleImagingAnalysis', 'triple_imaging_analyzed_var_names')}
+        if self.analysis_mode == 'testing':
+            # fake analysis with random delays, no MATLAB engine needed
+            self.analyzed_var_names = matlab_wrapper.fake_analysis1_var_names
+            self.engine_factory = lambda: FunctionAnalysisEngine(
+                matlab_wrapper.fake_analysis1)
+            return
+        analysis_modes_dict = matlab_wrapper.analysis_modes
         self.matlab_func_name, self.analyzed_var_names = (getattr(
             matlab_wrapper, name) for name in analysis_modes_dict[self.analysis_mode])
+        if self.backend == 'numpy':
+            import numpy_analysis
+            # raises if analysis_config.json has no calibration, before any shot is uploaded
+            numpy_analysis.load_calibration()
+            numpy_function, self.analyzed_var_names = (getattr(
+                numpy_analysis, name) for name in analysis_modes_dict[self.analysis_mode])
 
-        def analysis_function(filepath, previous_settings=None):
-            """A generic placeholder for one of Carsten's MATLAB analysis functions.
-            By passing in previous_settings, one can avoid resetting manually inputted settings, e.g. normBox.
+            def analysis_function(filepath, previous_settings=None):
+                analysis_dict, settings = numpy_function(
+                    filepath, previous_settings)
+                if not self.save_previous_settings:
+                    settings = None
+                return analysis_dict, settings
 
-            Returns a MATLAB analysis struct mapped to a Python dict, analysis_dict, and a settings dict compatible with the MATLAB wrapper functions.
-            """
-            if previous_settings is None:
-                matlab_dict = self.matlab_func_name(self.eng, filepath)
-            else:
-                matlab_dict = self.matlab_func_name(self.eng, filepath, marqueeBox=previous_settings['marqueeBox'],
-                                                    normBox=previous_settings['normBox'])
-            analysis_dict, settings = matlab_dict['analysis'], matlab_dict['settings']
-            if not self.save_previous_settings:
-                settings = None
-            return analysis_dict, settings
+            self.engine_factory = lambda: FunctionAnalysisEngine(
+                analysis_function)
+            return
 
-        self.analysis_function = analysis_function
+        # one shared session of matlab_engine_server.py per worker
+        engine_indices = itertools.count()
+
+        def engine_factory():
+            eng = self.load_matlab_engine(
+                next(engine_indices)) if self.load_matlab else None
+            return MatlabAnalysisEngine(self.matlab_func_name, eng,
+                                        save_previous_settings=self.save_previous_settings,
+                                        uses_boxes=self.analysis_mode in matlab_wrapper.box_settings_modes)
+
+        self.engine_factory = engine_factory
 
     def monitor_watchfolder(self):
         """
-        Adds new images to the stack of unanalyzed_ids.
-        """
-        watchfolder = self.watchfolder
-        if not os.path.exists(watchfolder):
-            pass
-        else:
-            files = [filename for filename in os.listdir(watchfolder)]
-            filesSPE = []
-            for file in files:  # filter out non .spe files
-                if '.spe' in file:
-                    filesSPE.append(file)
-            files = filesSPE
-            run_ids = run_ids_from_filenames(files)
-            fresh_ids = sorted(list(set(run_ids).difference(
-                set(self.done_ids)).difference(set(self.unanalyzed_ids))))
-            self.unanalyzed_ids += fresh_ids
-        pass
-
-    def analyze_newest_images(self):
-        """
-        Analyzes the newest run_id on the stack of unanalyzed_ids and uploads to breadboard. 
-        Deletes images locally after analysis if self.save_images is False.
+        Adds new images to the scheduler and periodically saves the done run_ids.
         """
+        fresh_ids = self.run_id_tracker.scan()
+        if self.append_mode:
+            # newest first, as the live lane serves them
+            self.analyzed_runs.prefetch(reversed(fresh_ids))
+        self.scheduler.add(fresh_ids)
+        with self.state_lock:
+            self.run_id_tracker.maybe_save()
 
-        def analyze_image(filepath):
-            """Helper function for cleaning analysis_dict to JSON serializable types
-            before uploading to breadboard.
-            """
-            self.logger.debug('{file} analyzing: '.format(file=filepath))
-            analysis_dict, settings = self.analysis_function(
-                filepath, self.previous_settings)
-            cleaned_analysis_dict = {}
-            print('\n')
-            for key in self.analyzed_var_names:
-                if not isnan(analysis_dict[key]):
-                    cleaned_analysis_dict[key] = analysis_dict[key]
-                    print(key, analysis_dict[key])
-            print('\n')
-            return cleaned_analysis_dict, settings
-
-        bc, watchfolder = self.bc, self.watchfolder
-        run_id = self.unanalyzed_ids[-1]  # start from top of stack
-        print(self.unanalyzed_ids)
+    def shot_files(self, run_id):
+        """Returns the image filepath of run_id, or a list of filepaths for multiple images per shot."""
         if self.images_per_shot == 1:
-            file = os.path.join(watchfolder,
+            return os.path.join(self.watchfolder,
                                 '{run_id}_0.spe'.format(run_id=run_id))
-            pending_file = file
         else:  # for triple imaging
-            file = [os.path.join(watchfolder, '{run_id}_{idx}.spe'.format(
-                run_id=run_id, idx=idx)) for idx in range(images_per_shot)]
-            pending_file = file[-1]
-        old_filesize = 0
-        # wait for file to finish writing to hard disk before opening in MATLAB
-        while os.path.getsize(pending_file) != old_filesize:
-            old_filesize = os.path.getsize(pending_file)
-            time.sleep(0.3)
-        if self.append_mode:
-            run_dict = bc._send_message(
-                'get', '/runs/' + str(run_id) + '/').json()
-            if set(self.analyzed_var_names).issubset(set(run_dict['parameters'].keys())):
-                popped_id = [self.unanalyzed_ids.pop()]
-                self.done_ids += popped_id
+            return [os.path.join(self.watchfolder, '{run_id}_{idx}.spe'.format(
+                run_id=run_id, idx=idx)) for idx in range(self.images_per_shot)]
+
+    def already_analyzed(self, run_id):
+        """Checks breadboard for existing analysis of run_id. Usually answered from the checks started in
+        monitor_watchfolder while earlier shots were analyzed."""
+        return self.analyzed_runs.is_analyzed(run_id)
+
+    def clean_analysis_dict(self, analysis_dict):
+        """Keeps the JSON serializable values of analyzed_var_names which are not NaN, for uploading to breadboard."""
+        cleaned_analysis_dict = {}
+        print('\n')
+        for key in self.analyzed_var_names:
+            if not isnan(analysis_dict[key]):
+                cleaned_analysis_dict[key] = analysis_dict[key]
+                print(key, analysis_dict[key])
+        print('\n')
+        return cleaned_analysis_dict
+
+    def start_pipeline(self):
+        """
+        Starts the analysis pipeline, three stages connected by bounded queues, so that the images of the next shot are
+        awaited and checked while a shot is analyzed and the results of the previous one are uploaded:
+            - prefetch: takes the next run_id from the scheduler as soon as the analysis queue has room, newest first
+              (see shot_scheduler.py), waits for its images to finish writing and, in append_mode, skips shots already
+              analyzed on breadboard.
+            - analyze: submits shots to the analysis worker pool as workers become free.
+            - upload: uploads results to breadboard and deletes images if self.save_images is False.
+        """
+        for stage in [self.prefetch_stage, self.analyze_stage, self.upload_stage]:
+            thread = threading.Thread(target=self.run_stage, args=(stage,),
+                                      name=stage.__name__, daemon=True)
+            thread.start()
+            self.pipeline_threads.append(thread)
+
+    def next_run_id(self):
+        """Blocks until the scheduler has a shot and returns its run_id, or None after refresh_time without shots."""
+        if not self.scheduler.wait(timeout=self.refresh_time):
+            return None
+        with self.state_lock:
+            run_id, lane = self.scheduler.next()
+            if run_id is None:  # taken by deadline demotion or another caller in between
                 return None
+            self.in_flight.add(run_id)
+        self.logger.debug('run_id {id} scheduled from the {lane} lane'.format(
+            id=str(run_id), lane=lane))
+        return run_id
+
+    def requeue(self, run_id):
+        """Hands run_id back to the scheduler to be retried, e.g. after an error."""
+        with self.state_lock:
+            self.in_flight.discard(run_id)
+            self.scheduler.requeue(run_id)
+
+    def pending_shots(self):
+        """Returns the number of shots waiting in the scheduler or in the analysis pipeline."""
+        with self.state_lock:
+            return len(self.scheduler) + len(self.in_flight)
+
+    def report_lag(self):
+        """Prints how far behind each scheduler lane is, every lag_report_interval sec while shots are waiting."""
+        if time.monotonic() - self.last_lag_report_time < self.lag_report_interval or len(self.scheduler) == 0:
+            return
+        self.last_lag_report_time = time.monotonic()
+        for lane, lag in self.scheduler.lag().items():
+            print('{lane} lane: {waiting} shots waiting, {behind} run_ids behind, oldest waiting {seconds:.0f} s'.format(
+                lane=lane, waiting=lag['waiting'], behind=lag['run_ids_behind'], seconds=lag['oldest_wait_seconds']))
+
+    def mark_done(self, run_id):
+        with self.state_lock:
+            self.in_flight.discard(run_id)
+            self.run_id_tracker.mark_done(run_id)
+
+    def run_stage(self, stage):
+        while True:
+            try:
+                stage()
+            except:
+                self.logger.error('{stage} error: {error}'.format(
+                    stage=stage.__name__, error=str(sys.exc_info()[1])))
+                time.sleep(self.refresh_time)
+
+    def prefetch_stage(self):
+        run_id = self.next_run_id()
+        if run_id is None:
+            return
+        try:
+            file = self.shot_files(run_id)
+            # wait for file(s) to finish writing to hard disk before opening in MATLAB
+            settle_times = self.write_completion.wait(file)
+            self.logger.debug('write completion times in seconds: {times}'.format(
+                times=str({os.path.basename(path): round(settle_time, 3) for path, settle_time in settle_times.items()})))
+            already_analyzed = self.append_mode and self.already_analyzed(
+                run_id)
+        except:
+            # back to the scheduler, to be retried once no newer shot waits
+            self.requeue(run_id)
+            raise
+        if already_analyzed:
+            SHOTS_ANALYZED.inc(
+                analysis_mode=self.analysis_mode, result='skipped')
+            self.mark_done(run_id)
+            return
+        self.analysis_queue.put((run_id, file))
+
+    def analyze_stage(self):
+        run_id, file = self.analysis_queue.get()
+        self.worker_slots.acquire()
+        self.logger.debug('{file} analyzing: '.format(file=file))
+        future = self.worker_pool.submit(file)
+
+        def on_analyzed(future):
+            self.worker_slots.release()
+            self.upload_queue.put((run_id, future, file))
+
+        future.add_done_callback(on_analyzed)
+
+    def upload_stage(self):
+        run_id, future, file = self.upload_queue.get()
         try:
-            analysis_dict, self.previous_settings = analyze_image(
-                file)
+            self.upload_analysis(run_id, future, file)
+        except:
+            self.requeue(run_id)
+            raise
+        # the shot is done, errors from here on must not have it analyzed and uploaded again
+        if not self.save_images:
+            self.discard_images(run_id, file)
+        print('\n')
+
+    def upload_analysis(self, run_id, future, file):
+        """
+        Uploads the result of a finished analysis to breadboard, or marks the shot as bad if the analysis failed.
+        """
+        bc = self.bc
+
+        def upload(analysis_dict):
+            upload_start_time = time.monotonic()
             resp = bc.append_analysis_to_run(run_id, analysis_dict)
+            BREADBOARD_REQUEST_SECONDS.observe(
+                time.monotonic() - upload_start_time, request='append_analysis')
+            return resp
+
+        try:
+            analysis_dict = self.clean_analysis_dict(future.result()[0])
+            resp = upload(analysis_dict)
+            result = 'ok'
         except:  # if MATLAB analysis fails
             analysis_dict = {'badshot': True}
             warning_message = str(
                 run_id) + 'could not be analyzed. Marking as bad shot.'
-            resp = bc.append_analysis_to_run(run_id, analysis_dict)
+            resp = upload(analysis_dict)
             warnings.warn(warning_message)
             self.logger.warn(warning_message)
-        popped_id = [self.unanalyzed_ids.pop()]
-        self.done_ids += popped_id
-
+            result = 'badshot'
         if resp.status_code != 200:
-            logger.warning('Upload error: ' + resp.text)
+            self.logger.warning('Upload error: ' + resp.text)
+        SHOTS_ANALYZED.inc(analysis_mode=self.analysis_mode, result=result)
+        self.last_analysis_time = time.monotonic()
+        self.mark_done(run_id)
 
-        if not self.save_images:  # delete images and add run_ids to .txt file after analysis if in testing mode
-            print('Not saving images.')
-            if isinstance(file, str):
-                filepath = os.path.join(self.watchfolder, file)
+    def discard_images(self, run_id, file):
+        """Deletes the images of an analyzed shot, as self.save_images is False, and adds its run_id to run_ids.txt."""
+        watchfolder = self.watchfolder
+        print('Not saving images.')
+        if isinstance(file, str):
+            filepath = os.path.join(self.watchfolder, file)
+            os.remove(filepath)
+            self.logger.debug(
+                'save_images is False, file {file} deleted after analysis.'.format(file=filepath))
+        elif isinstance(file, list):
+            for f in file:
+                filepath = os.path.join(self.watchfolder, f)
                 os.remove(filepath)
                 self.logger.debug(
                     'save_images is False, file {file} deleted after analysis.'.format(file=filepath))
-            elif isinstance(file, list):
-                for f in file:
-                    filepath = os.path.join(self.watchfolder, f)
-                    os.remove(filepath)
-                    logger.debug(
-                        'save_images is False, file {file} deleted after analysis.'.format(file=filepath))
-            with open(os.path.join(self.watchfolder, 'run_ids.txt'), 'a') as run_ids_file:
-                run_ids_file.write(str(popped_id[0]) + '\n')
-                self.logger.debug('Run_id {id} added to {file}.'.format(
-                    id=str(popped_id[0]), file=os.path.join(watchfolder, 'run_ids.txt')))
-        print('\n')
-
-    def dump(self):
-        with open(os.path.join(self.watchfolder, 'analysisLogger.pkl'), 'wb') as file:
-            pickle.dump(self, file)
+        with open(os.path.join(self.watchfolder, 'run_ids.txt'), 'a') as run_ids_file:
+            run_ids_file.write(str(run_id) + '\n')
+            self.logger.debug('Run_id {id} added to {file}.'.format(
+                id=str(run_id), file=os.path.join(watchfolder, 'run_ids.txt')))
 
     def main(self):
-        while True:
-            self.monitor_watchfolder()
-            if len(self.unanalyzed_ids) > 0:
-                self.analyze_newest_images()
-                # self.dump()
-            time.sleep(self.refresh_time)
+        self.start_pipeline()
+        try:
+            while True:
+                self.monitor_watchfolder()
+                self.report_lag()
+                time.sleep(self.refresh_time)
+        finally:
+            with self.state_lock:
+                self.run_id_tracker.save()
 
     def export_params_csv(self):
         """
@@ -313,12 +528,14 @@ class AnalysisLogger():
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         analysis_logger = AnalysisLogger()
-    elif len(sys.argv) == 4:
+    elif len(sys.argv) in [4, 5]:
         analysis_mode, watchfolder, save_images = (sys.argv[1], sys.argv[2], bool(sys.argv[3])
                                                    )
+        num_workers = int(sys.argv[4]) if len(sys.argv) == 5 else 1
         analysis_logger = AnalysisLogger(analysis_mode=analysis_mode,
                                          watchfolder=watchfolder,
-                                         save_images=save_images)
+                                         save_images=save_images,
+                                         num_workers=num_workers)
         print('analysis initialized')
     try:
         analysis_logger.main()
@@ -0,0 +1,87 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+
+class AnalyzedRunsChecker():
+    """AnalyzedRunsChecker answers whether breadboard runs already contain the analyzed_var_names, for AnalysisLogger's
+    append_mode. Run_ids are fetched ahead of time by a bounded pool of max_workers threads (see prefetch), so that
+    resolving a backlog of 2000 shots takes 2000 / max_workers round-trips instead of 2000 sequential ones, off the
+    critical path of the analysis. Answers are cached.
+    Fetches are served from a priority queue: run_ids someone waits for in is_analyzed first, then prefetched run_ids
+    newest first, so the check of a new live shot never waits behind the prefetches of a backlog."""
+
+    def __init__(self, bc, analyzed_var_names, max_workers=8):
+        self.bc = bc
+        self.analyzed_var_names = set(analyzed_var_names)
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (priority, run_id), see prefetch and is_analyzed
+        self.waited_order = itertools.count()
+        self.results = {}  # run_id: Future of True if analyzed
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work, name='analyzed_runs_' + str(idx), daemon=True)
+                        for idx in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _queue(self, run_id, priority):
+        """Queues a fetch of run_id if it isn't running or done yet. Must hold self.condition."""
+        future = self.results.get(run_id)
+        if future is None:
+            future = self.results[run_id] = Future()
+        if not (future.running() or future.done()):
+            heapq.heappush(self.queue, (priority, run_id))
+            self.condition.notify()
+        return future
+
+    def prefetch(self, run_ids):
+        """Starts checking run_ids in the background, newest first."""
+        with self.condition:
+            for run_id in run_ids:
+                if run_id not in self.results:
+                    self._queue(run_id, (1, -run_id))
+
+    def is_analyzed(self, run_id, timeout=None):
+        """Returns True if run_id is analyzed on breadboard, moving its fetch ahead of all prefetches if it hasn't
+        started yet and waiting for it. Failed fetches raise and are dropped from the cache, so the next call tries again."""
+        with self.condition:
+            future = self._queue(run_id, (0, next(self.waited_order)))
+        try:
+            return future.result(timeout=timeout)
+        except:
+            with self.condition:
+                if self.results.get(run_id) is future and future.done():
+                    del self.results[run_id]
+            raise
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or len(self.queue) > 0)
+                if self.closed:
+                    return
+                _, run_id = heapq.heappop(self.queue)
+                future = self.results.get(run_id)
+                # entries of run_ids moved ahead by is_analyzed stay behind in the heap
+                if future is None or future.running() or future.done():
+                    continue
+                future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._fetch(run_id))
+            except BaseException as error:
+                future.set_exception(error)
+
+    def _fetch(self, run_id):
+        resp = self.bc._send_message('get', '/runs/' + str(run_id) + '/')
+        if resp.status_code != 200:
+            raise ValueError('Breadboard error while fetching run_id {id}: {text}'.format(
+                id=str(run_id), text=resp.text))
+        return self.analyzed_var_names.issubset(set(resp.json()['parameters'].keys()))
+
+    def shutdown(self):
+        with self.condition:
+            self.closed = True
+            for future in self.results.values():
+                future.cancel()
+            self.condition.notify_all()
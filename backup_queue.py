@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+import collections
+
+
+class BackupQueue():
+    """BackupQueue copies files (e.g. images to the bec1server) in background worker threads, so a slow network share
+    never stalls the process that enqueues them.
+
+    Every job is appended to a journal file before it is queued, and marked done once copied, so jobs that were pending
+    when the process stopped or crashed are picked up again on the next start. At most max_pending jobs are held in memory;
+    the rest stay in the journal and are reloaded as the queue drains. Failed copies are retried with exponential backoff.
+
+    As in MoveJournal, journal records are flushed on every write and fsynced in batches every fsync_interval sec from a
+    background thread, which also compacts the journal to its pending jobs once it has grown by compact_size_in_bytes
+    since it was last compacted."""
+
+    def __init__(self, journal_path, num_workers=2, max_pending=1000, max_retries=8,
+                 base_backoff_in_sec=1, max_backoff_in_sec=60, rate_window_in_sec=60, fsync_interval=0.5,
+                 compact_size_in_bytes=1000000):
+        self.journal_path = journal_path
+        self.fsync_interval = fsync_interval
+        self.compact_size_in_bytes = compact_size_in_bytes
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.base_backoff_in_sec = base_backoff_in_sec
+        self.max_backoff_in_sec = max_backoff_in_sec
+        self.rate_window_in_sec = rate_window_in_sec
+        self.logger = logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.queued_ids = set()  # ids of jobs held in memory, i.e. queued, in flight or waiting for a retry
+        self.spilled = False  # True if some pending jobs only exist in the journal
+        self.num_spilled = 0  # number of those jobs
+        # journal offset in bytes up to which every job was loaded into memory, where _reload_spilled continues
+        self.spill_offset = 0
+        self.given_up_ids = set()  # ids of jobs left for the next start, see _retry
+        self.dirty = False  # True if the journal has records which were not fsynced yet
+        self.compacted_size = 0  # journal size in bytes right after the last compaction
+        self.stopped = threading.Event()
+        self.journal_thread = None
+        self.next_id = 0
+        self.copied_log = collections.deque()  # (time.monotonic(), bytes) of recent copies
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.files_failed = 0
+        self.workers = []
+        self.running = False
+        self.journal_file = None
+
+    def start(self):
+        """Compacts the journal, queues the jobs left over from previous sessions and starts the workers."""
+        pending_jobs = self._read_pending_jobs()
+        self._compact_journal(pending_jobs)
+        self.journal_file = open(self.journal_path, 'a')
+        self.compacted_size = self.journal_file.tell()
+        if len(pending_jobs) > 0:
+            print('{n} pending backup(s) found in {path}, resuming.'.format(
+                n=str(len(pending_jobs)), path=self.journal_path))
+        self.next_id = max([job['id'] for job in pending_jobs], default=-1) + 1
+        self.spilled = len(pending_jobs) > 0
+        self.num_spilled = len(pending_jobs)
+        self.spill_offset = 0
+        self._reload_spilled()
+        self.running = True
+        self.stopped.clear()
+        self.journal_thread = threading.Thread(
+            target=self._journal_loop, daemon=True)
+        self.journal_thread.start()
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=None):
+        """Stops the workers after their current copy. Unfinished jobs stay in the journal for the next start."""
+        self.running = False
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+        self.stopped.set()
+        if self.journal_thread is not None:
+            self.journal_thread.join()
+        self.sync()
+        with self.lock:
+            self.journal_file.close()
+
+    def enqueue(self, src, dst):
+        """Schedules a copy of src to dst. Never blocks on the copy itself."""
+        with self.lock:
+            job = {'id': self.next_id, 'src': src, 'dst': dst, 'retries': 0}
+            self.next_id += 1
+            self._write_journal(dict(job, op='add'))
+            try:
+                self.queue.put_nowait(job)
+                self.queued_ids.add(job['id'])
+            except queue.Full:
+                self.spilled = True
+                self.num_spilled += 1
+
+    def stats(self):
+        """Returns a dictionary with the number of pending jobs and the copy throughput over the last rate_window_in_sec.
+        queue_depth counts every pending job: queued, in flight, waiting for a retry or spilled to the journal."""
+        with self.lock:
+            self._trim_copied_log()
+            bytes_in_window = sum(nbytes for _, nbytes in self.copied_log)
+            return {'queue_depth': len(self.queued_ids) + self.num_spilled,
+                    'in_memory': len(self.queued_ids),
+                    'spilled_to_journal': self.num_spilled,
+                    'files_copied': self.files_copied,
+                    'files_failed': self.files_failed,
+                    'bytes_copied': self.bytes_copied,
+                    'bytes_per_sec': bytes_in_window / self.rate_window_in_sec}
+
+    def _work(self):
+        while self.running:
+            try:
+                job = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                with self.lock:
+                    if self.spilled:
+                        self._reload_spilled()
+                continue
+            try:
+                nbytes = self._copy(job['src'], job['dst'])
+            except OSError as error:
+                # an unreachable backup share raises FileNotFoundError too on Windows, which is retried
+                if not os.path.exists(job['src']):
+                    self.logger.warning('Backup source {src} no longer exists, dropping backup.'.format(
+                        src=job['src']))
+                    self._finish(job, nbytes=0, failed=True)
+                else:
+                    self._retry(job, error)
+            else:
+                self._finish(job, nbytes=nbytes)
+
+    def _copy(self, src, dst):
+        # copy to a temporary name first so a half written backup never looks complete
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        partial_dst = dst + '.part'
+        shutil.copyfile(src, partial_dst)
+        os.replace(partial_dst, dst)
+        return os.path.getsize(dst)
+
+    def _finish(self, job, nbytes, failed=False):
+        with self.lock:
+            self._write_journal({'op': 'done', 'id': job['id']})
+            self.queued_ids.discard(job['id'])
+            if failed:
+                self.files_failed += 1
+            else:
+                self.files_copied += 1
+                self.bytes_copied += nbytes
+                self.copied_log.append((time.monotonic(), nbytes))
+        self.logger.debug('backed up {src} to {dst}'.format(
+            src=job['src'], dst=job['dst']))
+
+    def _retry(self, job, error):
+        job['retries'] += 1
+        if job['retries'] > self.max_retries:
+            # leave the job in the journal, it is retried again on the next start
+            self.logger.error('Giving up on backup of {src} to {dst} after {n} tries: {error}'.format(
+                src=job['src'], dst=job['dst'], n=str(job['retries']), error=str(error)))
+            with self.lock:
+                self.queued_ids.discard(job['id'])
+                self.given_up_ids.add(job['id'])
+                self.files_failed += 1
+            return
+        backoff = min(self.base_backoff_in_sec * 2 ** (job['retries'] - 1),
+                      self.max_backoff_in_sec)
+        self.logger.warning('Backup of {src} failed ({error}), retrying in {backoff} sec.'.format(
+            src=job['src'], error=str(error), backoff=str(backoff)))
+        timer = threading.Timer(backoff, self.queue.put, args=(job,))
+        timer.daemon = True
+        timer.start()
+
+    def _reload_spilled(self):
+        """Queues pending jobs from the journal, starting at spill_offset, until the queue is full. Called with self.lock held.
+        The journal before spill_offset only holds jobs which were loaded already, so it is never read twice."""
+        self.journal_file.flush()
+        records = []  # (offset, record) of add records
+        done_ids = set()
+        end_offset = self.spill_offset
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self.spill_offset)
+            for line in journal:
+                offset = end_offset
+                end_offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:  # line cut short by a crash
+                    continue
+                if record['op'] == 'add':
+                    records.append((offset, record))
+                elif record['op'] == 'done':
+                    done_ids.add(record['id'])
+        for offset, record in records:
+            if record['id'] in self.queued_ids or record['id'] in done_ids or record['id'] in self.given_up_ids:
+                continue
+            job = {key: record[key] for key in ['id', 'src', 'dst']}
+            job['retries'] = 0
+            try:
+                self.queue.put_nowait(job)
+                self.queued_ids.add(job['id'])
+                self.num_spilled -= 1
+            except queue.Full:
+                self.spill_offset = offset
+                return
+        self.spill_offset = end_offset
+        self.spilled = False
+
+    def _trim_copied_log(self):
+        cutoff = time.monotonic() - self.rate_window_in_sec
+        while len(self.copied_log) > 0 and self.copied_log[0][0] < cutoff:
+            self.copied_log.popleft()
+
+    def _write_journal(self, record):
+        # called with self.lock held
+        self.journal_file.write(json.dumps(record) + '\n')
+        self.journal_file.flush()
+        self.dirty = True
+
+    def sync(self):
+        with self.lock:
+            if self.dirty and not self.journal_file.closed:
+                os.fsync(self.journal_file.fileno())
+                self.dirty = False
+
+    def _journal_loop(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
+            with self.lock:
+                # compared to the last compacted size, so that many pending jobs don't trigger a compaction every time
+                if self.journal_file.tell() > self.compacted_size + self.compact_size_in_bytes:
+                    self._compact_open_journal()
+
+    def _compact_open_journal(self):
+        """Rewrites the journal of a running BackupQueue to its pending jobs. Called with self.lock held."""
+        pending_jobs = self._read_pending_jobs()
+        # the journal is closed before it is replaced, which Windows requires
+        self.journal_file.close()
+        self._compact_journal(pending_jobs)
+        self.journal_file = open(self.journal_path, 'a')
+        self.compacted_size = self.journal_file.tell()
+        self.dirty = False
+        # jobs loaded already are skipped by their id, spilled ones are read again from the compacted journal
+        self.spill_offset = 0 if self.spilled else self.journal_file.tell()
+
+    def _read_pending_jobs(self):
+        if self.journal_file is not None and not self.journal_file.closed:
+            self.journal_file.flush()
+        if not os.path.exists(self.journal_path):
+            return []
+        pending_jobs = collections.OrderedDict()
+        with open(self.journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # line cut short by a crash
+                    continue
+                if record['op'] == 'add':
+                    pending_jobs[record['id']] = {key: record[key] for key in [
+                        'id', 'src', 'dst']}
+                    pending_jobs[record['id']]['retries'] = 0
+                elif record['op'] == 'done':
+                    pending_jobs.pop(record['id'], None)
+        return list(pending_jobs.values())
+
+    def _compact_journal(self, pending_jobs):
+        compacted_path = self.journal_path + '.tmp'
+        with open(compacted_path, 'w') as journal:
+            for job in pending_jobs:
+                journal.write(json.dumps(
+                    {'op': 'add', 'id': job['id'], 'src': job['src'], 'dst': job['dst']}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(compacted_path, self.journal_path)
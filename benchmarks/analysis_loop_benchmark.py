@@ -0,0 +1,192 @@
+"""Benchmark of AnalysisLogger's own overhead per shot, against the size of the backlog in the runfolder.
+
+For each backlog size, a runfolder is filled with that many small .spe images of runs on a local breadboard stand-in,
+and two things are measured:
+    - scan: the time of one monitor_watchfolder call with no new images, after one image is added and after one is
+      deleted, i.e. the folder scan and run_id bookkeeping done every refresh_time.
+    - drain: AnalysisLogger analyzes the whole backlog with a deterministic FakeAnalysis (see fake_analysis.py), uploads
+      the results and, with --delete-images, deletes the images. The loop overhead per shot is the drain time per shot
+      minus the mean analysis latency per worker.
+
+Each backlog size runs in its own process. Overhead that grows with the backlog points at O(n) work per shot, e.g.
+
+    python benchmarks/analysis_loop_benchmark.py --backlogs 100,1000,10000 --scan-only
+    python benchmarks/analysis_loop_benchmark.py --backlogs 50,200,1000 --latency uniform:0,0.01 --delete-images
+"""
+
+import os
+import sys
+import time
+import types
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+main_path = os.path.abspath(os.path.join(__file__, '../..'))
+sys.path.insert(0, main_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_breadboard import FakeBreadboard, FakeBreadboardClient
+from fake_analysis import FakeAnalysis
+
+IMAGE_BYTES = b'\0' * 64
+
+
+def backdate(folder, seconds=60):
+    """Sets the modification time of folder into the past, as for a folder nothing was written to lately."""
+    past = time.time() - seconds
+    os.utime(folder, (past, past))
+
+
+def median_seconds(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return statistics.median(durations)
+
+
+def make_logger(args, watchfolder, client):
+    """An AnalysisLogger on watchfolder analyzing with FakeAnalysis, writing to client, with Slack posts printed."""
+    import utility_functions
+    utility_functions.load_breadboard_client = lambda: client
+    sys.modules['enrico_bot'] = types.SimpleNamespace(post_message=print,
+                                                      post_image=print)
+    import analysis_loggerOOP
+    from analysis_engines import FunctionAnalysisEngine
+    fake_analysis = FakeAnalysis(
+        args.analysis, latency=args.latency, seed=args.seed)
+    # instead of the testing mode analysis, fake_analysis1, which sleeps at random
+    logger = analysis_loggerOOP.AnalysisLogger(analysis_mode='testing', watchfolder=watchfolder, load_matlab=False,
+                                               save_images=not args.delete_images, refresh_time=args.refresh_time,
+                                               append_mode=False, metrics_port=None, num_workers=args.workers,
+                                               lag_report_interval=float('inf'),
+                                               engine_factory=lambda: FunctionAnalysisEngine(fake_analysis),
+                                               analyzed_var_names=fake_analysis.var_names)
+    return logger, fake_analysis
+
+
+def make_runfolder(runfolder, fake_breadboard, backlog):
+    """Fills runfolder with an image for each of backlog new runs."""
+    os.mkdir(runfolder)
+    for _ in range(backlog):
+        with open(os.path.join(runfolder, '{id}_0.spe'.format(id=str(fake_breadboard.create_run()))), 'wb') as image_file:
+            image_file.write(IMAGE_BYTES)
+    backdate(runfolder)
+
+
+def run_backlog(backlog, args):
+    """Runs in a fresh process. Returns the results for one backlog size as a dictionary."""
+    workdir = tempfile.mkdtemp(prefix='enrico_loop_benchmark_')
+    os.chdir(workdir)
+    # AnalysisLogger prints every upload, which goes to a file instead of flooding the console
+    sys.stdout = open(os.path.join(workdir, 'analysis_logger_output.txt'), 'w')
+    fake_breadboard = FakeBreadboard(request_delay=args.request_delay).start()
+    client = FakeBreadboardClient(fake_breadboard.api_url)
+    runfolder = os.path.join(workdir, 'run0_scan')
+    make_runfolder(runfolder, fake_breadboard, backlog)
+    logger, _ = make_logger(args, runfolder, client)
+    results = {'backlog': backlog}
+
+    # scan: the first call finds the backlog, later ones only look for changes
+    start_time = time.perf_counter()
+    logger.monitor_watchfolder()
+    results['first_scan'] = time.perf_counter() - start_time
+    backdate(runfolder)
+    results['scan_idle'] = median_seconds(logger.monitor_watchfolder, args.repeats)
+    extra_run_ids = [fake_breadboard.create_run() for _ in range(args.repeats)]
+
+    def add_image():
+        with open(os.path.join(runfolder, '{id}_0.spe'.format(id=str(extra_run_ids.pop()))), 'wb') as image_file:
+            image_file.write(IMAGE_BYTES)
+        logger.monitor_watchfolder()
+
+    results['scan_new_image'] = median_seconds(add_image, args.repeats)
+    deletable = sorted(os.listdir(runfolder))[:args.repeats]
+
+    def delete_image():
+        os.remove(os.path.join(runfolder, deletable.pop()))
+        logger.monitor_watchfolder()
+
+    results['scan_deleted_image'] = median_seconds(delete_image, args.repeats)
+    if args.scan_only:
+        return results
+
+    # drain: the whole backlog of a fresh runfolder, through the pipeline
+    import threading
+    runfolder = os.path.join(workdir, 'run1_drain')
+    make_runfolder(runfolder, fake_breadboard, backlog)
+    logger, fake_analysis = make_logger(args, runfolder, client)
+    logger.monitor_watchfolder()
+    shots = len(logger.scheduler)
+    start_time = time.perf_counter()
+    threading.Thread(target=logger.main, daemon=True).start()
+    deadline = time.monotonic() + args.drain_timeout
+    while logger.pending_shots() > 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    drain_seconds = time.perf_counter() - start_time
+    analyzed = [run_id for run_id in logger.done_ids]
+    latency = sum(fake_analysis.latency(logger.shot_files(run_id)) for run_id in analyzed)
+    results.update({'shots': shots, 'analyzed': len(analyzed), 'drain_seconds': drain_seconds,
+                    'shots_per_second': len(analyzed) / drain_seconds,
+                    'analysis_seconds_per_shot': latency / max(len(analyzed), 1),
+                    'overhead_per_shot': (drain_seconds - latency / args.workers) / max(len(analyzed), 1),
+                    'breadboard_requests': fake_breadboard.request_count})
+    return results
+
+
+def report(all_results, scan_only):
+    header = '{:>8} {:>11} {:>11} {:>14} {:>14}'.format(
+        'backlog', 'first scan', 'idle scan', 'scan +1 image', 'scan -1 image')
+    if not scan_only:
+        header += ' {:>8} {:>10} {:>15} {:>15}'.format(
+            'shots', 'shots/s', 'analysis/shot', 'overhead/shot')
+    print(header)
+    for results in all_results:
+        line = '{backlog:>8} {first_scan:>10.2f}ms {scan_idle:>10.3f}ms {scan_new_image:>13.3f}ms {scan_deleted_image:>13.3f}ms'.format(
+            backlog=results['backlog'], **{key: results[key] * 1e3 for key in ['first_scan', 'scan_idle', 'scan_new_image',
+                                                                                 'scan_deleted_image']})
+        if not scan_only:
+            line += ' {analyzed:>8} {shots_per_second:>10.1f} {analysis:>13.2f}ms {overhead:>13.2f}ms'.format(
+                analyzed=results['analyzed'], shots_per_second=results['shots_per_second'],
+                analysis=results['analysis_seconds_per_shot'] * 1e3, overhead=results['overhead_per_shot'] * 1e3)
+            if results['analyzed'] < results['shots']:
+                line += '  (drain timed out)'
+        print(line)
+
+
+def main(args):
+    all_results = []
+    for backlog in args.backlogs:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            all_results.append(executor.submit(
+                run_backlog, backlog, args).result())
+        print('backlog {backlog} done'.format(backlog=str(backlog)))
+    print('\n')
+    report(all_results, args.scan_only)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark of AnalysisLogger's overhead per shot against the backlog size, with deterministic fake analyses.")
+    parser.add_argument('--backlogs', type=lambda text: [int(size) for size in text.split(',')],
+                        default=[100, 300, 1000])
+    parser.add_argument('--analysis', choices=['fake_analysis1', 'fake_analysis2'], default='fake_analysis1')
+    parser.add_argument('--latency', default='constant:0',
+                        help='analysis latency distribution, see fake_analysis.py, e.g. uniform:0,0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='analysis workers of AnalysisLogger')
+    parser.add_argument('--refresh-time', type=float, default=0.2,
+                        help='sec between watchfolder scans of AnalysisLogger')
+    parser.add_argument('--request-delay', type=float, default=0,
+                        help='sec added to every breadboard request')
+    parser.add_argument('--delete-images', action='store_true',
+                        help='run with save_images=False, deleting images after analysis')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='calls per scan measurement')
+    parser.add_argument('--scan-only', action='store_true',
+                        help='only measure monitor_watchfolder, not draining the backlog')
+    parser.add_argument('--drain-timeout', type=float, default=600)
+    main(parser.parse_args())
@@ -0,0 +1,62 @@
+"""Deterministic stand-ins for matlab_wrapper.fake_analysis1 and fake_analysis2, for benchmarks.
+
+A FakeAnalysis returns the same var names as the analysis it stands in for, with values and latency drawn from a random
+generator seeded by the run_id of the image, so that every run of a benchmark does the same work, in whatever order the
+shots are analyzed. Latencies follow a distribution given as 'name:parameters' in sec:
+    - 'constant:0.01'
+    - 'uniform:0,0.02'
+    - 'exponential:0.01' (mean)
+    - 'lognormal:0.01,0.5' (median, sigma of the log)
+    - 'choice:0,1,2' (equally likely values, like the randint sleeps of fake_analysis1)
+"""
+
+import os
+import sys
+import math
+import time
+import random
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../..')))
+
+import matlab_wrapper
+from measurement_directory import run_id_from_filename
+
+FAKE_ANALYSES = {'fake_analysis1': matlab_wrapper.fake_analysis1_var_names,
+                 'fake_analysis2': matlab_wrapper.fake_analysis2_var_names}
+
+
+def latency_sampler(distribution):
+    """Returns a function of a random.Random which draws a latency in sec from distribution, see the module docstring."""
+    name, _, parameters = distribution.partition(':')
+    values = [float(value) for value in parameters.split(',') if value != '']
+    if name == 'constant':
+        return lambda rng: values[0]
+    if name == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == 'exponential':
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0
+    if name == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if name == 'choice':
+        return lambda rng: rng.choice(values)
+    raise ValueError(distribution + ' is not a latency distribution, e.g. constant:0.01 or uniform:0,0.02')
+
+
+class FakeAnalysis():
+    """An analysis_function(filepath, previous_settings) returning (analysis_dict, None) after a seeded latency."""
+
+    def __init__(self, analysis='fake_analysis1', latency='constant:0', seed=0):
+        self.var_names = FAKE_ANALYSES[analysis]
+        self.sample_latency = latency_sampler(latency)
+        self.seed = seed
+
+    def rng(self, filepath):
+        filename = os.path.basename(filepath if isinstance(filepath, str) else filepath[0])
+        return random.Random(self.seed * 1000003 + run_id_from_filename(filename))
+
+    def latency(self, filepath):
+        return self.sample_latency(self.rng(filepath))
+
+    def __call__(self, filepath, previous_settings=None):
+        rng = self.rng(filepath)
+        time.sleep(self.sample_latency(rng))
+        return {name: rng.randint(0, 42) for name in self.var_names}, None
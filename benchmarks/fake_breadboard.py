@@ -0,0 +1,196 @@
+"""A local stand-in for the breadboard endpoints enrico uses, for benchmarks. Runs are kept in memory; the time each run
+first receives image names and analysis results is recorded so that end-to-end latencies can be computed.
+
+Like the real server, PUT and PATCH replace every field they contain, including the nested parameters and the imagenames
+list, so a client which writes without reading the run first wipes its other parameters. lost_fields tells if that
+happened to a run."""
+
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../..')))
+
+from breadboard_transport import BreadboardTransport
+
+
+class FakeBreadboard():
+    """FakeBreadboard serves /runs/ (GET with lab, limit and offset, POST) and /runs/<id>/ (GET, PUT, PATCH) on localhost.
+    PUT and PATCH replace the fields they contain, without merging parameters or image names."""
+
+    def __init__(self, port=0, request_delay=0):
+        """
+        Args:
+            - port: 0 picks a free port.
+            - request_delay: sec added to every request, to emulate the round-trip to the real breadboard server.
+        """
+        self.request_delay = request_delay
+        self.lock = threading.Lock()
+        self.runs = {}  # run_id: run dictionary in the breadboard API format
+        self.next_run_id = 1
+        self.images_registered_times = {}  # run_id: time.time() when image names were first written
+        # run_id: time.time() when parameters beyond the initial ones and the measurement name were first written
+        self.analysis_registered_times = {}
+        self.initial_parameters = {}  # run_id: parameters the run was created with
+        self.first_imagenames = {}  # run_id: image names of the first write of any
+        self.request_count = 0
+        self.server = ThreadingHTTPServer(('localhost', port), self._handler())
+        self.api_url = 'http://localhost:{port}'.format(
+            port=str(self.server.server_address[1]))
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def create_run(self, parameters=None, runtime=None):
+        """Adds a run as breadboard-cicero-client would. Returns the new run_id."""
+        if runtime is None:
+            runtime = datetime.datetime.today()
+        parameters = dict({'ListBoundVariables': []}, **(parameters or {}))
+        with self.lock:
+            run_id = self.next_run_id
+            self.next_run_id += 1
+            self.runs[run_id] = {'id': run_id,
+                                 'runtime': runtime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                 'imagenames': [],
+                                 'notes': '',
+                                 'parameters': parameters}
+            self.initial_parameters[run_id] = dict(parameters)
+        return run_id
+
+    def _update_run(self, run_id, update):
+        now = time.time()
+        with self.lock:
+            run_dict = self.runs[run_id]
+            run_dict.update(update)
+            if len(run_dict['imagenames']) > 0:
+                self.images_registered_times.setdefault(run_id, now)
+                self.first_imagenames.setdefault(run_id, list(run_dict['imagenames']))
+            analysis_names = set(run_dict['parameters']).difference(
+                self.initial_parameters[run_id]).difference({'measurement_name'})
+            if len(analysis_names) > 0:
+                self.analysis_registered_times.setdefault(run_id, now)
+            return run_dict
+
+    def lost_fields(self, run_id):
+        """Returns the names of the parameters the run was created with and of the image names first written to it which
+        it no longer has, e.g. because a later write replaced them."""
+        with self.lock:
+            run_dict = self.runs[run_id]
+            lost = [name for name in self.initial_parameters[run_id] if name not in run_dict['parameters']]
+            lost += [name for name in self.first_imagenames.get(run_id, []) if name not in run_dict['imagenames']]
+            return lost
+
+    def _handler(self):
+        fake_breadboard = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real breadboard server
+            # headers and body are written separately, which Nagle's algorithm would delay by a delayed ACK (~40 ms)
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _route(self):
+                with fake_breadboard.lock:
+                    fake_breadboard.request_count += 1
+                time.sleep(fake_breadboard.request_delay)
+                url = urllib.parse.urlparse(self.path)
+                parts = [part for part in url.path.split('/') if part != '']
+                run_id = int(parts[1]) if len(parts) > 1 else None
+                return url, run_id
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if length == 0:
+                    return {}
+                return json.loads(self.rfile.read(length))
+
+            def do_GET(self):
+                url, run_id = self._route()
+                if run_id is None:
+                    query = urllib.parse.parse_qs(url.query)
+                    limit = int(query.get('limit', ['100'])[0])
+                    offset = int(query.get('offset', ['0'])[0])
+                    with fake_breadboard.lock:
+                        run_ids = sorted(fake_breadboard.runs, reverse=True)
+                        results = [fake_breadboard.runs[idx]
+                                   for idx in run_ids[offset:offset + limit]]
+                        self._reply(200, {'count': len(run_ids), 'results': results})
+                elif run_id in fake_breadboard.runs:
+                    with fake_breadboard.lock:
+                        self._reply(200, fake_breadboard.runs[run_id])
+                else:
+                    self._reply(404, {'detail': 'Not found.'})
+
+            def do_POST(self):
+                self._route()
+                payload = self._read_body()
+                run_id = fake_breadboard.create_run(payload.get('parameters'))
+                self._reply(201, fake_breadboard.runs[run_id])
+
+            def _do_update(self):
+                _, run_id = self._route()
+                # read before replying, an unread body would be parsed as the next request on the connection
+                update = self._read_body()
+                if run_id not in fake_breadboard.runs:
+                    self._reply(404, {'detail': 'Not found.'})
+                    return
+                run_dict = fake_breadboard._update_run(run_id, update)
+                self._reply(200, run_dict)
+
+            def do_PATCH(self):
+                self._do_update()
+
+            def do_PUT(self):
+                self._do_update()
+
+        return Handler
+
+
+class FakeBreadboardClient():
+    """FakeBreadboardClient mimics the BreadboardClient methods used by enrico, sending requests to a FakeBreadboard
+    through a BreadboardTransport, as load_breadboard_client does for the real client. Like those, each method reads the
+    run, merges its update into the parameters or image names and writes them back."""
+
+    def __init__(self, api_url):
+        self.api_url = api_url
+        BreadboardTransport(api_url).attach(self)
+
+    def _get_run(self, run_id):
+        return self._send_message('get', '/runs/' + str(run_id) + '/').json()
+
+    def _update_parameters(self, run_id, parameters):
+        run_parameters = self._get_run(run_id)['parameters']
+        run_parameters.update(parameters)
+        return self._send_message('patch', '/runs/' + str(run_id) + '/', data=json.dumps({'parameters': run_parameters}))
+
+    def append_images_to_run(self, run_id, imagenames):
+        run_imagenames = self._get_run(run_id)['imagenames']
+        run_imagenames += [name for name in imagenames if name not in run_imagenames]
+        return self._send_message('patch', '/runs/' + str(run_id) + '/', data=json.dumps({'imagenames': run_imagenames}))
+
+    def add_measurement_name_to_run(self, run_id, measurement_name):
+        return self._update_parameters(run_id, {'measurement_name': measurement_name})
+
+    def add_instrument_readout_to_run(self, run_id, readout):
+        return self._update_parameters(run_id, readout)
+
+    def append_analysis_to_run(self, run_id, analysis_dict):
+        return self._update_parameters(run_id, analysis_dict)
@@ -0,0 +1,189 @@
+"""End-to-end benchmark of the shot pipeline: a fake camera writes .spe files into a watchfolder while a fake Cicero
+creates runs on a local breadboard stand-in, ImageWatchdog matches and moves the images and AnalysisLogger analyzes them
+with matlab_wrapper.fake_analysis1.
+
+Reports p50/p95/p99 latency from file creation to the image names (and analysis results) arriving on breadboard, and the
+throughput in shots/s. Also checks that the Cicero parameters and image names of each run survive the later writes of
+the analysis results. Use a high --rate or --burst-size to measure throughput at saturation, e.g.
+
+    python benchmarks/shot_pipeline_benchmark.py --shots 50 --rate 2 --images-per-shot 3
+"""
+
+import os
+import sys
+import time
+import types
+import argparse
+import datetime
+import tempfile
+import threading
+main_path = os.path.abspath(os.path.join(__file__, '../..'))
+sys.path.insert(0, main_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_breadboard import FakeBreadboard, FakeBreadboardClient
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of values, q in [0, 100]."""
+    if len(values) == 0:
+        return float('nan')
+    ordered = sorted(values)
+    idx = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(idx, len(ordered) - 1)]
+
+
+def latency_report(name, latencies, start_time, end_times):
+    if len(latencies) == 0:
+        return '{name}: no shots completed'.format(name=name)
+    elapsed = max(end_times) - start_time
+    return '{name}: {n} shots, latency p50 {p50:.3f} s, p95 {p95:.3f} s, p99 {p99:.3f} s, {rate:.2f} shots/s'.format(
+        name=name, n=str(len(latencies)), p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99), rate=len(latencies) / elapsed)
+
+
+class FakeCamera():
+    """Creates a breadboard run per shot (like breadboard-cicero-client) and then writes images_per_shot fake .spe files
+    into the watchfolder, camera_delay sec later, in write_chunks chunks to emulate a camera still writing to disk."""
+
+    def __init__(self, fake_breadboard, watchfolder, images_per_shot=1, image_bytes=2 ** 20, camera_delay=0.5,
+                 write_chunks=4):
+        self.fake_breadboard = fake_breadboard
+        self.watchfolder = watchfolder
+        self.images_per_shot = images_per_shot
+        self.image_bytes = image_bytes
+        self.camera_delay = camera_delay
+        self.write_chunks = write_chunks
+        self.file_created_times = {}  # run_id: time.time() the last image of the shot was closed
+
+    def shot(self):
+        # Cicero parameters, which the image names and analysis results must not replace
+        run_id = self.fake_breadboard.create_run(
+            {'ListBoundVariables': ['TOF'], 'TOF': 10, 'IterationNum': len(self.file_created_times)})
+        threading.Thread(target=self._write_images,
+                         args=(run_id,), daemon=True).start()
+        return run_id
+
+    def _write_images(self, run_id):
+        time.sleep(self.camera_delay)
+        timestamp = datetime.datetime.today().strftime('%Y%m%d-%H%M%S-%f')
+        chunk = os.urandom(self.image_bytes // self.write_chunks)
+        for idx in range(self.images_per_shot):
+            filepath = os.path.join(self.watchfolder, '{timestamp}_{idx}.spe'.format(
+                timestamp=timestamp, idx=str(idx)))
+            with open(filepath, 'wb') as file:
+                for _ in range(self.write_chunks):
+                    file.write(chunk)
+                    file.flush()
+        self.file_created_times[run_id] = time.time()
+
+
+def shot_schedule(shots, rate, burst_size, burst_gap):
+    """Yields the time in sec after the start at which each shot is taken: shots at rate shots/s, with an extra pause of
+    burst_gap sec after every burst_size shots."""
+    t = 0
+    for idx in range(shots):
+        yield t
+        t += 1 / rate
+        if (idx + 1) % burst_size == 0:
+            t += burst_gap
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='enrico_benchmark_')
+    os.chdir(workdir)
+    fake_breadboard = FakeBreadboard(
+        request_delay=args.request_delay).start()
+    client = FakeBreadboardClient(fake_breadboard.api_url)
+
+    # route all breadboard traffic to the stand-in and keep benchmarks off Slack, before the modules below load them
+    import utility_functions
+    utility_functions.load_breadboard_client = lambda: client
+    sys.modules['enrico_bot'] = types.SimpleNamespace(post_message=print,
+                                                      post_image=print)
+    from measurement_directory import measurement_directory
+    from run_feed import RunFeed
+    import image_watchdog
+    import analysis_loggerOOP
+
+    watchfolder = os.path.join(workdir, 'images')
+    os.mkdir(watchfolder)
+    runfolder = measurement_directory(measurement_name='run0_benchmark')
+    watchdog = image_watchdog.ImageWatchdog(watchfolder=watchfolder, num_images_per_shot=args.images_per_shot,
+                                            backup_to_bec1server=False, runfolder=runfolder,
+                                            use_file_events=not args.polling, run_feed=RunFeed(client).start())
+    threading.Thread(target=watchdog.main, daemon=True).start()
+    if not args.no_analysis:
+        analysis_logger = analysis_loggerOOP.AnalysisLogger(analysis_mode='testing', watchfolder=os.path.abspath(runfolder),
+                                                            load_matlab=False, save_images=True, append_mode=False,
+                                                            num_workers=args.analysis_workers)
+        analysis_logger.images_per_shot = args.images_per_shot
+        threading.Thread(target=analysis_logger.main, daemon=True).start()
+
+    camera = FakeCamera(fake_breadboard, watchfolder, images_per_shot=args.images_per_shot,
+                        image_bytes=args.image_bytes, camera_delay=args.camera_delay)
+    start_time = time.time()
+    run_ids = []
+    for shot_time in shot_schedule(args.shots, args.rate, args.burst_size, args.burst_gap):
+        time.sleep(max(start_time + shot_time - time.time(), 0))
+        run_ids.append(camera.shot())
+
+    deadline = time.time() + args.drain_timeout
+    registered = fake_breadboard.images_registered_times
+    analyzed = fake_breadboard.analysis_registered_times
+    while time.time() < deadline:
+        done = registered if args.no_analysis else analyzed
+        if all(run_id in done for run_id in run_ids):
+            break
+        time.sleep(0.1)
+
+    image_latencies = [registered[run_id] - camera.file_created_times[run_id]
+                       for run_id in run_ids if run_id in registered and run_id in camera.file_created_times]
+    print('\n')
+    print(latency_report('file creation -> image names on breadboard', image_latencies,
+                         start_time, [registered[run_id] for run_id in run_ids if run_id in registered]))
+    if not args.no_analysis:
+        analysis_latencies = [analyzed[run_id] - camera.file_created_times[run_id]
+                              for run_id in run_ids if run_id in analyzed and run_id in camera.file_created_times]
+        print(latency_report('file creation -> analysis on breadboard', analysis_latencies,
+                             start_time, [analyzed[run_id] for run_id in run_ids if run_id in analyzed]))
+    misplaced_folder = watchdog.misplaced_folder
+    n_misplaced = len(os.listdir(misplaced_folder)) if os.path.exists(
+        misplaced_folder) else 0
+    print('{n} of {total} shots matched, {misplaced} images misplaced, {requests} breadboard requests.'.format(
+        n=str(len(registered)), total=str(len(run_ids)), misplaced=str(n_misplaced),
+        requests=str(fake_breadboard.request_count)))
+    damaged_run_ids = [run_id for run_id in run_ids if len(fake_breadboard.lost_fields(run_id)) > 0]
+    for run_id in damaged_run_ids:
+        print('run_id {id} lost {fields}'.format(
+            id=str(run_id), fields=', '.join(fake_breadboard.lost_fields(run_id))))
+    print('{n} runs lost Cicero parameters or image names.'.format(
+        n=str(len(damaged_run_ids))))
+    print('benchmark files in ' + workdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end benchmark of ImageWatchdog and AnalysisLogger against a local breadboard stand-in.')
+    parser.add_argument('--shots', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=1,
+                        help='shots/s within a burst')
+    parser.add_argument('--burst-size', type=int, default=1,
+                        help='shots per burst')
+    parser.add_argument('--burst-gap', type=float, default=0,
+                        help='extra pause in sec after each burst')
+    parser.add_argument('--images-per-shot', type=int, default=1)
+    parser.add_argument('--image-bytes', type=int, default=2 ** 20)
+    parser.add_argument('--camera-delay', type=float, default=0.5,
+                        help='sec between run creation and the images being written')
+    parser.add_argument('--request-delay', type=float, default=0.02,
+                        help='sec added to every breadboard request')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='sec to wait for the pipeline to finish after the last shot')
+    parser.add_argument('--polling', action='store_true',
+                        help='poll the watchfolder instead of using file system events')
+    parser.add_argument('--no-analysis', action='store_true',
+                        help='only run ImageWatchdog')
+    parser.add_argument('--analysis-workers', type=int, default=1,
+                        help='number of AnalysisLogger analysis workers')
+    main(parser.parse_args())
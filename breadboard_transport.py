@@ -0,0 +1,89 @@
+"""A shared HTTP transport for all breadboard traffic of a process. load_breadboard_client() routes the BreadboardClient
+through it, so the polling loops of image_watchdog.py, run_feed.py, the analysis loggers and the instruments reuse
+keep-alive connections instead of paying connection setup on every request.
+
+    from breadboard_transport import BreadboardTransport
+    transport = BreadboardTransport('https://breadboard.example.org', api_key)
+    resp = transport.send_message('get', '/runs/', params={'lab': 'fermi1', 'limit': 1})
+"""
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import REGISTRY
+
+HTTP_REQUESTS = REGISTRY.counter('enrico_breadboard_http_requests_total',
+                                 'HTTP requests sent to breadboard, by method and status code.')
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('enrico_breadboard_http_request_seconds',
+                                          'Duration of HTTP requests to breadboard, by method.')
+
+
+class BreadboardTransport():
+    """BreadboardTransport sends breadboard API requests over one pooled requests.Session. send_message has the
+    signature of BreadboardClient._send_message, which it replaces (see attach).
+
+    Connections are kept alive and reused across threads, up to pool_maxsize per host. Every request gets a
+    (connect, read) timeout, responses are gzip-compressed by the server if it supports it, and request counts and
+    latencies are kept here and exported through metrics.py."""
+
+    def __init__(self, api_url, api_key=None, timeout=(3.05, 10), pool_maxsize=10, max_connect_retries=2):
+        """
+        Args:
+            - api_url: base url of the breadboard API, e.g. the api_url of the breadboard API config.
+            - api_key: breadboard API token, sent as 'Authorization: Token <api_key>'.
+            - timeout: (connect, read) timeout in sec, or one number for both.
+            - max_connect_retries: retries of requests which failed to connect. Requests which reached the server are
+              never retried here, callers decide whether a request is safe to repeat.
+        """
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        # only failed connections are retried, a read error may come after the server acted on the request.
+        # read=False raises read errors as they are, e.g. as requests.ReadTimeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                              max_retries=Retry(total=max_connect_retries, connect=max_connect_retries, read=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Content-Type': 'application/json'})
+        if api_key is not None:
+            self.session.headers.update(
+                {'Authorization': 'Token ' + api_key})
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.total_request_time = 0
+
+    def send_message(self, method, url, params=None, data=None, timeout=None):
+        """Sends an HTTP request to api_url + url and returns the requests.Response."""
+        start_time = time.monotonic()
+        status = 'error'
+        try:
+            # appended rather than joined, an absolute url like /runs/ would drop a path prefix of api_url
+            resp = self.session.request(method.upper(), self.api_url.rstrip('/') + url, params=params, data=data,
+                                        timeout=self.timeout if timeout is None else timeout)
+            status = str(resp.status_code)
+            return resp
+        finally:
+            elapsed = time.monotonic() - start_time
+            with self.lock:
+                self.request_count += 1
+                self.total_request_time += elapsed
+            HTTP_REQUESTS.inc(method=method.lower(), status=status)
+            HTTP_REQUEST_SECONDS.observe(elapsed, method=method.lower())
+
+    def stats(self):
+        with self.lock:
+            mean_latency = self.total_request_time / \
+                self.request_count if self.request_count > 0 else 0
+            return {'request_count': self.request_count, 'mean_latency_in_sec': mean_latency}
+
+    def attach(self, bc):
+        """Routes all requests of breadboard client bc through this transport. Returns bc."""
+        bc._send_message = self.send_message
+        bc.transport = self
+        return bc
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,160 @@
+import sys
+import json
+import time
+import logging
+import threading
+from metrics import REGISTRY, BREADBOARD_REQUEST_SECONDS, BREADBOARD_RETRIES
+
+BREADBOARD_PENDING_WRITES = REGISTRY.gauge('enrico_breadboard_pending_writes',
+                                           'Runs with updates waiting to be written to breadboard.')
+
+
+class BreadboardWriteCoalescer():
+    """BreadboardWriteCoalescer collects updates to breadboard runs (image names, measurement name, instrument readouts,
+    analysis results) and writes all pending updates of a run in a single GET + PUT round-trip, instead of one round-trip
+    per BreadboardClient call. Breadboard replaces the parameters and image names of a run on every write, so the run is
+    read first, the pending parameters are merged into its parameters and the pending image names appended to its image
+    names, as log_editor.py does. The measurement name is set with the client's own add_measurement_name_to_run.
+
+    Pending updates are flushed from a background thread every flush_interval sec, or immediately once max_batch_size runs
+    are pending. Failed writes are kept and retried after retry_delay sec, doubling on every further failure, up to
+    max_attempts times."""
+
+    def __init__(self, bc, flush_interval=0.2, max_batch_size=20, max_attempts=3, retry_delay=1):
+        self.bc = bc
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        # run_id: {'imagenames': [...], 'parameters': {...}, 'measurement_name': str or None, 'attempts': int,
+        # 'retry_time': time.monotonic() before which the update isn't retried}
+        self.pending = {}
+        self.running = False
+        self.thread = None
+        self.requests_sent = 0
+        self.updates_received = 0
+        self.given_up_run_ids = []  # run_ids whose update was dropped after max_attempts failed writes
+        BREADBOARD_PENDING_WRITES.set_function(lambda: len(self.pending))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Flushes all pending updates and stops the background thread."""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush(retry_now=True)
+
+    def update_run(self, run_id, imagenames=None, parameters=None, measurement_name=None):
+        """Schedules imagenames to be written to, parameters to be merged into and measurement_name to be set on
+        breadboard run run_id."""
+        with self.condition:
+            update = self.pending.setdefault(run_id, {'imagenames': [], 'parameters': {}, 'measurement_name': None,
+                                                      'attempts': 0, 'retry_time': 0})
+            if imagenames is not None:
+                update['imagenames'] += [name for name in imagenames
+                                         if name not in update['imagenames']]
+            if parameters is not None:
+                update['parameters'].update(parameters)
+            if measurement_name is not None:
+                update['measurement_name'] = measurement_name
+            self.updates_received += 1
+            if len(self.pending) >= self.max_batch_size:
+                self.condition.notify_all()
+
+    def append_images_to_run(self, run_id, imagenames):
+        self.update_run(run_id, imagenames=imagenames)
+
+    def add_measurement_name_to_run(self, run_id, measurement_name):
+        self.update_run(run_id, measurement_name=measurement_name)
+
+    def add_instrument_readout_to_run(self, run_id, readout):
+        self.update_run(run_id, parameters=readout)
+
+    def append_analysis_to_run(self, run_id, analysis_dict):
+        self.update_run(run_id, parameters=analysis_dict)
+
+    def flush(self, retry_now=False):
+        """Writes all pending updates now, one GET + PUT round-trip per run. Failed updates are left until their retry time, unless
+        retry_now."""
+        now = time.monotonic()
+        with self.condition:
+            pending = {run_id: update for run_id, update in self.pending.items()
+                       if retry_now or update['retry_time'] <= now}
+            for run_id in pending:
+                del self.pending[run_id]
+        for run_id, update in pending.items():
+            try:
+                self._write(run_id, update)
+            except:
+                update['attempts'] += 1
+                if update['attempts'] < self.max_attempts:
+                    BREADBOARD_RETRIES.inc(request='run_update')
+                    retry_delay = self.retry_delay * 2 ** (update['attempts'] - 1)
+                    update['retry_time'] = time.monotonic() + retry_delay
+                    self.logger.warning('Failed to write {update} to breadboard run_id {id}, retrying in {delay} s. Error: {error}'.format(
+                        update=str(update), id=str(run_id), delay=str(retry_delay), error=str(sys.exc_info()[1])))
+                    self._requeue(run_id, update)
+                else:
+                    self.logger.error('Giving up writing {update} to breadboard run_id {id}. Error: {error}'.format(
+                        update=str(update), id=str(run_id), error=str(sys.exc_info()[1])))
+                    self.given_up_run_ids.append(run_id)
+
+    def _write(self, run_id, update):
+        start_time = time.monotonic()
+        run_url = '/runs/' + str(run_id) + '/'
+        if update['measurement_name'] is not None:
+            # first, so that the run read below already has it and the PUT keeps it
+            self.bc.add_measurement_name_to_run(
+                run_id, update['measurement_name'])
+            self.requests_sent += 1
+        if len(update['imagenames']) > 0 or len(update['parameters']) > 0:
+            resp = self.bc._send_message('get', run_url)
+            self.requests_sent += 1
+            if resp.status_code != 200:
+                raise ValueError('Breadboard error while fetching run_id {id}: {text}'.format(
+                    id=str(run_id), text=resp.text))
+            run_dict = resp.json()
+            existing_imagenames = run_dict.get('imagenames') or []
+            run_dict['imagenames'] = existing_imagenames + [name for name in update['imagenames']
+                                                            if name not in existing_imagenames]
+            run_dict['parameters'].update(update['parameters'])
+            resp = self.bc._send_message(
+                'put', run_url, data=json.dumps(run_dict))
+            self.requests_sent += 1
+            if resp.status_code != 200:
+                raise ValueError('Upload error: ' + resp.text)
+        BREADBOARD_REQUEST_SECONDS.observe(
+            time.monotonic() - start_time, request='run_update')
+        self.logger.debug('Wrote {update} to breadboard run_id {id}.'.format(
+            update=str({key: update[key] for key in ['imagenames', 'parameters', 'measurement_name']}), id=str(run_id)))
+
+    def _requeue(self, run_id, update):
+        # merges a failed update back in front of anything that came in since
+        with self.condition:
+            newer_update = self.pending.pop(run_id, None)
+            if newer_update is not None:
+                update['imagenames'] += [name for name in newer_update['imagenames']
+                                         if name not in update['imagenames']]
+                update['parameters'].update(newer_update['parameters'])
+                if newer_update['measurement_name'] is not None:
+                    update['measurement_name'] = newer_update['measurement_name']
+            self.pending[run_id] = update
+
+    def _work(self):
+        while True:
+            with self.condition:
+                # woken early by update_run once max_batch_size runs are pending
+                if self.running:
+                    self.condition.wait(timeout=self.flush_interval)
+                if not self.running:
+                    return
+            self.flush()
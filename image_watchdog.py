@@ -3,6 +3,7 @@ import time
 import datetime
 import shutil
 import sys
+import queue
 from utility_functions import load_breadboard_client, load_bec1serverpath
 import utility_functions
 bc = load_breadboard_client()
@@ -10,6 +11,27 @@ import warnings
 from measurement_directory import measurement_directory, todays_measurements
 import enrico_bot
 import logging
+from watchfolder_events import WatchfolderEvents, WATCHDOG_AVAILABLE
+from write_completion import WriteCompletionDetector
+from backup_queue import BackupQueue
+from run_feed import get_run_feed
+from recent_runs import RecentRunsIndex
+from move_journal import MoveJournal
+from breadboard_writes import BreadboardWriteCoalescer
+from metrics import REGISTRY, start_metrics_server
+
+METRICS_PORT = 9110
+IMAGE_EXTENSION = '.spe'  # of the images moved to run folders, next to which e.g. .jpeg previews are written
+SHOTS_MATCHED = REGISTRY.counter('enrico_watchdog_shots_matched_total',
+                                 'Shots matched to a breadboard run, by watchfolder.')
+SHOTS_MISPLACED = REGISTRY.counter('enrico_watchdog_shots_misplaced_total',
+                                   'Shots moved to the misplaced folder, by watchfolder.')
+MATCH_LATENCY = REGISTRY.histogram('enrico_watchdog_match_latency_seconds',
+                                   'Time from a shot arriving in the watchfolder to its images being moved to the run folder.')
+IDLE_SECONDS = REGISTRY.gauge('enrico_watchdog_idle_seconds',
+                              'Time since the last shot arrived, by watchfolder.')
+BACKUP_QUEUE_DEPTH = REGISTRY.gauge('enrico_backup_queue_depth',
+                                    'Files waiting to be copied to bec1server.')
 
 
 class ImageWatchdog():
@@ -19,13 +41,34 @@ class ImageWatchdog():
 
     def __init__(self, watchfolder=os.path.join(os.path.dirname(__file__), 'images'),
                  num_images_per_shot=1, refresh_time=0.3, backup_to_bec1server=True, MONTH_DIR_FMT='%Y%m',
-                 max_time_diff_in_sec=5, min_time_diff_in_sec=0, max_idle_time=60 * 3, runfolder=None):
+                 max_time_diff_in_sec=5, min_time_diff_in_sec=0, max_idle_time=60 * 3, runfolder=None,
+                 use_file_events=True, run_feed=None, catch_up_min_shots=3, resume_on_start=True,
+                 breadboard_writes=None, backup_queue=None, metrics_port=METRICS_PORT):
+        """
+        Args:
+            - metrics_port: local port serving shot, latency and queue metrics at http://localhost:metrics_port/metrics
+              (see metrics.py). None to not start a metrics server, e.g. if another object in the process already has.
+            - breadboard_writes, backup_queue: a BreadboardWriteCoalescer and BackupQueue to share with other
+              ImageWatchdogs in the same process (see multi_camera_watchdog.py). Created by this ImageWatchdog if None.
+            - resume_on_start: if True, images left in the watchfolder by a previous session are matched using the move
+              journal (see resume_watchfolder). If False, they are moved to a misplacedimages folder (see clear_watchfolder).
+            - catch_up_min_shots: if at least this many shots are waiting in the watchfolder, e.g. after a stall, they are
+              matched to runs in one batch (see catch_up) instead of one shot per loop iteration.
+            - run_feed: RunFeed or RunFeedClient providing the newest breadboard run. By default, connects to the
+              run_feed.py server if it is running or polls breadboard from this process otherwise.
+            - use_file_events: set to False to poll the watchfolder with os.listdir every refresh_time instead of
+              listening for file system events. Polling is also used if the watchdog package is not installed.
+        """
         self.MONTH_DIR_FMT = MONTH_DIR_FMT
         self.init_logger()
         self.watchfolder = watchfolder
         print("\n\nWatching this folder for changes: " + self.watchfolder)
-        # clears watchfolder by moving unmatched images to a temporary storage folder
-        self.clear_watchfolder()
+        self.metric_labels = {'watchfolder': os.path.basename(
+            os.path.normpath(self.watchfolder))}
+        if not resume_on_start:
+            # clears watchfolder by moving unmatched images to a temporary storage folder
+            self.clear_watchfolder()
+        self.init_file_events(use_file_events)
         if runfolder is None:
             self.set_runfolder()
         else:
@@ -34,15 +77,51 @@ class ImageWatchdog():
         self.num_images_per_shot = num_images_per_shot
         self.refresh_time = refresh_time
         self.backup_to_bec1server = backup_to_bec1server
+        self.backup_queue = backup_queue
+        # shared objects passed in are stopped by their owner, e.g. MultiCameraWatchdog.shutdown
+        self.owns_backup_queue = backup_queue is None
+        self.owns_breadboard_writes = breadboard_writes is None
         if self.backup_to_bec1server:
             self.set_bec1serverpath()
         self.previous_update_time = datetime.datetime.now()
         self.incomingfile_time = datetime.datetime.now()
         self.newest_run_dict = {'run_id': 0}
+        if run_feed is None:
+            run_feed = get_run_feed(bc)
+        self.run_feed = run_feed
+        self.run_subscriber = run_feed.subscribe()
+        self.recent_runs = RecentRunsIndex()
+        # image and measurement names are written to breadboard together, once per run
+        if breadboard_writes is None:
+            breadboard_writes = BreadboardWriteCoalescer(bc).start()
+        self.breadboard_writes = breadboard_writes
         self.max_time_diff_in_sec = max_time_diff_in_sec
         self.min_time_diff_in_sec = min_time_diff_in_sec
         self.idle_message_sent = False
         self.max_idle_time = max_idle_time
+        self.catch_up_min_shots = catch_up_min_shots
+        self.pending_filenames = []
+        self.init_move_journal(resume_on_start)
+        self.init_metrics(metrics_port)
+
+    def init_metrics(self, metrics_port):
+        IDLE_SECONDS.set_function(lambda: (datetime.datetime.now() - self.incomingfile_time).total_seconds(),
+                                  **self.metric_labels)
+        if self.backup_to_bec1server:
+            BACKUP_QUEUE_DEPTH.set_function(
+                lambda: self.backup_queue.stats()['queue_depth'])
+        if metrics_port is not None:
+            start_metrics_server(metrics_port)
+
+    def init_move_journal(self, resume_on_start):
+        # one journal per watchfolder, so that several cameras can run side by side
+        watchfolder_name = os.path.basename(
+            os.path.normpath(self.watchfolder))
+        self.move_journal = MoveJournal(measurement_directory(
+            measurement_name='') + 'image_watchdog_move_journal_{name}.jsonl'.format(name=watchfolder_name))
+        unfinished_records = self.move_journal.start()
+        if resume_on_start:
+            self.resume_watchfolder(unfinished_records)
 
     def init_logger(self):
         '''A debugging log is created in the MM/YYMMDD with info to manually associate files that failed to match.'''
@@ -50,12 +129,25 @@ class ImageWatchdog():
         logger = self.logger
         logger.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s:%(name)s:%(message)s')
-        file_handler = logging.FileHandler(measurement_directory(
+        log_path = os.path.abspath(measurement_directory(
             measurement_name='') + 'image_watchdog_debugging.log')
+        if any(getattr(handler, 'baseFilename', None) == log_path for handler in logger.handlers):
+            return  # another ImageWatchdog in this process already logs there
+        file_handler = logging.FileHandler(log_path)
         file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
 
+    def init_file_events(self, use_file_events):
+        self.file_events = None
+        if use_file_events and WATCHDOG_AVAILABLE:
+            self.file_events = WatchfolderEvents(self.watchfolder)
+            self.file_events.start()
+        elif use_file_events:
+            print('watchdog package not found, polling watchfolder instead.')
+        self.write_completion = WriteCompletionDetector(
+            file_events=self.file_events)
+
     def getFileList(self):
         folder = self.watchfolder
         if not os.path.exists(folder):
@@ -81,6 +173,60 @@ class ImageWatchdog():
                 path=misplaced_filepath))
             os.mkdir(self.watchfolder)
 
+    def resume_watchfolder(self, unfinished_records):
+        """Finishes the images a previous session left in the watchfolder in one pass. Images the journal lists as matched
+        are moved to their recorded destination, all others are matched like a backlog (see catch_up), using their
+        recorded arrival time if they had been picked up before. Images left over from an incomplete shot are moved to the
+        misplaced folder, as they can't be told apart from the next shot's images in the regular loop."""
+        filenames, _ = self.getFileList()
+        if len(filenames) == 0:
+            return
+        print('{n} file(s) left in {folder}, resuming.'.format(
+            n=str(len(filenames)), folder=self.watchfolder))
+        matched_records = {}  # run_id: journal records of files matched to run_id
+        remaining_filenames = []
+        arrival_times = {}
+        for filename in filenames:
+            record = unfinished_records.get(filename)
+            if record is not None and record['state'] == 'matched':
+                matched_records.setdefault(record['run_id'], []).append(record)
+                continue
+            remaining_filenames.append(filename)
+            if record is not None and 'arrival_time' in record:
+                arrival_times[filename] = datetime.datetime.strptime(
+                    record['arrival_time'], '%Y-%m-%dT%H:%M:%S.%f')
+        for run_id, records in matched_records.items():
+            for record in records:
+                destination = record['destination']
+                if not os.path.exists(os.path.dirname(destination)):
+                    os.mkdir(os.path.dirname(destination))
+                shutil.move(os.path.join(self.watchfolder,
+                                         record['file']), os.path.abspath(destination))
+                self.move_journal.record(
+                    [record['file']], 'moved', run_id=run_id, destination=destination)
+                self.logger.debug('resumed moving {old_name} to {destination}'.format(old_name=record['file'],
+                                                                                      destination=destination))
+                if self.backup_to_bec1server:
+                    self.backup_queue.enqueue(os.path.abspath(destination),
+                                              os.path.join(self.bec1serverpath, destination))
+            # includes images of the run moved before the crash, whose breadboard write may not have gone out, but not
+            # their previews, see preview_renderer.py
+            run_folder = os.path.dirname(records[0]['destination'])
+            run_filenames = sorted([filename for filename in os.listdir(run_folder)
+                                    if filename.startswith(str(run_id) + '_') and filename.endswith(IMAGE_EXTENSION)])
+            self.write_images_to_breadboard(run_id, run_filenames)
+            self.recent_runs.mark_matched(run_id)
+        if len(remaining_filenames) >= self.num_images_per_shot:
+            self.catch_up(remaining_filenames, arrival_times=arrival_times)
+        leftover_filenames = [filename for filename in remaining_filenames
+                              if os.path.exists(os.path.join(self.watchfolder, filename))]
+        if len(leftover_filenames) > 0:
+            self.logger.warning('Incomplete shot {files} left from the previous session, moving to {folder}.'.format(
+                files=str(leftover_filenames), folder=self.misplaced_folder))
+            self.new_imagenames = leftover_filenames
+            self.move_images(False)
+        self.breadboard_writes.flush()
+
     def set_runfolder(self):
         print('existing runs: ')
         print(todays_measurements())
@@ -102,9 +248,25 @@ class ImageWatchdog():
             if not os.path.exists(path):
                 print('creating {path} on bec1server.'.format(path=path))
                 os.mkdir(path)
+        if self.backup_queue is None:
+            # pending backups survive restarts of the watchdog, they are kept in a journal in the MM/YYMMDD folder
+            self.backup_queue = BackupQueue(measurement_directory(
+                measurement_name='') + 'bec1server_backup_journal.jsonl')
+            self.backup_queue.start()
+
+    def backup_stats_message(self):
+        stats = self.backup_queue.stats()
+        return 'bec1server backup queue depth: {depth}, {rate:.1f} kB/s, {failed} failed.'.format(
+            depth=str(stats['queue_depth']), rate=stats['bytes_per_sec'] / 1e3, failed=str(stats['files_failed']))
 
     def monitor_watchfolder(self):
-        filenames, _ = self.getFileList()
+        if self.file_events is None:
+            filenames, _ = self.getFileList()
+        else:
+            # blocks for at most refresh_time, returns as soon as a full shot has arrived
+            filenames = self.file_events.wait_for_shot(
+                self.num_images_per_shot, timeout=self.refresh_time)
+        self.pending_filenames = filenames
         if len(filenames) >= self.num_images_per_shot:
             self.new_imagenames = filenames[0:self.num_images_per_shot]
             new_images_bool = True
@@ -114,32 +276,28 @@ class ImageWatchdog():
             new_images_bool = False
         return new_images_bool
 
-    def update_run_dict(self, MAX_RETRIES=10):
-        try_counter = 0
-        success = False
-        while try_counter < MAX_RETRIES:
-            try_counter += 1
-            if success:
+    def update_run_dict(self):
+        """Adds the runs pushed by the run feed since the last call to the recent runs index and updates newest_run_dict."""
+        while True:
+            try:
+                new_run_dict = self.run_subscriber.get_nowait()
+            except queue.Empty:
                 break
-            else:
-                try:
-                    if try_counter > 1:
-                        print('Retrying to get newest breadboard entry. Tries: {n}'.format(
-                            n=str(try_counter)))
-                    new_run_dict = utility_functions.get_newest_run_dict(bc)
-                    new_id = new_run_dict['run_id']
-                    if self.newest_run_dict['run_id'] < new_id:
-                        print('new id: {id}'.format(id=str(new_id)))
-                        print('list bound variables: {run_dict}'.format(run_dict={key: new_run_dict[key]
-                                                                                  for key in new_run_dict['ListBoundVariables']}))
-                        self.logger.debug(
-                            'new run_id: ' + str(new_run_dict['run_id']) + '. runtime: ' + str(new_run_dict['runtime']))
-                        self.newest_run_dict = new_run_dict
-                    success = True
-                except:
-                    self.logger.error(sys.exc_info()[1])
-
-    def move_images(self, safety_check_passed):
+            try:
+                if not self.recent_runs.add(new_run_dict):
+                    continue
+                new_id = new_run_dict['run_id']
+                if self.newest_run_dict['run_id'] < new_id:
+                    print('new id: {id}'.format(id=str(new_id)))
+                    print('list bound variables: {run_dict}'.format(run_dict={key: new_run_dict[key]
+                                                                              for key in new_run_dict['ListBoundVariables']}))
+                    self.logger.debug(
+                        'new run_id: ' + str(new_run_dict['run_id']) + '. runtime: ' + str(new_run_dict['runtime']))
+                    self.newest_run_dict = new_run_dict
+            except:
+                self.logger.error(sys.exc_info()[1])
+
+    def move_images(self, safety_check_passed, run_id=None):
         """Renames images according to run_id or timestamp (if safety_check passes or fails) and moves
         them to the appropriate folder. Returns a list of the renamed image filenames."""
 
@@ -158,19 +316,18 @@ class ImageWatchdog():
 
         output_filenames = []
         image_idx = 0
-        run_id = self.newest_run_dict['run_id']
+        # prevent python from corrupting files, wait for writing to disk to finish
+        settle_times = self.write_completion.wait([os.path.join(self.watchfolder, filename)
+                                                   for filename in self.new_imagenames])
+        self.logger.debug('write completion times in seconds: {times}'.format(
+            times=str({os.path.basename(path): round(settle_time, 3) for path, settle_time in settle_times.items()})))
         for filename in self.new_imagenames:
-            # prevent python from corrupting file, wait for writing to disk to finish
             filepath = os.path.join(self.watchfolder, filename)
-            old_filesize = 0
-            while os.path.getsize(filepath) != old_filesize:
-                old_filesize = os.path.getsize(filepath)
-                time.sleep(0.2)
             # rename images according to their associated run_id
             old_filename = filename
             if safety_check_passed:
                 new_filename = str(run_id) + '_' + \
-                    str(image_idx) + '.spe'
+                    str(image_idx) + IMAGE_EXTENSION
                 destination = self.runfolder
             else:
                 new_filename = old_filename
@@ -181,49 +338,68 @@ class ImageWatchdog():
                 new_filename = rename_file(new_filename)
                 new_filepath = os.path.join(
                     destination, new_filename)
-            if safety_check_passed and self.backup_to_bec1server:
-                becserver_filepath = os.path.join(
-                    self.bec1serverpath, new_filepath)
-                shutil.copyfile(filepath, becserver_filepath)
-                print('copying file to ' + becserver_filepath)
             if not os.path.exists(os.path.dirname(new_filepath)):
                 os.mkdir(os.path.dirname(new_filepath))
+            if safety_check_passed:
+                self.move_journal.record(
+                    [filename], 'matched', run_id=run_id, destination=new_filepath)
             shutil.move(filepath, os.path.abspath(new_filepath))
+            self.move_journal.record([filename], 'moved' if safety_check_passed else 'misplaced',
+                                     run_id=run_id, destination=new_filepath)
             self.logger.debug('moving {old_name} to {destination}'.format(old_name=old_filename,
                                                                           destination=new_filepath))
+            if safety_check_passed and self.backup_to_bec1server:
+                # copied in the background from the local file, only the local move blocks here
+                becserver_filepath = os.path.join(
+                    self.bec1serverpath, new_filepath)
+                self.backup_queue.enqueue(
+                    os.path.abspath(new_filepath), becserver_filepath)
             image_idx += 1
             output_filenames.append(new_filename)
+        if self.file_events is not None:
+            self.file_events.discard(self.new_imagenames)
+        if safety_check_passed:
+            SHOTS_MATCHED.inc(**self.metric_labels)
+            MATCH_LATENCY.observe((datetime.datetime.today() - self.incomingfile_time).total_seconds(),
+                                  **self.metric_labels)
+        else:
+            SHOTS_MISPLACED.inc(**self.metric_labels)
         return output_filenames
 
-    def match_images_to_run_id(self, MAX_RETRIES=5):
-        print('here')
+    def match_images_to_run_id(self):
+        self.move_journal.record(self.new_imagenames, 'pending',
+                                 arrival_time=self.incomingfile_time.strftime('%Y-%m-%dT%H:%M:%S.%f'))
 
-        def check_run_image_concurrent(self):
-            max_time_diff_in_sec = self.max_time_diff_in_sec
-            min_time_diff_in_sec = self.min_time_diff_in_sec
-            runtime_str = self.newest_run_dict['runtime']
-            incomingfile_time = self.incomingfile_time
+        def find_run():
+            # oldest unmatched run started min_time_diff_in_sec to max_time_diff_in_sec before the images arrived
+            self.update_run_dict()
+            return self.recent_runs.match(self.incomingfile_time,
+                                          min_time_diff_in_sec=self.min_time_diff_in_sec,
+                                          max_time_diff_in_sec=self.max_time_diff_in_sec)
+
+        matched_run_dict = find_run()
+        # the images' run might not be on breadboard yet, wait for new runs instead of sleeping
+        deadline = self.incomingfile_time + \
+            datetime.timedelta(seconds=self.max_time_diff_in_sec)
+        while matched_run_dict is None:
+            remaining_time = (
+                deadline - datetime.datetime.today()).total_seconds()
+            if remaining_time <= 0:
+                break
+            self.run_feed.wait_for_new_run(
+                self.newest_run_dict['run_id'], timeout=remaining_time)
+            matched_run_dict = find_run()
+        safety_check_passed = matched_run_dict is not None
+        if safety_check_passed:
+            run_id = matched_run_dict['run_id']
+            self.recent_runs.mark_matched(run_id)
             runtime = datetime.datetime.strptime(
-                runtime_str, "%Y-%m-%dT%H:%M:%SZ")
-            time_diff = (incomingfile_time - runtime)
+                matched_run_dict['runtime'], "%Y-%m-%dT%H:%M:%SZ")
             self.logger.debug("time diff in seconds: {time_diff}".format(
-                time_diff=str(time_diff.total_seconds())))
-            if min_time_diff_in_sec < time_diff.total_seconds() < max_time_diff_in_sec:
-                return True
-            else:
-                self.update_run_dict()
-                return False
-
-        try_counter = 0
-        safety_check_passed = False
-        while try_counter < MAX_RETRIES and (not safety_check_passed):
-            try:
-                safety_check_passed = check_run_image_concurrent(self)
-                try_counter += 1
-                time.sleep(1)
-            except:
-                pass
-        output_filenames = self.move_images(safety_check_passed)
+                time_diff=str((self.incomingfile_time - runtime).total_seconds())))
+        else:
+            run_id = None
+        output_filenames = self.move_images(safety_check_passed, run_id)
         if not safety_check_passed:
             warning_message = 'Incoming image time and latest Breadboard runtime differ by too much. Check run_id {id} manually later.'.format(
                 id=str(self.newest_run_dict['run_id']))
@@ -231,24 +407,75 @@ class ImageWatchdog():
             self.logger.warning(warning_message)
             matched_to_run_id = False
         else:
-            # write to breadboard
-            run_id = self.newest_run_dict['run_id']
-            try:
-                resp = bc.append_images_to_run(run_id, output_filenames)
-                bc.add_measurement_name_to_run(run_id, self.runfolder)
-                if resp.status_code != 200:
-                    self.logger.warning('Upload error: ' + resp.text)
-                else:
-                    self.logger.debug('Uploaded filenames {files} to breadboard run_id {id}.'.format(
-                        files=str(output_filenames), id=str(run_id)))
-            except:
-                warning = 'Failed to write {files} to breadboard run_id {id}.'.format(
-                    files=str(output_filenames), id=str(run_id))
-                warnings.warn(warning)
-                logger.warning(warning)
+            self.write_images_to_breadboard(run_id, output_filenames)
             matched_to_run_id = True
         return matched_to_run_id
 
+    def write_images_to_breadboard(self, run_id, output_filenames):
+        """Queues the image names and measurement name for run_id, they are written by self.breadboard_writes."""
+        self.breadboard_writes.update_run(run_id, imagenames=output_filenames,
+                                          measurement_name=self.runfolder)
+        self.logger.debug('Queued filenames {files} for breadboard run_id {id}.'.format(
+            files=str(output_filenames), id=str(run_id)))
+        if self.backup_to_bec1server:
+            self.logger.debug(self.backup_stats_message())
+
+    def catch_up(self, filenames, arrival_times=None):
+        """Matches a backlog of images, e.g. after a stall, in one pass. The images are grouped into shots by modification time,
+        all runs in the backlog's time range are fetched from breadboard with one paginated query, and each shot is matched
+        to its run using the image modification time as arrival time. Image names are flushed to breadboard in one batch after
+        all shots have been moved. Incomplete shots are left for the regular loop. Returns the number of matched shots.
+        arrival_times can override the modification time of some files, e.g. from the move journal."""
+        filepaths = [os.path.join(self.watchfolder, filename)
+                     for filename in filenames]
+        self.write_completion.wait(filepaths)
+        mtimes = {filename: datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
+                  for filename, filepath in zip(filenames, filepaths)}
+        arrival_times = dict(mtimes, **(arrival_times or {}))
+        ordered_filenames = sorted(filenames, key=arrival_times.get)
+        n = self.num_images_per_shot
+        shots = [ordered_filenames[idx:idx + n]
+                 for idx in range(0, len(ordered_filenames) - n + 1, n)]
+        print('catching up on {n} shots in the watchfolder.'.format(
+            n=str(len(shots))))
+        start_time = arrival_times[shots[0][-1]] - \
+            datetime.timedelta(seconds=self.max_time_diff_in_sec)
+        end_time = arrival_times[shots[-1][-1]]
+        run_dicts = utility_functions.get_runs_in_time_range(
+            bc, start_time, end_time)
+        catch_up_runs = RecentRunsIndex(max_runs=max(len(run_dicts), 1))
+        for run_dict in run_dicts:
+            catch_up_runs.add(run_dict)
+        self.update_run_dict()
+        for run_id in self.recent_runs.matched_run_ids:
+            catch_up_runs.mark_matched(run_id)
+
+        matched_images = []
+        for shot in shots:
+            # same image order as in the regular loop, see getFileList
+            self.new_imagenames = sorted(shot, reverse=True)
+            self.incomingfile_time = arrival_times[shot[-1]]
+            run_dict = catch_up_runs.match(self.incomingfile_time,
+                                           min_time_diff_in_sec=self.min_time_diff_in_sec,
+                                           max_time_diff_in_sec=self.max_time_diff_in_sec)
+            if run_dict is None:
+                self.logger.warning('No run found for images {files} from the backlog.'.format(
+                    files=str(self.new_imagenames)))
+                self.move_images(False)
+                continue
+            run_id = run_dict['run_id']
+            catch_up_runs.mark_matched(run_id)
+            self.recent_runs.mark_matched(run_id)
+            matched_images.append((run_id, self.move_images(True, run_id)))
+        self.incomingfile_time = datetime.datetime.today()
+        for run_id, output_filenames in matched_images:
+            self.write_images_to_breadboard(run_id, output_filenames)
+        self.breadboard_writes.flush()
+        print('caught up: {matched} shots matched, {misplaced} moved to {folder}.'.format(
+            matched=str(len(matched_images)), misplaced=str(len(shots) - len(matched_images)),
+            folder=self.misplaced_folder))
+        return len(matched_images)
+
     def check_idle_time(self):
         idle_time = (datetime.datetime.now() -
                      self.incomingfile_time).total_seconds()
@@ -261,21 +488,46 @@ class ImageWatchdog():
         elif idle_time < self.max_idle_time and self.idle_message_sent:
             self.idle_message_sent = False  # reset message status if image taking is resumed
 
+    def step(self):
+        """One iteration of the main loop."""
+        self.update_run_dict()  # fetch newest run info from breadboard
+        self.check_idle_time()  # fire Slack message if experiment is idling
+        new_images_bool = self.monitor_watchfolder()
+        if len(self.pending_filenames) >= self.catch_up_min_shots * self.num_images_per_shot:
+            self.catch_up(self.pending_filenames)
+        elif new_images_bool:
+            self.match_images_to_run_id()  # this method contains all the safety checks and logic
+            # for matching run_id to images and writing image and run names to breadboard.
+        if self.file_events is None:
+            time.sleep(self.refresh_time)
+
+    def log_error(self):
+        self.logger.error('Error: {}. {}, line: {}'.format(
+            sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2].tb_lineno))
+
+    def shutdown(self):
+        """Stops background threads after flushing pending breadboard writes, backups and journal records.
+        A shared breadboard_writes or backup_queue passed to __init__ is only flushed, and left running for its owner."""
+        if self.file_events is not None:
+            self.file_events.stop()
+        if self.backup_to_bec1server and self.owns_backup_queue:
+            print(self.backup_stats_message())
+            self.backup_queue.stop(timeout=5)
+        if self.owns_breadboard_writes:
+            self.breadboard_writes.stop()
+        else:
+            self.breadboard_writes.flush()
+        self.move_journal.stop()
+
     def main(self):
         while True:
             try:
-                self.update_run_dict()  # fetch newest run info from breadboard
-                self.check_idle_time()  # fire Slack message if experiment is idling
-                new_images_bool = self.monitor_watchfolder()
-                if new_images_bool:
-                    self.match_images_to_run_id()  # this method contains all the safety checks and logic
-                    # for matching run_id to images and writing image and run names to breadboard.
-                time.sleep(self.refresh_time)
+                self.step()
             except KeyboardInterrupt:
+                self.shutdown()
                 break
             except:
-                self.logger.error('Error: {}. {}, line: {}'.format(
-                    sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2].tb_lineno))
+                self.log_error()
 
 
 if __name__ == "__main__":
@@ -4,7 +4,8 @@ import os
 import sys
 main_path = os.path.abspath(os.path.join(__file__, '../..'))
 sys.path.insert(0, main_path)
-from utility_functions import load_breadboard_client, get_newest_run_dict, time_diff_in_sec
+from utility_functions import load_breadboard_client, time_diff_in_sec
+from run_feed import get_run_feed
 import enrico_bot
 import numpy as np
 # TODO: logging errors
@@ -13,6 +14,7 @@ import numpy as np
 class StatusMonitor:
     def __init__(self, backlog_max=30, warning_interval_in_min=10, read_run_time_offset=3, max_time_diff_tolerance=15):
         self.bc = load_breadboard_client()
+        self.run_feed = get_run_feed(self.bc)
         self.backlog_max = backlog_max
         self.backlog = OrderedDict()
         self.last_warning = None
@@ -49,7 +51,7 @@ class StatusMonitor:
     def upload_to_breadboard(self):
         # matches backlog times to run_id times and writes (but not overwrites) closest log entry to breadboard
         try:
-            run_dict = get_newest_run_dict(self.bc)
+            run_dict = self.run_feed.newest_run_dict()
         except:
             pass
         new_run_id = run_dict['run_id']
@@ -4,7 +4,8 @@ import sys
 main_path = os.path.abspath(os.path.join(__file__, '../..'))
 sys.path.insert(0, main_path)
 
-from utility_functions import load_breadboard_client, get_newest_run_dict, time_diff_in_sec
+from utility_functions import load_breadboard_client, time_diff_in_sec
+from run_feed import get_run_feed
 from wlm import WavelengthMeter
 import datetime
 import time
@@ -39,7 +40,8 @@ def main():
     refresh_time = 1  # seconds
     print("Did you remember to sync the os clock to a web server?")
     print('Reading wavemeter, readings will output below ... \n')
-    old_run_dict = get_newest_run_dict(bc)
+    run_feed = get_run_feed(bc)
+    old_run_dict = run_feed.newest_run_dict()
     old_run_id = old_run_dict['run_id']
     print("Initial run ID: " + str(old_run_id))
     time_warned = False
@@ -83,7 +85,7 @@ def main():
 
         # listen to breadboard server for new run_id
         try:
-            new_run_dict = get_newest_run_dict(bc)
+            new_run_dict = run_feed.newest_run_dict()
             new_run_id = new_run_dict['run_id']
         except:
             logger.error(sys.exc_info()[1])
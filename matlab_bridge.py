@@ -0,0 +1,86 @@
+"""Converts the structs returned by MATLAB analysis functions to Python without copying array data.
+
+MATLAB arrays (matlab.double, matlab.uint16, ...) are wrapped as NumPy arrays through the buffer protocol, so an
+image-sized field costs no more than a scalar. flatten_struct turns a (nested) struct into a flat dictionary of Python
+scalars, NumPy arrays and strings, with arrays larger than lazy_threshold elements left as LazyArrays that are only
+wrapped when used, e.g. ODimage for a preview.
+"""
+
+import numpy as np
+
+
+def is_matlab_array(value):
+    return type(value).__module__.startswith('matlab') and hasattr(value, 'size')
+
+
+def to_numpy(matlab_array):
+    """Returns a NumPy view of matlab_array with its MATLAB shape, sharing its memory. Engines before MATLAB R2022a don't
+    expose the buffer protocol on arrays, the view is then of their flat column-major storage."""
+    shape = tuple(matlab_array.size)
+    try:
+        view = memoryview(matlab_array)
+    except TypeError:
+        view = memoryview(matlab_array._data)  # array.array in older engines
+    array = np.asarray(view)
+    if array.shape == shape:
+        return array
+    if array.ndim == 1:
+        return array.reshape(shape, order='F')
+    return array.T  # column-major data exposed with reversed dimensions
+
+
+class LazyArray():
+    """A MATLAB array which is wrapped as a NumPy array on first use, see array. Works with np.asarray."""
+
+    def __init__(self, matlab_array):
+        self.matlab_array = matlab_array
+        self.shape = tuple(matlab_array.size)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = to_numpy(self.matlab_array)
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def __repr__(self):
+        return 'LazyArray(shape={shape})'.format(shape=str(self.shape))
+
+
+def convert(value, lazy_threshold=64):
+    """Converts one MATLAB value: 1x1 arrays to Python scalars, small arrays to NumPy arrays, large arrays to LazyArrays,
+    structs to dictionaries and cell arrays to lists."""
+    if is_matlab_array(value):
+        numel = int(np.prod(value.size))
+        if numel == 1:
+            return to_numpy(value).item()
+        if numel > lazy_threshold:
+            return LazyArray(value)
+        return to_numpy(value)
+    if isinstance(value, dict):
+        return {key: convert(item, lazy_threshold) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [convert(item, lazy_threshold) for item in value]
+    return value
+
+
+def flatten_struct(matlab_struct, prefix='', separator='_', lazy_threshold=64):
+    """
+    Returns a flat dictionary of the fields of matlab_struct, converted by convert. Nested structs are flattened with
+    their field names joined by separator, e.g. {'K_analysis': {'Ncnt': 1}} to {'K_analysis_Ncnt': 1}.
+
+    Args:
+        - prefix: prepended to every key, e.g. 'K_' to flatten the K_analysis struct as K_Ncnt, ...
+        - lazy_threshold: arrays with more elements are returned as LazyArrays.
+    """
+    flat_dict = {}
+    for key, value in matlab_struct.items():
+        if isinstance(value, dict):
+            flat_dict.update(flatten_struct(value, prefix + key + separator, separator,
+                                            lazy_threshold))
+        else:
+            flat_dict[prefix + key] = convert(value, lazy_threshold)
+    return flat_dict
@@ -0,0 +1,241 @@
+"""Keeps MATLAB engines running across restarts of the analysis scripts.
+
+Starting MATLAB takes about a minute. Run this server once per analysis computer:
+
+    python matlab_engine_server.py [analysis_mode] [num_engines] [settings]
+
+It launches num_engines MATLAB sessions as separate processes, shares them as enrico_matlab_0, enrico_matlab_1, ... (plus
+enrico_matlab_settings for AnalysisSettingsUpdater if 'settings' is given) and warms them up with a cd to the analysis
+library folder of analysis_mode. analysis_loggerOOP.py, analysis_logger.py and AnalysisSettingsUpdater then connect to a
+shared session in seconds through matlab_wrapper.load_matlab_engine (see connect_engine), and start their own engine as
+before if no session is shared. The sessions outlive the server, so restarting it reconnects to them;
+'python matlab_engine_server.py quit' closes them.
+
+Every health_interval sec the server checks that each analysis session answers, and relaunches sessions which died or
+hung. The settings session only has to be alive, as it blocks while AnalysisSettingsUpdater waits on the user.
+
+MATLAB is reached through an engine backend, MatlabEngineBackend, so that a stub backend can stand in for it in tests
+(see tests/matlab_stubs.py).
+"""
+
+import os
+import sys
+import time
+import signal
+import subprocess
+
+ENGINE_NAME_PREFIX = 'enrico_matlab_'
+SETTINGS_ENGINE_INDEX = 'settings'
+
+_private_engines = []  # engines started by connect_engine because no shared session was available
+
+
+def engine_name(engine_index):
+    return ENGINE_NAME_PREFIX + str(engine_index)
+
+
+def default_analysis_library_path(analysis_mode):
+    import matlab_wrapper
+    return {'y': matlab_wrapper.ycam_path,
+            'zd': matlab_wrapper.dualimaging_path,
+            'zt': matlab_wrapper.tripleimaging_path}[analysis_mode]
+
+
+def ping(eng):
+    """Starts a trivial MATLAB call on eng in the background. Returns its future, or None if eng is gone."""
+    try:
+        return eng.plus(1, 1, background=True)
+    except Exception:
+        return None
+
+
+def answered(future, timeout):
+    """Returns True if the future of ping resolves to the right answer within timeout sec."""
+    try:
+        return future is not None and future.result(timeout=max(timeout, 0)) == 2
+    except Exception:
+        return False
+
+
+class MatlabEngineBackend():
+    """The matlab.engine API, plus launching MATLAB processes which share their engine."""
+
+    def __init__(self, matlab_executable='matlab'):
+        self.matlab_executable = matlab_executable
+
+    def find(self):
+        """Returns the names of the shared MATLAB sessions on this computer."""
+        import matlab.engine
+        return list(matlab.engine.find_matlab())
+
+    def connect(self, name):
+        import matlab.engine
+        return matlab.engine.connect_matlab(name)
+
+    def start(self):
+        import matlab.engine
+        return matlab.engine.start_matlab()
+
+    def launch(self, name):
+        """Starts MATLAB in a new process which shares its engine as name, and returns without waiting for it. The
+        session shows up in find() once MATLAB has started."""
+        command = "matlab.engine.shareEngine('{name}')".format(name=name)
+        return subprocess.Popen([self.matlab_executable, '-nosplash', '-nodesktop', '-r', command])
+
+    def kill(self, pid):
+        try:
+            os.kill(int(pid), signal.SIGTERM)
+        except OSError:
+            pass  # already gone
+
+
+def connect_engine(engine_index=0, backend=None, start_if_missing=True):
+    """
+    Returns a MATLAB engine connected to the shared session engine_index of MatlabEngineServer, or, if that session is
+    not running and start_if_missing, a newly started engine private to this process. Pass engines to release_engine
+    when done, which only quits private engines.
+    """
+    backend = backend or MatlabEngineBackend()
+    name = engine_name(engine_index)
+    try:
+        if name in backend.find():
+            eng = backend.connect(name)
+            print('connected to shared MATLAB session ' + name)
+            return eng
+    except Exception as e:
+        print('could not connect to shared MATLAB session {name}: {error}'.format(
+            name=name, error=str(e)))
+    if not start_if_missing:
+        raise RuntimeError('No shared MATLAB session named ' + name)
+    print('no shared MATLAB session {name}, starting a new engine. Run matlab_engine_server.py to keep engines '
+          'running between restarts.'.format(name=name))
+    eng = backend.start()
+    _private_engines.append(eng)
+    return eng
+
+
+def release_engine(eng):
+    """Quits eng if this process started it, leaves shared sessions running."""
+    for idx, private_eng in enumerate(_private_engines):
+        if private_eng is eng:
+            del _private_engines[idx]
+            eng.quit()
+            return
+
+
+class MatlabEngineServer():
+    """MatlabEngineServer launches, warms up and health checks the shared MATLAB sessions, see the module docstring."""
+
+    def __init__(self, analysis_mode='y', num_engines=1, settings_engine=False, backend=None,
+                 analysis_library_path=None, health_interval=30, ping_timeout=300, startup_timeout=300):
+        """
+        Args:
+            - analysis_mode: 'y', 'zd' or 'zt', selects the analysis library folder the sessions cd to.
+            - num_engines: number of sessions for analysis workers, e.g. num_workers of AnalysisLogger.
+            - settings_engine: if True, also runs a session for AnalysisSettingsUpdater, which waits on user input and
+              would otherwise block analysis.
+            - analysis_library_path: folder of the .m files, overrides analysis_mode.
+            - ping_timeout: sec a session may take to answer a health check. Calls are queued behind a running analysis,
+              so this should be longer than the slowest analysis.
+            - startup_timeout: sec after which a launched session that never showed up is launched again.
+        """
+        self.names = [engine_name(idx) for idx in range(num_engines)]
+        if settings_engine:
+            self.names.append(engine_name(SETTINGS_ENGINE_INDEX))
+        self.backend = backend or MatlabEngineBackend()
+        self.analysis_library_path = analysis_library_path or default_analysis_library_path(
+            analysis_mode)
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self.startup_timeout = startup_timeout
+        self.engines = {}  # name: connected engine
+        self.pids = {}  # name: MATLAB process id
+        self.launch_times = {}  # name: time.monotonic() of launch, for sessions not connected yet
+
+    def ensure_engines(self):
+        """Connects to and warms up shared sessions which came up, and launches the missing ones."""
+        shared = set(self.backend.find())
+        for name in self.names:
+            if name in self.engines:
+                continue
+            if name in shared:
+                try:
+                    eng = self.backend.connect(name)
+                    self.warm_up(eng)
+                except Exception as e:
+                    print('could not connect to {name}: {error}'.format(
+                        name=name, error=str(e)))
+                    continue
+                self.engines[name] = eng
+                self.pids[name] = eng.feature('getpid')
+                self.launch_times.pop(name, None)
+                print('{name} ready.'.format(name=name))
+            elif time.monotonic() - self.launch_times.get(name, -float('inf')) > self.startup_timeout:
+                print('launching MATLAB session {name}...'.format(name=name))
+                self.backend.launch(name)
+                self.launch_times[name] = time.monotonic()
+
+    def warm_up(self, eng):
+        eng.eval(r'cd ' + self.analysis_library_path, nargout=0)
+
+    def check_health(self):
+        """Drops sessions which don't answer a health check, killing hung MATLAB processes, so that ensure_engines
+        relaunches them. All sessions are pinged at once, so one busy session doesn't hold up the checks of the others.
+        The settings session is only checked to be alive, since it blocks on user input and calibrations."""
+        settings_name = engine_name(SETTINGS_ENGINE_INDEX)
+        shared = set(self.backend.find())
+        pings = {name: ping(eng) for name, eng in self.engines.items() if name != settings_name}
+        deadline = time.monotonic() + self.ping_timeout
+        for name in list(self.engines):
+            if name == settings_name:
+                if name in shared:
+                    continue
+                print('{name} has closed, relaunching it.'.format(name=name))
+            elif answered(pings[name], deadline - time.monotonic()):
+                continue
+            else:
+                print('{name} is not responding, relaunching it.'.format(name=name))
+            del self.engines[name]
+            pid = self.pids.pop(name, None)
+            if pid is not None:
+                self.backend.kill(pid)
+
+    def missing_engines(self):
+        return [name for name in self.names if name not in self.engines]
+
+    def serve_forever(self):
+        print('keeping {names} running in {path}'.format(names=str(self.names),
+                                                         path=self.analysis_library_path))
+        while True:
+            self.ensure_engines()
+            self.check_health()
+            # poll faster while sessions are starting up
+            time.sleep(min(self.health_interval, 5)
+                       if self.missing_engines() else self.health_interval)
+
+    def quit_engines(self):
+        """Closes all shared enrico MATLAB sessions, including ones launched by an earlier server."""
+        for name in self.backend.find():
+            if not name.startswith(ENGINE_NAME_PREFIX):
+                continue
+            try:
+                self.backend.connect(name).eval('exit', nargout=0)
+            except Exception:
+                pass  # the connection drops as MATLAB exits
+            print('closed ' + name)
+        self.engines = {}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'quit':
+        MatlabEngineServer(analysis_library_path='.').quit_engines()
+        sys.exit()
+    analysis_mode = sys.argv[1] if len(sys.argv) > 1 else 'y'
+    num_engines = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    settings_engine = len(sys.argv) > 3 and sys.argv[3] == 'settings'
+    server = MatlabEngineServer(analysis_mode=analysis_mode, num_engines=num_engines,
+                                settings_engine=settings_engine)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('server stopped, the MATLAB sessions keep running. Run "python matlab_engine_server.py quit" to close them.')
@@ -1,7 +1,9 @@
 # currently used on ycam
 
-from PIL import Image
+import time
 import numpy as np
+from matlab_bridge import to_numpy, flatten_struct, LazyArray
+from preview_renderer import load_preview_pool
 
 try:
     from utility_functions import load_analysis_path
@@ -15,18 +17,33 @@ except FileNotFoundError:  # stopgap until all computers which do analysis have
     tripleimaging_path = r'C:\Users\Fermi1\Documents\GitHub\Fermi1_MatlabImageAnalysis'
 
 
-def load_matlab_engine():
+def load_matlab_engine(engine_index=0, shared=True):
+    """
+    Returns a MATLAB engine. If shared, connects to the session engine_index kept running by matlab_engine_server.py,
+    which takes seconds instead of a minute, and starts a new engine only if the server doesn't run that session.
+    """
     print('loading matlab engine...')
-    import matlab.engine
-    eng = matlab.engine.start_matlab()
+    if shared:
+        from matlab_engine_server import connect_engine
+        eng = connect_engine(engine_index)
+    else:
+        import matlab.engine
+        eng = matlab.engine.start_matlab()
     print('matlab engine loaded')
     return eng
 
 
 def numpyfy_MATLABarray(matlab_array):
-    return np.array(matlab_array._data).reshape(matlab_array.size, order='F')
+    return to_numpy(matlab_array)  # a view, see matlab_bridge.py
+
+
+def lazy_images(matlab_dict):
+    """ODimage of matlab_dict as a LazyArray, wrapped as a NumPy array only if used."""
+    return {key: LazyArray(matlab_dict[key]) for key in ['ODimage'] if key in matlab_dict}
 
 # getAnalysisModeAnalysis takes (matlab_engine, filepath, **kwargs) and returns a dictionary translated from a MATLAB analysis struct.
+# The analysis structs are flattened by matlab_bridge.flatten_struct, keeping array fields, and settings are returned as
+# MATLAB values, to be passed back to the next call.
 # analysismode_analyzed_var_names is manually defined to include scalar values from the analysis dictionary. These are most easily written to breadboard.
 
 
@@ -49,13 +66,13 @@ def getYcamAnalysis(eng, filepath,
             matlab_dict = eng.getYcamAnalysis(
                 filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
-        if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
+        images = lazy_images(matlab_dict)
+        if save_jpg_preview and 'ODimage' in images:
+            # rendered in the background, see preview_renderer.py
+            load_preview_pool().submit(images['ODimage'], filepath)
 
-        return matlab_dict
+        return {'analysis': flatten_struct(matlab_dict['analysis']), 'settings': matlab_dict['settings'],
+                **images}
     except:
         print('matlab wrapper error')
 
@@ -75,19 +92,15 @@ def getDualImagingAnalysis(eng, filepath,
         # else:
         #     matlab_dict = eng.getMeasNaAnalysis(filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
-        if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
-
-        flatten_dict = {'analysis': {}, 'settings': {}}
-        for key in matlab_dict['K_analysis']:
-            flatten_dict['analysis']['K_' +
-                                     key] = matlab_dict['K_analysis'][key]
-        for key in matlab_dict['Na_analysis']:
-            flatten_dict['analysis']['Na_' +
-                                     key] = matlab_dict['Na_analysis'][key]
+        images = lazy_images(matlab_dict)
+        if save_jpg_preview and 'ODimage' in images:
+            # rendered in the background, see preview_renderer.py
+            load_preview_pool().submit(images['ODimage'], filepath)
+
+        flatten_dict = {'analysis': {}, 'settings': {}, **images}
+        for species in ['K', 'Na']:
+            flatten_dict['analysis'].update(flatten_struct(
+                matlab_dict[species + '_analysis'], prefix=species + '_'))
         # matlab struct object is passed to python as a dictionary, to be parsed in analysis_logger.py
         return flatten_dict
     except:
@@ -115,22 +128,15 @@ def getTripleImagingAnalysis(eng, filepaths,
         # else:
         #     matlab_dict = eng.getMeasNaAnalysis(filepath, 'marqueeBox', marqueeBox, 'normBox', normBox)
 
-        if save_jpg_preview and 'ODimage' in matlab_dict:
-            np_im = numpyfy_MATLABarray(matlab_dict['ODimage'])
-            im = Image.fromarray(np_im)
-            save_filepath = filepath.replace('.spe', '.jpeg')
-            im.save(save_filepath)
-
-        flatten_dict = {'analysis': {}, 'settings': {}}
-        for key in matlab_dict['K1_analysis']:
-            flatten_dict['analysis']['K1_' +
-                                     key] = matlab_dict['K1_analysis'][key]
-        for key in matlab_dict['K2_analysis']:
-            flatten_dict['analysis']['K2_' +
-                                     key] = matlab_dict['K2_analysis'][key]
-        for key in matlab_dict['Na_analysis']:
-            flatten_dict['analysis']['Na_' +
-                                     key] = matlab_dict['Na_analysis'][key]
+        images = lazy_images(matlab_dict)
+        if save_jpg_preview and 'ODimage' in images:
+            # rendered in the background, see preview_renderer.py
+            load_preview_pool().submit(images['ODimage'], filepaths)
+
+        flatten_dict = {'analysis': {}, 'settings': {}, **images}
+        for species in ['K1', 'K2', 'Na']:
+            flatten_dict['analysis'].update(flatten_struct(
+                matlab_dict[species + '_analysis'], prefix=species + '_'))
         # matlab struct object is passed to python as a dictionary, to be parsed in analysis_logger.py
         return flatten_dict
     except:
@@ -153,7 +159,9 @@ class AnalysisSettingsUpdater:
         """
         self.matlab_func = wrapped_matlab_func
         self.images_per_shot = images_per_shot
-        self.eng = load_matlab_engine()
+        # a session of its own if matlab_engine_server.py runs one, as calibrating waits on the user
+        from matlab_engine_server import SETTINGS_ENGINE_INDEX
+        self.eng = load_matlab_engine(engine_index=SETTINGS_ENGINE_INDEX)
 
     def update(self):
         """
@@ -203,6 +211,14 @@ def update_triple_imaging_settings(eng, filepaths, analysis_library_path=triplei
         filepaths[0], filepaths[1], filepaths[2])  # TODO
 
 
+# analysis_mode: (name of the analysis function of this module and of numpy_analysis.py, name of its analyzed var names)
+analysis_modes = {'y': ('getYcamAnalysis', 'ycam_analyzed_var_names'),
+                  'zd': ('getDualImagingAnalysis', 'dual_imaging_analyzed_var_names'),
+                  'zt': ('getTripleImagingAnalysis', 'triple_imaging_analyzed_var_names')}
+images_per_shot = {'y': 1, 'zd': 1, 'zt': 3, 'testing': 1}
+# analysis modes whose MATLAB function analyzes with the marqueeBox and normBox passed in, the zd and zt ones ignore them
+box_settings_modes = ['y']
+
 ##################################################################################################################################
 
 
@@ -0,0 +1,212 @@
+"""A lightweight in-process metrics registry, exported over a local HTTP endpoint in the Prometheus text format.
+
+    from metrics import REGISTRY, start_metrics_server
+    shots_matched = REGISTRY.counter('enrico_shots_matched_total', 'Shots matched to a breadboard run.')
+    shots_matched.inc(camera='zcam')
+    start_metrics_server(9110)  # then browse or scrape http://localhost:9110/metrics
+"""
+
+import sys
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{key}="{value}"'.format(key=key, value=value.replace('"', '\\"'))
+                          for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter():
+    """A value that only goes up, e.g. the number of shots matched."""
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. a queue depth. Instead of being set, a gauge can also read its value from a
+    function every time the metrics are exported."""
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        with self.lock:
+            self.functions[_label_key(labels)] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, key, function()))
+            except:
+                pass  # a broken callback shouldn't take down the endpoint
+        return samples
+
+
+class Histogram():
+    """Counts observations, e.g. latencies in sec, in cumulative buckets."""
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.values = {}  # label key: [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            counts = self.values.setdefault(
+                key, [0] * len(self.buckets) + [0, 0])
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key +
+                                    (('le', _format_value(bound)),), cumulative))
+                samples.append((self.name + '_bucket', key +
+                                (('le', '+Inf'),), counts[-1]))
+                samples.append((self.name + '_sum', key, counts[-2]))
+                samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+class MetricsRegistry():
+    """Holds metrics by name. Asking for an existing name returns the existing metric, so modules can declare the
+    metrics they use without coordinating."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, metric_class, name, help_text, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, help_text, **kwargs)
+            metric = self.metrics[name]
+        if not isinstance(metric, metric_class):
+            raise ValueError('{name} is already registered as a {type}'.format(
+                name=name, type=metric.metric_type))
+        return metric
+
+    def counter(self, name, help_text):
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def exposition(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append('# HELP {name} {help_text}'.format(
+                name=metric.name, help_text=metric.help_text))
+            lines.append('# TYPE {name} {type}'.format(
+                name=metric.name, type=metric.metric_type))
+            for sample_name, label_key, value in metric.samples():
+                lines.append('{name}{labels} {value}'.format(name=sample_name,
+                                                             labels=_format_labels(label_key), value=_format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# breadboard metrics shared by every module which talks to breadboard, labelled by request
+BREADBOARD_REQUEST_SECONDS = REGISTRY.histogram('enrico_breadboard_request_seconds',
+                                                'Duration of breadboard round-trips, by request.')
+BREADBOARD_RETRIES = REGISTRY.counter('enrico_breadboard_retries_total',
+                                      'Breadboard requests retried after an error, by request.')
+
+
+def start_metrics_server(port, registry=REGISTRY, address='localhost'):
+    """Serves registry.exposition() at http://address:port/metrics from a daemon thread. Returns the server, or None
+    (with a printed warning) if the port is taken, e.g. by another daemon on the same computer."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ['/', '/metrics']:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer((address, port), Handler)
+    except OSError:
+        print('metrics port {port} unavailable, metrics not exported: {error}'.format(
+            port=str(port), error=str(sys.exc_info()[1])))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('serving metrics on http://{address}:{port}/metrics'.format(
+        address=address, port=str(server.server_address[1])))
+    return server
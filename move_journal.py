@@ -0,0 +1,81 @@
+import os
+import json
+import threading
+
+FINAL_STATES = ['moved', 'misplaced']
+
+
+class MoveJournal():
+    """MoveJournal is an append-only log of the state of each image ImageWatchdog handles:
+        - pending: the image was picked up for matching, arrival_time records when.
+        - matched: the image was matched to run_id and is about to be moved to destination.
+        - moved / misplaced: the image has left the watchfolder.
+    After a crash, the last record of each file left in the watchfolder tells a restarted watchdog how to finish it.
+
+    Records are flushed to the OS on every write, which survives a crash of the process. To keep per shot latency
+    negligible, fsyncs (which also survive a power failure) are batched every fsync_interval sec from a background thread."""
+
+    def __init__(self, journal_path, fsync_interval=0.5):
+        self.journal_path = journal_path
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.stopped = threading.Event()
+        self.journal_file = None
+        self.thread = None
+
+    def start(self):
+        """Compacts the journal to the records of unfinished files, opens it for appending and starts the fsync thread.
+        Returns a dictionary of filename: last record for every unfinished file."""
+        unfinished = self.read_unfinished()
+        compacted_path = self.journal_path + '.tmp'
+        with open(compacted_path, 'w') as journal:
+            for record in unfinished.values():
+                journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(compacted_path, self.journal_path)
+        self.journal_file = open(self.journal_path, 'a')
+        self.thread = threading.Thread(target=self._fsync_loop, daemon=True)
+        self.thread.start()
+        return unfinished
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sync()
+        self.journal_file.close()
+
+    def record(self, filenames, state, **fields):
+        """Appends one record per filename with the given state and any extra fields, e.g. run_id or destination."""
+        with self.lock:
+            for filename in filenames:
+                self.journal_file.write(json.dumps(
+                    dict(fields, file=filename, state=state)) + '\n')
+            self.journal_file.flush()
+            self.dirty = True
+
+    def sync(self):
+        with self.lock:
+            if self.dirty and not self.journal_file.closed:
+                os.fsync(self.journal_file.fileno())
+                self.dirty = False
+
+    def read_unfinished(self):
+        """Returns a dictionary of filename: last record, for files whose last state is not moved or misplaced."""
+        last_records = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # line cut short by a crash
+                        continue
+                    last_records[record['file']] = record
+        return {filename: record for filename, record in last_records.items()
+                if record['state'] not in FINAL_STATES}
+
+    def _fsync_loop(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
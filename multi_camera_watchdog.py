@@ -0,0 +1,104 @@
+"""Runs one ImageWatchdog per camera (e.g. ycam and zcam) in a single asyncio process. All cameras share one run feed,
+one breadboard client, one breadboard write coalescer and one bec1server backup queue, instead of each image_watchdog.py
+process polling breadboard and holding connections on its own.
+
+Cameras are listed in a .json config, by default multi_camera_config.json next to this file:
+
+    {"cameras": [{"name": "ycam", "watchfolder": "images_ycam", "num_images_per_shot": 1},
+                 {"name": "zcam", "watchfolder": "images_zcam", "num_images_per_shot": 3, "runfolder": "202010/201021/run3_zcam"}]}
+
+A camera without a runfolder asks for one at startup, like image_watchdog.py does.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import image_watchdog
+from image_watchdog import ImageWatchdog
+from breadboard_writes import BreadboardWriteCoalescer
+from backup_queue import BackupQueue
+from measurement_directory import measurement_directory
+from run_feed import get_run_feed
+from metrics import start_metrics_server
+
+
+class MultiCameraWatchdog():
+    """MultiCameraWatchdog sets up an ImageWatchdog for each camera config and runs their loops concurrently.
+    Blocking file system and breadboard calls of each loop run in asyncio's default thread pool."""
+
+    def __init__(self, camera_configs, backup_to_bec1server=True):
+        """
+        Args:
+            - camera_configs: list of dictionaries with keys name, watchfolder and num_images_per_shot, and optionally
+              runfolder plus any other ImageWatchdog keyword argument.
+        """
+        bc = image_watchdog.bc
+        # one metrics endpoint for all cameras, shots are labelled by watchfolder
+        start_metrics_server(image_watchdog.METRICS_PORT)
+        self.run_feed = get_run_feed(bc)
+        self.breadboard_writes = BreadboardWriteCoalescer(bc).start()
+        self.backup_queue = None
+        if backup_to_bec1server:
+            self.backup_queue = BackupQueue(measurement_directory(
+                measurement_name='') + 'bec1server_backup_journal.jsonl')
+            self.backup_queue.start()
+        self.watchdogs = {}
+        for camera_config in camera_configs:
+            kwargs = dict(camera_config)
+            name = kwargs.pop('name')
+            print('\nsetting up {name}'.format(name=name))
+            self.watchdogs[name] = ImageWatchdog(backup_to_bec1server=backup_to_bec1server, run_feed=self.run_feed,
+                                                 breadboard_writes=self.breadboard_writes,
+                                                 backup_queue=self.backup_queue, metrics_port=None, **kwargs)
+
+    async def watch(self, name, watchdog, min_error_delay=0.5, max_error_delay=30):
+        """Runs the loop of one camera. After an error, the next step waits min_error_delay sec, doubling with every
+        further error in a row up to max_error_delay, so that e.g. an unreachable breadboard isn't hammered."""
+        error_delay = min_error_delay
+        while True:
+            try:
+                await asyncio.to_thread(watchdog.step)
+                error_delay = min_error_delay
+            except asyncio.CancelledError:
+                raise
+            except:
+                print('{name}: error {error}, retrying in {delay:.1f} sec'.format(
+                    name=name, error=str(sys.exc_info()[1]), delay=error_delay))
+                watchdog.log_error()
+                await asyncio.sleep(error_delay)
+                error_delay = min(2 * error_delay, max_error_delay)
+
+    async def run(self):
+        await asyncio.gather(*[self.watch(name, watchdog) for name, watchdog in self.watchdogs.items()])
+
+    def shutdown(self):
+        # the cameras only flush the shared objects, which are stopped once here
+        for watchdog in self.watchdogs.values():
+            watchdog.shutdown()
+        if self.backup_queue is not None:
+            for watchdog in list(self.watchdogs.values())[:1]:
+                print(watchdog.backup_stats_message())
+            self.backup_queue.stop(timeout=5)
+        self.breadboard_writes.stop()
+        self.run_feed.stop()
+
+    def main(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            self.shutdown()
+
+
+def load_camera_configs(config_path=os.path.join(os.path.dirname(__file__), 'multi_camera_config.json')):
+    with open(config_path) as config_file:
+        return json.load(config_file)['cameras']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        camera_configs = load_camera_configs()
+    else:
+        camera_configs = load_camera_configs(sys.argv[1])
+    multi_camera_watchdog = MultiCameraWatchdog(camera_configs)
+    multi_camera_watchdog.main()
@@ -0,0 +1,173 @@
+"""A pure NumPy alternative to the MATLAB analysis functions in matlab_wrapper.py, which needs no MATLAB engine and can run
+in as many threads or processes as there are cores.
+
+getYcamAnalysis, getDualImagingAnalysis and getTripleImagingAnalysis follow AnalysisLogger's
+analysis_function(filepath, previous_settings) contract and return (analysis_dict, settings), with analysis_dict
+containing the keys of the matching *_analyzed_var_names below. settings holds the marqueeBox and normBox used, boxes
+are [x, y, width, height] in pixels with 1-based x and y, like MATLAB rectangles. A box of None is the whole image, a
+normBox of None skips the probe normalization.
+
+Keys are shared with the MATLAB analyses of matlab_wrapper only for quantities computed the same way, i.e. counts and
+centers of mass. Cloud widths are rms widths of the projections, uploaded under their own names, and the Thomas-Fermi
+fit results of the MATLAB ycam analysis (chemical potential, condensate number, radii) are not computed.
+
+Each absorption image is three frames of a .spe file: with atoms, probe without atoms and dark, see FRAMES. Atom numbers
+are column density integrals, OD * pixel area / cross section, with the pixel size and cross section taken from
+"numpy_analysis_calibration" in analysis_config.json, e.g. {"pixel_size_um": 2.5, "cross_section_um2": 0.1}. There are
+no defaults, see load_calibration.
+"""
+
+import numpy as np
+from functools import lru_cache
+from spe_reader import SpeFile, box_slices
+from matlab_wrapper import dual_imaging_analyzed_var_names, triple_imaging_analyzed_var_names
+
+# frame indices of atoms, probe and dark images per species. Dual imaging images both species in one .spe file.
+FRAMES = {'single': (0, 1, 2),
+          'K': (0, 1, 2),
+          'Na': (3, 4, 5)}
+
+CALIBRATION_KEYS = ['pixel_size_um',  # in the atom plane
+                    'cross_section_um2']
+
+ycam_analyzed_var_names = ['bareNcntAverageMarqueeBoxValues', 'COMX', 'COMY',
+                           'rmsWidthX_pix', 'rmsWidthY_pix', 'fwhmX_pix', 'fwhmY_pix']
+
+DEFAULT_SETTINGS = {'marqueeBox': None, 'normBox': None}
+
+
+@lru_cache(maxsize=1)
+def load_calibration():
+    """Returns "numpy_analysis_calibration" from analysis_config.json, read once per process. Raises a ValueError if it
+    is missing any of CALIBRATION_KEYS, as uncalibrated atom numbers would look plausible on breadboard."""
+    from utility_functions import load_analysis_path
+    try:
+        calibration = load_analysis_path().get('numpy_analysis_calibration', {})
+    except FileNotFoundError:
+        calibration = {}
+    missing_keys = [key for key in CALIBRATION_KEYS if key not in calibration]
+    if len(missing_keys) > 0:
+        raise ValueError('The numpy analysis backend needs {keys} in "numpy_analysis_calibration" of analysis_config.json.'.format(
+            keys=str(missing_keys)))
+    return calibration
+
+
+def od_image(frames, frame_indices=FRAMES['single'], normBox=None, roi=None):
+    """Returns the optical density -ln((atoms - dark) / (probe - dark)) in roi, a [x, y, width, height] box (the whole
+    frame if None). With normBox, the probe is first rescaled to match the atoms frame in normBox, to correct for probe
+    intensity drifts between the two exposures. Only the pixels in roi and normBox are read from memory mapped frames."""
+    atoms_idx, probe_idx, dark_idx = frame_indices
+    scale = 1
+    if normBox is not None:
+        rows, cols = box_slices(normBox, frames.shape[1:])
+        dark = frames[dark_idx, rows, cols].astype(np.float64)
+        probe_sum = (frames[probe_idx, rows, cols] - dark).sum()
+        if probe_sum > 0:
+            scale = (frames[atoms_idx, rows, cols] - dark).sum() / probe_sum
+    rows, cols = box_slices(roi, frames.shape[1:])
+    dark = frames[dark_idx, rows, cols].astype(np.float64)
+    atoms = frames[atoms_idx, rows, cols] - dark
+    probe = (frames[probe_idx, rows, cols] - dark) * scale
+    np.clip(atoms, 1, None, out=atoms)
+    np.clip(probe, 1, None, out=probe)
+    return np.log(probe / atoms)
+
+
+def border_mean(od):
+    """Mean OD along the edges of od, the background level of a marquee box drawn around the cloud."""
+    edges = [od[0, :], od[-1, :], od[1:-1, 0], od[1:-1, -1]]
+    return np.concatenate(edges).mean()
+
+
+def width_at_half_max(profile):
+    return float(np.count_nonzero(profile >= profile.max() / 2))
+
+
+def cloud_analysis(frames, marqueeBox, calibration, frame_indices=FRAMES['single'], normBox=None):
+    """Counts, center of mass and widths of the cloud in marqueeBox. Moments are computed from the background subtracted
+    column density projected onto x and y, with negative values of the projections clipped. Projecting first averages
+    out pixel noise, which would otherwise widen the cloud when clipped."""
+    rows, cols = box_slices(marqueeBox, frames.shape[1:])
+    box = od_image(frames, frame_indices, normBox=normBox, roi=marqueeBox)
+    signal = box - border_mean(box)
+    atoms_per_od = calibration['pixel_size_um'] ** 2 / \
+        calibration['cross_section_um2']
+    x_profile = np.clip(signal.sum(axis=0), 0, None)
+    y_profile = np.clip(signal.sum(axis=1), 0, None)
+    total = x_profile.sum()
+    if total <= 0:
+        nan = float('nan')
+        return {'Ncnt': signal.sum() * atoms_per_od, 'COMX': nan, 'COMY': nan, 'sigmaX': nan, 'sigmaY': nan,
+                'fwhmX': nan, 'fwhmY': nan}
+    x = np.arange(box.shape[1])
+    y = np.arange(box.shape[0])
+    com_x = (x_profile * x).sum() / total
+    com_y = (y_profile * y).sum() / total
+    sigma_x = np.sqrt((x_profile * (x - com_x) ** 2).sum() / total)
+    sigma_y = np.sqrt((y_profile * (y - com_y) ** 2).sum() / total)
+    return {'Ncnt': signal.sum() * atoms_per_od,
+            # 1-based pixel coordinates of the full image, like MATLAB
+            'COMX': com_x + cols.start + 1, 'COMY': com_y + rows.start + 1,
+            'sigmaX': sigma_x, 'sigmaY': sigma_y,
+            'fwhmX': width_at_half_max(x_profile), 'fwhmY': width_at_half_max(y_profile)}
+
+
+def small_box(box, shape):
+    """The central half (in width and height) of box."""
+    if box is None:
+        box = [1, 1, shape[1], shape[0]]
+    x, y, width, height = box
+    return [x + width / 4, y + height / 4, width / 2, height / 2]
+
+
+def settings_from(previous_settings):
+    if previous_settings is None:
+        return dict(DEFAULT_SETTINGS)
+    return {key: previous_settings.get(key) for key in DEFAULT_SETTINGS}
+
+
+def getYcamAnalysis(filepath, previous_settings=None, calibration=None):
+    settings = settings_from(previous_settings)
+    calibration = calibration or load_calibration()
+    with SpeFile(filepath) as spe:
+        cloud = cloud_analysis(spe.frames, settings['marqueeBox'], calibration,
+                               normBox=settings['normBox'])
+    analysis_dict = {'bareNcntAverageMarqueeBoxValues': cloud['Ncnt'],
+                     'COMX': cloud['COMX'], 'COMY': cloud['COMY'],
+                     'rmsWidthX_pix': cloud['sigmaX'], 'rmsWidthY_pix': cloud['sigmaY'],
+                     'fwhmX_pix': cloud['fwhmX'], 'fwhmY_pix': cloud['fwhmY']}
+    return {key: float(analysis_dict[key]) for key in ycam_analyzed_var_names}, settings
+
+
+def getDualImagingAnalysis(filepath, previous_settings=None, calibration=None):
+    settings = settings_from(previous_settings)
+    calibration = calibration or load_calibration()
+    analysis_dict = {}
+    with SpeFile(filepath) as spe:
+        clouds = {}
+        for species in ['K', 'Na']:
+            clouds[species] = [cloud_analysis(spe.frames, box, calibration, FRAMES[species], settings['normBox'])
+                               for box in [settings['marqueeBox'],
+                                           small_box(settings['marqueeBox'], spe.frames.shape[1:])]]
+    for species, (large, small) in clouds.items():
+        analysis_dict[species + '_NcntLarge'] = large['Ncnt']
+        analysis_dict[species + '_NcntSmall'] = small['Ncnt']
+        analysis_dict[species + '_COMX'] = large['COMX']
+        analysis_dict[species + '_COMY'] = large['COMY']
+    return {key: float(analysis_dict[key]) for key in dual_imaging_analyzed_var_names}, settings
+
+
+def getTripleImagingAnalysis(filepaths, previous_settings=None, calibration=None):
+    """filepaths are the K1, K2 and Na images of a shot, in that order."""
+    settings = settings_from(previous_settings)
+    calibration = calibration or load_calibration()
+    analysis_dict = {}
+    for species, filepath in zip(['K1', 'K2', 'Na'], filepaths):
+        with SpeFile(filepath) as spe:
+            cloud = cloud_analysis(spe.frames, settings['marqueeBox'], calibration,
+                                   normBox=settings['normBox'])
+        analysis_dict[species +
+                      '_bareNcntAverageMarqueeBoxValues'] = cloud['Ncnt']
+        analysis_dict[species + '_COMX'] = cloud['COMX']
+        analysis_dict[species + '_COMY'] = cloud['COMY']
+    return {key: float(analysis_dict[key]) for key in triple_imaging_analyzed_var_names}, settings
@@ -0,0 +1,128 @@
+"""Renders JPEG previews of OD images in a background pool, off the analysis path.
+
+PreviewPool.submit takes an OD image (a NumPy array, or a matlab_bridge.LazyArray which is only converted in the worker)
+and returns at once. A worker clips the OD to od_range, maps it through a 256 color lookup table in one indexing
+operation and writes a full-size preview next to the image (runIdx_0.jpeg) and a thumbnail (runIdx_0_thumb.jpeg), e.g.
+for the log viewer.
+"""
+
+import os
+import time
+import threading
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import REGISTRY
+
+PREVIEW_SECONDS = REGISTRY.histogram('enrico_preview_seconds',
+                                     'Duration of rendering and encoding a preview and its thumbnail.')
+PREVIEWS_DROPPED = REGISTRY.counter('enrico_previews_dropped_total',
+                                    'Previews skipped because too many were waiting to be rendered.')
+
+# colormap anchors, evenly spaced from low to high OD, interpolated to the lookup table
+COLORMAPS = {'viridis': [(68, 1, 84), (72, 40, 120), (62, 74, 137), (49, 104, 142), (38, 130, 142),
+                         (31, 158, 137), (53, 183, 121), (109, 205, 89), (180, 222, 44), (253, 231, 37)],
+             'gray': [(0, 0, 0), (255, 255, 255)]}
+THUMBNAIL_SIZE = 256
+
+_preview_pool = None
+_preview_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(colormap='viridis', size=256):
+    """Returns a (size, 3) uint8 lookup table of the colormap, one of COLORMAPS or, if installed, of matplotlib."""
+    if colormap in COLORMAPS:
+        anchors = np.array(COLORMAPS[colormap], dtype=np.float64)
+        positions = np.linspace(0, 1, len(anchors))
+        levels = np.linspace(0, 1, size)
+        lut = np.stack([np.interp(levels, positions, anchors[:, channel])
+                        for channel in range(3)], axis=1)
+    else:
+        import matplotlib.pyplot as plt
+        lut = plt.get_cmap(colormap)(np.linspace(0, 1, size))[:, :3] * 255
+    return np.round(lut).astype(np.uint8)
+
+
+def render(od_image, od_range=(0, 3), colormap='viridis'):
+    """Returns od_image as an RGB PIL image, with OD clipped to od_range and NaN shown as the lowest OD."""
+    lut = colormap_lut(colormap)
+    low, high = od_range
+    od = np.nan_to_num(np.asarray(od_image, dtype=np.float32), nan=low)
+    indices = np.clip((od - low) * ((len(lut) - 1) / (high - low)), 0, len(lut) - 1)
+    return Image.fromarray(lut[indices.astype(np.uint8)], mode='RGB')
+
+
+def preview_paths(filepath):
+    """Full-size preview and thumbnail paths of the image at filepath, the first image of a shot with several."""
+    if not isinstance(filepath, str):
+        filepath = filepath[0]
+    root = os.path.splitext(filepath)[0]
+    return root + '.jpeg', root + '_thumb.jpeg'
+
+
+def save_preview(od_image, filepath, od_range=(0, 3), colormap='viridis', thumbnail_size=THUMBNAIL_SIZE, quality=90):
+    """Writes the preview and thumbnail of od_image for the image(s) at filepath and returns their paths."""
+    start_time = time.monotonic()
+    preview_path, thumbnail_path = preview_paths(filepath)
+    image = render(od_image, od_range, colormap)
+    image.save(preview_path, quality=quality)
+    image.thumbnail((thumbnail_size, thumbnail_size))
+    image.save(thumbnail_path, quality=quality)
+    PREVIEW_SECONDS.observe(time.monotonic() - start_time)
+    return preview_path, thumbnail_path
+
+
+class PreviewPool():
+    """PreviewPool renders previews with save_preview on num_workers threads. NumPy and JPEG encoding release the GIL,
+    so rendering doesn't hold up analysis. Previews beyond max_pending waiting ones are dropped, as they are only for
+    display."""
+
+    def __init__(self, num_workers=1, max_pending=8, **preview_kwargs):
+        """
+        Args:
+            - preview_kwargs: od_range, colormap, thumbnail_size and quality of save_preview. od_range must be a
+              (low, high) pair with low < high.
+        """
+        low, high = preview_kwargs.get('od_range', (0, 3))
+        if not low < high:
+            raise ValueError('od_range {od_range} is empty, it must be (low, high) with low < high, e.g. (0, 3)'.format(
+                od_range=str(preview_kwargs['od_range'])))
+        self.executor = ThreadPoolExecutor(max_workers=num_workers,
+                                           thread_name_prefix='preview')
+        self.max_pending = max_pending
+        self.preview_kwargs = preview_kwargs
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, od_image, filepath):
+        """Queues a preview of od_image for the image(s) at filepath. Returns a Future of the preview and thumbnail
+        paths, or None if the preview was dropped."""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                PREVIEWS_DROPPED.inc()
+                return None
+            self.pending += 1
+        future = self.executor.submit(
+            save_preview, od_image, filepath, **self.preview_kwargs)
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future):
+        with self.lock:
+            self.pending -= 1
+        if future.exception() is not None:
+            print('preview failed: ' + str(future.exception()))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def load_preview_pool():
+    """Returns the preview pool shared by the analysis functions of this process, created on first use."""
+    global _preview_pool
+    with _preview_pool_lock:
+        if _preview_pool is None:
+            _preview_pool = PreviewPool()
+    return _preview_pool
@@ -0,0 +1,234 @@
+"""Re-analyzes finished runs offline, in parallel, and writes the results to breadboard in bulk.
+
+    python reanalyze.py zd D:\\Fermidata1\\202610\\261017\\run3_spectroscopy --processes 8
+    python reanalyze.py y D:\\Fermidata1\\202610\\261017 --run-ids 120000-120500 --skip-existing --dry-run
+
+Paths can be runfolders, day folders or any folder above them, all .spe images below are found. Shots are analyzed
+across --processes worker processes, each with its own analysis engine: with --backend matlab, process i connects to the
+shared session i of matlab_engine_server.py if it runs. Each shot is analyzed with default settings (no marqueeBox or
+normBox carried over from the previous shot), so shots are independent. Results go through the analysis cache
+(analysis_cache.py) unless --no-cache, except MATLAB results, which depend on the settings stored in MATLAB. Results are
+written to breadboard every --flush-every shots and at the end.
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from math import isnan
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_id_tracker import RunIdTracker
+import matlab_wrapper
+
+_worker = {}  # analysis engine and caches of a worker process, see init_worker
+
+
+def find_shots(paths, images_per_shot=1, run_id_range=None):
+    """Returns [(run_id, file(s))] of the shots in and below paths, sorted by run_id, optionally only those with
+    first <= run_id <= last for run_id_range (first, last). Shots missing images are left out."""
+    shots = {}
+    for path in paths:
+        for folder, _, filenames in os.walk(path):
+            if 'misplaced' in os.path.basename(folder) or not any('.spe' in name for name in filenames):
+                continue
+            for run_id in RunIdTracker(folder, load_state=False).scan():
+                if run_id_range is not None and not run_id_range[0] <= run_id <= run_id_range[1]:
+                    continue
+                files = [os.path.join(folder, '{run_id}_{idx}.spe'.format(run_id=run_id, idx=idx))
+                         for idx in range(images_per_shot)]
+                if not all(os.path.exists(file) for file in files):
+                    print('skipping run_id {id}, missing images in {folder}'.format(
+                        id=str(run_id), folder=folder))
+                    continue
+                shots[run_id] = files[0] if images_per_shot == 1 else files
+    return sorted(shots.items())
+
+
+def make_engine(analysis_mode, backend, engine_index=0):
+    """Returns an AnalysisEngine for analysis_mode as AnalysisLogger would, without carrying settings between shots."""
+    from analysis_engines import FunctionAnalysisEngine, MatlabAnalysisEngine
+    if analysis_mode == 'testing':
+        return FunctionAnalysisEngine(matlab_wrapper.fake_analysis1)
+    function_name = matlab_wrapper.analysis_modes[analysis_mode][0]
+    if backend == 'numpy':
+        import numpy_analysis
+        return FunctionAnalysisEngine(getattr(numpy_analysis, function_name))
+    return MatlabAnalysisEngine(getattr(matlab_wrapper, function_name),
+                                matlab_wrapper.load_matlab_engine(engine_index=engine_index),
+                                uses_boxes=analysis_mode in matlab_wrapper.box_settings_modes)
+
+
+def init_worker(analysis_mode, backend, use_cache, engine_counter, analyzed_var_names):
+    with engine_counter.get_lock():
+        engine_index = engine_counter.value
+        engine_counter.value += 1
+    _worker['engine'] = make_engine(analysis_mode, backend, engine_index)
+    from analysis_cache import analysis_tag
+    _worker['analysis_tag'] = analysis_tag(analysis_mode, backend)
+    _worker['use_cache'] = use_cache and analysis_mode != 'testing'
+    _worker['caches'] = {}  # cache path: AnalysisCache
+    _worker['analyzed_var_names'] = analyzed_var_names
+
+
+def worker_engine(file):
+    if not _worker['use_cache']:
+        return _worker['engine']
+    from analysis_cache import AnalysisCache, CachedAnalysisEngine, default_cache_path
+    runfolder = os.path.dirname(file if isinstance(file, str) else file[0])
+    cache_path = default_cache_path(runfolder)
+    if cache_path not in _worker['caches']:
+        _worker['caches'][cache_path] = AnalysisCache(cache_path)
+    return CachedAnalysisEngine(_worker['engine'], _worker['caches'][cache_path], _worker['analysis_tag'])
+
+
+def analyze_shot(run_id, file):
+    """Runs in a worker process. Returns (run_id, cleaned analysis_dict, error message or None). Only the scalars
+    uploaded to breadboard are sent back, not image-sized arrays or MATLAB arrays."""
+    try:
+        analysis_dict, _ = worker_engine(file).analyze(file, None)
+        return run_id, clean_analysis_dict(analysis_dict, _worker['analyzed_var_names']), None
+    except:
+        return run_id, None, str(sys.exc_info()[1])
+
+
+def clean_analysis_dict(analysis_dict, analyzed_var_names):
+    """Keeps the values of analyzed_var_names which are not NaN, as AnalysisLogger uploads them, as Python floats."""
+    return {key: float(analysis_dict[key]) for key in analyzed_var_names
+            if key in analysis_dict and not isnan(analysis_dict[key])}
+
+
+def analyzed_var_names_of(analysis_mode, backend='matlab'):
+    if analysis_mode == 'testing':
+        return matlab_wrapper.fake_analysis1_var_names
+    if backend == 'numpy':
+        import numpy_analysis
+        return getattr(numpy_analysis, matlab_wrapper.analysis_modes[analysis_mode][1])
+    return getattr(matlab_wrapper, matlab_wrapper.analysis_modes[analysis_mode][1])
+
+
+def reanalyze(paths, analysis_mode, backend='matlab', num_processes=None, run_id_range=None, dry_run=False,
+              skip_existing=False, flush_every=100, use_cache=True, mark_bad_shots=False, progress_interval=2, bc=None):
+    """
+    Analyzes the shots in and below paths and writes the results to breadboard. Returns a summary dictionary, whose
+    not_written lists the run_ids whose results could not be written.
+
+    Args:
+        - backend: 'matlab' or 'numpy', see AnalysisLogger.
+        - num_processes: worker processes, by default the number of cores for the numpy backend and 1 for MATLAB.
+        - run_id_range: (first, last) to only analyze those run_ids.
+        - dry_run: only lists what would be analyzed, nothing is analyzed or written.
+        - skip_existing: leaves out runs which already have all analyzed var names on breadboard.
+        - flush_every: results written to breadboard per batch, besides the final write. 0 to only write at the end.
+        - mark_bad_shots: if True, shots which fail to analyze are marked {'badshot': True} on breadboard, as
+          AnalysisLogger does. Off by default, as the runs may already hold good analysis from the live session.
+        - bc: BreadboardClient, utility_functions.load_breadboard_client() by default.
+    """
+    from analyzed_runs import AnalyzedRunsChecker
+    from breadboard_writes import BreadboardWriteCoalescer
+    if backend == 'numpy' and analysis_mode != 'testing':
+        import numpy_analysis
+        numpy_analysis.load_calibration()  # raises without a calibration, before any worker starts
+    analyzed_var_names = analyzed_var_names_of(analysis_mode, backend)
+    shots = find_shots(paths, matlab_wrapper.images_per_shot[analysis_mode], run_id_range)
+    print('found {count} shots in {paths}'.format(count=len(shots), paths=str(paths)))
+    if bc is None and (skip_existing or not dry_run):
+        from utility_functions import load_breadboard_client
+        bc = load_breadboard_client()
+    skipped = 0
+    if skip_existing and len(shots) > 0:
+        checker = AnalyzedRunsChecker(bc, analyzed_var_names)
+        checker.prefetch([run_id for run_id, _ in shots])
+
+        def is_analyzed(run_id):
+            try:
+                return checker.is_analyzed(run_id)
+            except:
+                return False  # e.g. run not on breadboard, analyze it anyway
+
+        remaining = [(run_id, file) for run_id, file in shots if not is_analyzed(run_id)]
+        checker.shutdown()
+        skipped = len(shots) - len(remaining)
+        shots = remaining
+        print('skipping {count} shots already analyzed on breadboard'.format(count=skipped))
+    summary = {'shots': len(shots), 'skipped': skipped, 'analyzed': 0, 'failed': 0, 'seconds': 0, 'not_written': []}
+    if dry_run:
+        for run_id, file in shots:
+            print('would analyze run_id {id}: {file}'.format(id=str(run_id), file=str(file)))
+        return summary
+    if len(shots) == 0:
+        return summary
+
+    if num_processes is None:
+        num_processes = os.cpu_count() if backend == 'numpy' else 1
+    writer = BreadboardWriteCoalescer(bc)
+    start_time = time.monotonic()
+    last_progress_time = start_time
+    engine_counter = multiprocessing.Value('i', 0)
+    with ProcessPoolExecutor(max_workers=num_processes, initializer=init_worker,
+                             initargs=(analysis_mode, backend, use_cache, engine_counter,
+                                       analyzed_var_names)) as executor:
+        futures = [executor.submit(analyze_shot, run_id, file) for run_id, file in shots]
+        for done, future in enumerate(as_completed(futures), start=1):
+            run_id, analysis_dict, error = future.result()
+            if error is None:
+                writer.append_analysis_to_run(run_id, analysis_dict)
+                summary['analyzed'] += 1
+            else:
+                print('run_id {id} could not be analyzed{marking}: {error}'.format(
+                    id=str(run_id), marking=', marking as bad shot' if mark_bad_shots else '', error=error))
+                if mark_bad_shots:
+                    writer.append_analysis_to_run(run_id, {'badshot': True})
+                summary['failed'] += 1
+            if flush_every > 0 and len(writer.pending) >= flush_every:
+                writer.flush()
+            now = time.monotonic()
+            if now - last_progress_time > progress_interval or done == len(shots):
+                last_progress_time = now
+                rate = done / (now - start_time)
+                print('{done}/{total} shots, {rate:.1f} shots/s, {failed} failed, about {eta:.0f} s left'.format(
+                    done=done, total=len(shots), rate=rate, failed=summary['failed'],
+                    eta=(len(shots) - done) / rate))
+    # failed writes are retried at once, as nothing is left to do, until written or given up on
+    while len(writer.pending) > 0:
+        writer.flush(retry_now=True)
+    summary['seconds'] = time.monotonic() - start_time
+    summary['not_written'] = sorted(set(writer.given_up_run_ids))
+    print('analyzed {analyzed} shots ({failed} failed) in {seconds:.1f} s, {requests} breadboard requests'.format(
+        requests=writer.requests_sent, **summary))
+    if len(summary['not_written']) > 0:
+        print('results of {count} run_ids could not be written to breadboard: {run_ids}'.format(
+            count=len(summary['not_written']), run_ids=str(summary['not_written'])))
+    return summary
+
+
+def parse_run_id_range(text):
+    first, last = text.split('-')
+    return int(first), int(last)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-analyze runfolders, day folders or run_id ranges in parallel and write the results to breadboard.')
+    parser.add_argument('analysis_mode', choices=[
+                        'y', 'zd', 'zt', 'testing'])
+    parser.add_argument('paths', nargs='+',
+                        help='runfolders, day folders or folders above them')
+    parser.add_argument('--backend', choices=['matlab', 'numpy'], default='matlab')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, by default one per core for numpy and 1 for matlab')
+    parser.add_argument('--run-ids', type=parse_run_id_range, default=None,
+                        help='first-last, only analyze these run_ids')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the shots which would be analyzed')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='skip runs already analyzed on breadboard')
+    parser.add_argument('--flush-every', type=int, default=100,
+                        help='results per write to breadboard, 0 to write all at the end')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--mark-bad-shots', action='store_true',
+                        help='mark shots which fail to analyze as bad shots on breadboard')
+    args = parser.parse_args()
+    reanalyze(args.paths, args.analysis_mode, backend=args.backend, num_processes=args.processes,
+              run_id_range=args.run_ids, dry_run=args.dry_run, skip_existing=args.skip_existing,
+              flush_every=args.flush_every, use_cache=not args.no_cache, mark_bad_shots=args.mark_bad_shots)
@@ -0,0 +1,62 @@
+import bisect
+import datetime
+
+RUNTIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class RecentRunsIndex():
+    """RecentRunsIndex keeps the last max_runs breadboard run dictionaries sorted by runtime, so that incoming images can be
+    matched to the run they belong to with a binary search instead of only being compared against the newest run."""
+
+    def __init__(self, max_runs=200):
+        self.max_runs = max_runs
+        self.runtimes = []  # sorted datetimes
+        self.run_dicts = []  # run dictionaries in the same order as self.runtimes
+        self.run_ids = set()
+        self.matched_run_ids = set()
+
+    def __len__(self):
+        return len(self.run_dicts)
+
+    def add(self, run_dict):
+        """Adds a run dictionary (see utility_functions.clean_run_dict). Returns False if the run_id is already indexed."""
+        if run_dict['run_id'] in self.run_ids:
+            return False
+        runtime = datetime.datetime.strptime(run_dict['runtime'], RUNTIME_FMT)
+        idx = bisect.bisect_right(self.runtimes, runtime)
+        self.runtimes.insert(idx, runtime)
+        self.run_dicts.insert(idx, run_dict)
+        self.run_ids.add(run_dict['run_id'])
+        while len(self.run_dicts) > self.max_runs:
+            self.runtimes.pop(0)
+            oldest_run_dict = self.run_dicts.pop(0)
+            self.run_ids.discard(oldest_run_dict['run_id'])
+            self.matched_run_ids.discard(oldest_run_dict['run_id'])
+        return True
+
+    def newest(self):
+        if len(self.run_dicts) == 0:
+            return None
+        return self.run_dicts[-1]
+
+    def match(self, file_time, min_time_diff_in_sec=0, max_time_diff_in_sec=5):
+        """Returns the run dictionary of the oldest run not yet matched to images which started more than
+        min_time_diff_in_sec and less than max_time_diff_in_sec before file_time, or None if there is no such run.
+        Shots are matched in the order their images arrive, so a newer unmatched run in the window belongs to a later shot.
+        Runtimes have a resolution of 1 sec; runs which started in the same second are told apart by their run_id."""
+        latest_runtime = file_time - \
+            datetime.timedelta(seconds=min_time_diff_in_sec)
+        idx = bisect.bisect_left(self.runtimes, latest_runtime) - 1
+        matched_run_dict = None
+        matched_key = None
+        # walk back from the newest run in the window to the oldest one
+        while idx >= 0 and (file_time - self.runtimes[idx]).total_seconds() < max_time_diff_in_sec:
+            run_dict = self.run_dicts[idx]
+            key = (self.runtimes[idx], run_dict['run_id'])
+            if run_dict['run_id'] not in self.matched_run_ids and (matched_key is None or key < matched_key):
+                matched_run_dict, matched_key = run_dict, key
+            idx -= 1
+        return matched_run_dict
+
+    def mark_matched(self, run_id):
+        self.matched_run_ids.add(run_id)
@@ -0,0 +1,269 @@
+"""A shared feed of the newest breadboard run, so that the image watchdog, wavemeter, status monitors etc. don't each
+poll breadboard for /runs/?limit=1 on their own.
+
+Run `python run_feed.py` once per lab computer to start a feed server. Consumers call get_run_feed(), which connects to
+that server if it is running and otherwise falls back to polling breadboard from a thread in their own process."""
+
+import sys
+import time
+import queue
+import logging
+import threading
+import collections
+from multiprocessing.connection import Listener, Client
+from utility_functions import get_recent_run_dicts
+
+RUN_FEED_ADDRESS = ('localhost', 6011)
+RUN_FEED_AUTHKEY = b'enrico run feed'
+
+
+class RunFeed():
+    """RunFeed polls breadboard for the newest run from a single background thread and caches it.
+    The polling interval adapts: it drops to min_interval after a new run_id shows up and grows by
+    backoff_factor on every poll without a change, up to max_interval.
+    Each poll asks for the fetch_limit newest runs, so runs which start in quick succession between two polls aren't missed.
+    Subscribers get every new run dictionary pushed to a queue, starting with the last history_length runs."""
+
+    def __init__(self, bc, min_interval=0.1, max_interval=1, backoff_factor=1.5, fetch_limit=5, history_length=50):
+        self.bc = bc
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.fetch_limit = fetch_limit
+        self.interval = min_interval
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.run_dict = None
+        self.history = collections.deque(maxlen=history_length)
+        self.subscribers = []
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def newest_run_dict(self, timeout=10):
+        """Returns the cached newest run dictionary, waiting up to timeout sec for the first poll if necessary."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.run_dict is not None, timeout=timeout)
+            return self.run_dict
+
+    def wait_for_new_run(self, run_id, timeout):
+        """Blocks until a run newer than run_id is known or timeout expires. Returns the newest run dictionary."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.run_dict is not None and self.run_dict['run_id'] > run_id,
+                                    timeout=timeout)
+            return self.run_dict
+
+    def subscribe(self, maxsize=100):
+        """Returns a queue which receives the recent history and then each new run dictionary, oldest first.
+        If a subscriber falls behind, the oldest entries are dropped."""
+        subscriber = queue.Queue(maxsize=max(maxsize, len(self.history)))
+        with self.condition:
+            self.subscribers.append(subscriber)
+            for run_dict in self.history:
+                subscriber.put_nowait(run_dict)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, run_dict):
+        with self.condition:
+            if self.run_dict is not None and run_dict['run_id'] <= self.run_dict['run_id']:
+                return False
+            self.run_dict = run_dict
+            self.history.append(run_dict)
+            for subscriber in self.subscribers:
+                if subscriber.full():
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+                subscriber.put_nowait(run_dict)
+            self.condition.notify_all()
+        return True
+
+    def _fetch(self):
+        # oldest first, so that each new run is published in order
+        return list(reversed(get_recent_run_dicts(self.bc, limit=self.fetch_limit)))
+
+    def _poll_once(self):
+        try:
+            is_new = False
+            for run_dict in self._fetch():
+                is_new = self.publish(run_dict) or is_new
+        except:
+            self.logger.error(sys.exc_info()[1])
+            is_new = False
+        if is_new:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(
+                self.interval * self.backoff_factor, self.max_interval)
+        time.sleep(self.interval)
+
+    def _poll(self):
+        while self.running:
+            self._poll_once()
+
+
+class RunFeedClient(RunFeed):
+    """RunFeedClient has the same interface as RunFeed, but receives new runs pushed from a RunFeedServer
+    over a local socket instead of polling breadboard.
+    If the connection to the server drops, it polls breadboard through bc itself, as RunFeed does, so that subscribers
+    don't keep a stale newest run, and retries the server with a delay growing up to max_reconnect_interval."""
+
+    def __init__(self, address=RUN_FEED_ADDRESS, authkey=RUN_FEED_AUTHKEY, bc=None, max_reconnect_interval=10):
+        super().__init__(bc=bc)
+        self.address = address
+        self.authkey = authkey
+        self.max_reconnect_interval = max_reconnect_interval
+        self.connection = Client(address, authkey=authkey)
+
+    def stop(self):
+        self.running = False
+        self.connection.close()
+
+    def _reconnect(self):
+        """Polls breadboard and retries the server until it is back or the client is stopped."""
+        reconnect_interval = self.min_interval
+        reconnect_time = time.monotonic()
+        self.interval = self.min_interval
+        while self.running:
+            if time.monotonic() >= reconnect_time:
+                try:
+                    self.connection = Client(
+                        self.address, authkey=self.authkey)
+                    print('reconnected to run feed server at {address}'.format(
+                        address=str(self.address)))
+                    return
+                except OSError:
+                    reconnect_interval = min(reconnect_interval * 2,
+                                             self.max_reconnect_interval)
+                    reconnect_time = time.monotonic() + reconnect_interval
+            if self.bc is None:
+                from utility_functions import load_breadboard_client
+                self.bc = load_breadboard_client()
+            self._poll_once()
+
+    def _poll(self):
+        while self.running:
+            try:
+                run_dict = self.connection.recv()
+            except (EOFError, OSError):
+                if not self.running:
+                    return
+                self.logger.error(
+                    'Lost connection to run feed server, polling breadboard until it is back.')
+                self.connection.close()
+                self._reconnect()
+                continue
+            self.publish(run_dict)
+
+
+class RunFeedServer():
+    """RunFeedServer runs a RunFeed and pushes every new run dictionary to all connected RunFeedClients."""
+
+    def __init__(self, bc, address=RUN_FEED_ADDRESS, authkey=RUN_FEED_AUTHKEY, **run_feed_kwargs):
+        self.run_feed = RunFeed(bc, **run_feed_kwargs)
+        self.listener = Listener(address, authkey=authkey)
+        self.connections = []
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.closed = False
+
+    def accept_clients(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except:
+                if self.closed:
+                    return
+                # e.g. a client which failed authentication or disconnected during the handshake
+                self.logger.error(sys.exc_info()[1])
+                continue
+            with self.lock:
+                try:
+                    for run_dict in list(self.run_feed.history):
+                        connection.send(run_dict)
+                except OSError:
+                    # the client disconnected right after the handshake
+                    self.logger.error(sys.exc_info()[1])
+                    connection.close()
+                    continue
+                self.connections.append(connection)
+            print('run feed client connected, {n} total.'.format(
+                n=str(len(self.connections))))
+
+    def broadcast(self, run_dict):
+        with self.lock:
+            for connection in list(self.connections):
+                try:
+                    connection.send(run_dict)
+                except OSError:
+                    connection.close()
+                    self.connections.remove(connection)
+
+    def main(self):
+        subscriber = self.run_feed.subscribe()
+        self.run_feed.start()
+        threading.Thread(target=self.accept_clients, daemon=True).start()
+        print('serving newest breadboard runs on {address}'.format(
+            address=str(self.listener.address)))
+        try:
+            while True:
+                run_dict = subscriber.get()
+                print('new id: {id}'.format(id=str(run_dict['run_id'])))
+                self.broadcast(run_dict)
+        except KeyboardInterrupt:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        self.run_feed.stop()
+
+
+def get_run_feed(bc=None, address=RUN_FEED_ADDRESS, authkey=RUN_FEED_AUTHKEY):
+    """Returns a started RunFeedClient if a RunFeedServer is running at address, and otherwise a started
+    RunFeed polling breadboard through bc (loaded with load_breadboard_client if None)."""
+    try:
+        return RunFeedClient(address, authkey, bc=bc).start()
+    except ConnectionRefusedError:
+        if bc is None:
+            from utility_functions import load_breadboard_client
+            bc = load_breadboard_client()
+        print('no run feed server found at {address}, polling breadboard from this process.'.format(
+            address=str(address)))
+        return RunFeed(bc).start()
+
+
+_shared_run_feed = None
+_shared_run_feed_lock = threading.Lock()
+
+
+def load_shared_run_feed(bc=None):
+    """Returns the run feed shared by the functions of this process which need the newest run, see get_run_feed,
+    started on first use."""
+    global _shared_run_feed
+    with _shared_run_feed_lock:
+        if _shared_run_feed is None:
+            _shared_run_feed = get_run_feed(bc)
+    return _shared_run_feed
+
+
+if __name__ == '__main__':
+    from utility_functions import load_breadboard_client
+    server = RunFeedServer(load_breadboard_client())
+    server.main()
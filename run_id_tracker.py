@@ -0,0 +1,99 @@
+import os
+import json
+import time
+from measurement_directory import run_id_from_filename
+
+
+class RunIdTracker():
+    """RunIdTracker finds the run_ids of new .spe images in a runfolder incrementally and remembers which are done.
+
+    scan() only lists the folder when its modification time has changed, and only parses the file names it has not seen
+    before, so each call costs O(new files). Done run_ids are kept in a set and periodically persisted to state_path as
+    compact [first, last] ranges, so that a restarted AnalysisLogger can skip them without asking breadboard."""
+
+    def __init__(self, folder, state_path=None, persist_interval=10, load_state=True, mtime_resolution=2):
+        """
+        Args:
+            - state_path: .json file the done run_ids are saved to. Not persisted if None.
+            - persist_interval: minimum time in sec between saves, see maybe_save.
+            - load_state: set to False to start from scratch, e.g. to reanalyze a runfolder.
+            - mtime_resolution: sec for which the folder is listed again even if its modification time is unchanged,
+              since files created within the file system's timestamp resolution don't change it.
+        """
+        self.folder = folder
+        self.state_path = state_path
+        self.persist_interval = persist_interval
+        self.mtime_resolution = mtime_resolution
+        self.seen_filenames = set()
+        self.known_ids = set()
+        self.done_ids = set()
+        self.folder_mtime = None
+        self.dirty = False
+        self.last_save_time = time.monotonic()
+        if load_state and state_path is not None:
+            self.load()
+
+    def scan(self):
+        """Returns the sorted run_ids of images added to the folder since the last scan which are not done."""
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime
+        except FileNotFoundError:
+            return []
+        if folder_mtime == self.folder_mtime and time.time() - folder_mtime > self.mtime_resolution:
+            return []
+        self.folder_mtime = folder_mtime
+        new_ids = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                filename = entry.name
+                if filename in self.seen_filenames:
+                    continue
+                self.seen_filenames.add(filename)
+                if '.spe' not in filename:  # filter out non .spe files
+                    continue
+                try:
+                    run_id = run_id_from_filename(filename)
+                except (TypeError, ValueError):  # not named runIdx_imageIdx.spe
+                    continue
+                if run_id not in self.known_ids:
+                    self.known_ids.add(run_id)
+                    new_ids.add(run_id)
+        return sorted(new_ids.difference(self.done_ids))
+
+    def mark_done(self, run_id):
+        self.done_ids.add(run_id)
+        self.dirty = True
+
+    def maybe_save(self):
+        """Saves the done run_ids if any changed and at least persist_interval sec passed since the last save."""
+        if self.dirty and time.monotonic() - self.last_save_time > self.persist_interval:
+            self.save()
+
+    def save(self):
+        if self.state_path is None:
+            return
+        ranges = []
+        for run_id in sorted(self.done_ids):
+            if len(ranges) > 0 and ranges[-1][1] == run_id - 1:
+                ranges[-1][1] = run_id
+            else:
+                ranges.append([run_id, run_id])
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump({'done_id_ranges': ranges}, state_file)
+        os.replace(temp_path, self.state_path)
+        self.dirty = False
+        self.last_save_time = time.monotonic()
+
+    def load(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as state_file:
+                ranges = json.load(state_file)['done_id_ranges']
+        except (ValueError, KeyError):
+            print('could not read {path}, starting without saved run_ids.'.format(
+                path=self.state_path))
+            return
+        for first, last in ranges:
+            self.done_ids.update(range(first, last + 1))
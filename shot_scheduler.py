@@ -0,0 +1,164 @@
+import time
+import heapq
+import threading
+
+POLICIES = ['lifo', 'fifo', 'deadline']
+LANES = ['live', 'backfill']
+
+
+class Lane():
+    """A queue of run_ids served by policy:
+        - 'lifo': newest run_id first.
+        - 'fifo': oldest run_id first.
+        - 'deadline': earliest deadline (arrival time + deadline sec) first among the shots which can still make it.
+          Once every waiting shot is past its deadline, they are served newest first.
+    Removals are lazy, entries no longer waiting are skipped when they reach the top of the heap."""
+
+    def __init__(self, name, policy='lifo', deadline=None):
+        if policy not in POLICIES:
+            raise ValueError(str(policy) + ' is not a scheduling policy, i.e. one of ' + str(POLICIES))
+        if policy == 'deadline' and deadline is None:
+            raise ValueError('the deadline policy of the {name} lane needs a deadline.'.format(name=name))
+        self.name = name
+        self.policy = policy
+        self.deadline = deadline
+        self.arrival_times = {}  # run_id: time.monotonic() at which it was added, for waiting run_ids
+        self.heap = []  # entries (*sort key, run_id, arrival time)
+        self.expired = []  # entries (-run_id, run_id, arrival time) of shots past their deadline under the deadline policy
+
+    def sort_key(self, run_id, arrival_time):
+        if self.policy == 'lifo':
+            return (-run_id,)
+        if self.policy == 'fifo':
+            return (run_id,)
+        return (arrival_time + self.deadline, run_id)
+
+    def push(self, run_id, arrival_time):
+        self.arrival_times[run_id] = arrival_time
+        heapq.heappush(self.heap, self.sort_key(
+            run_id, arrival_time) + (run_id, arrival_time))
+        if len(self.heap) > 2 * len(self.arrival_times) + 64:  # drop removed entries
+            self.heap = [entry for entry in self.heap if self.waiting(*entry[-2:])]
+            heapq.heapify(self.heap)
+
+    def remove(self, run_id):
+        del self.arrival_times[run_id]
+
+    def waiting(self, run_id, arrival_time):
+        return self.arrival_times.get(run_id) == arrival_time
+
+    def pop(self, now):
+        """Returns the next run_id by policy, or None if the lane is empty."""
+        if self.policy == 'deadline':
+            while len(self.heap) > 0 and self.heap[0][0] < now:
+                run_id, arrival_time = heapq.heappop(self.heap)[-2:]
+                if self.waiting(run_id, arrival_time):
+                    heapq.heappush(self.expired,
+                                   (-run_id, run_id, arrival_time))
+        for heap in [self.heap, self.expired]:
+            while len(heap) > 0:
+                run_id, arrival_time = heapq.heappop(heap)[-2:]
+                if self.waiting(run_id, arrival_time):
+                    self.remove(run_id)
+                    return run_id
+        return None
+
+    def oldest(self):
+        """Smallest waiting run_id."""
+        return min(self.arrival_times)
+
+    def __len__(self):
+        return len(self.arrival_times)
+
+
+class ShotScheduler():
+    """
+    ShotScheduler decides which shot AnalysisLogger analyzes next, with two lanes:
+        - live: the newest live_capacity shots, served first to keep the latency of the newest shot minimal.
+        - backfill: shots pushed out of the live lane by newer ones, waiting in it longer than live_deadline, or
+          retried after an error. Served only when the live lane is empty, i.e. with analysis capacity left over, so
+          a backlog after a stall is worked off without delaying new shots.
+    lag() reports how far behind each lane is. Safe to use from several threads, wait() blocks until a shot is waiting.
+    """
+
+    def __init__(self, live_policy='lifo', backfill_policy='fifo', live_capacity=1, live_deadline=None,
+                 backfill_deadline=None):
+        """
+        Args:
+            - live_policy, backfill_policy: 'lifo', 'fifo' or 'deadline', see Lane.
+            - live_capacity: number of newest shots kept in the live lane, e.g. the number of analysis workers.
+            - live_deadline: sec after which a waiting live shot moves to the backfill lane, None to keep it live.
+              Also the deadline of the deadline policy in the live lane.
+            - backfill_deadline: sec, deadline of the deadline policy in the backfill lane.
+        """
+        self.live = Lane('live', live_policy, live_deadline)
+        self.backfill = Lane('backfill', backfill_policy, backfill_deadline)
+        self.live_capacity = live_capacity
+        self.live_deadline = live_deadline
+        self.newest_run_id = None
+        self.lock = threading.Lock()
+        self.shots_waiting = threading.Condition(self.lock)
+
+    def add(self, run_ids):
+        """Adds new run_ids, e.g. from RunIdTracker.scan, the newest of which enter the live lane."""
+        now = time.monotonic()
+        with self.lock:
+            for run_id in sorted(run_ids):
+                if self.newest_run_id is None or run_id > self.newest_run_id:
+                    self.newest_run_id = run_id
+                if len(self.live) < self.live_capacity or run_id > self.live.oldest():
+                    self.live.push(run_id, now)
+                else:
+                    self.backfill.push(run_id, now)
+                while len(self.live) > self.live_capacity:
+                    self.demote(self.live.oldest())
+            self.shots_waiting.notify_all()
+
+    def requeue(self, run_id):
+        """Queues run_id again, e.g. after an error, in the backfill lane so that it can't block new shots."""
+        with self.lock:
+            self.backfill.push(run_id, time.monotonic())
+            self.shots_waiting.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until a shot is waiting or timeout sec have passed. Returns True if a shot is waiting."""
+        with self.lock:
+            return self.shots_waiting.wait_for(lambda: len(self) > 0, timeout=timeout)
+
+    def demote(self, run_id):
+        arrival_time = self.live.arrival_times[run_id]
+        self.live.remove(run_id)
+        self.backfill.push(run_id, arrival_time)
+
+    def next(self):
+        """Returns (run_id, lane name) of the shot to analyze next, or (None, None) if no shot is waiting."""
+        now = time.monotonic()
+        with self.lock:
+            if self.live_deadline is not None:
+                for run_id, arrival_time in list(self.live.arrival_times.items()):
+                    if now - arrival_time > self.live_deadline:
+                        self.demote(run_id)
+            for lane in [self.live, self.backfill]:
+                run_id = lane.pop(now)
+                if run_id is not None:
+                    return run_id, lane.name
+        return None, None
+
+    def lag(self):
+        """Returns {lane name: {'waiting': number of shots, 'oldest_wait_seconds': sec the longest waiting shot has
+        waited, 'run_ids_behind': newest run_id - oldest waiting run_id}}."""
+        now = time.monotonic()
+        report = {}
+        with self.lock:
+            for lane in [self.live, self.backfill]:
+                if len(lane) == 0:
+                    report[lane.name] = {'waiting': 0,
+                                         'oldest_wait_seconds': 0, 'run_ids_behind': 0}
+                    continue
+                report[lane.name] = {'waiting': len(lane),
+                                     'oldest_wait_seconds': now - min(lane.arrival_times.values()),
+                                     'run_ids_behind': self.newest_run_id - min(lane.arrival_times)}
+        return report
+
+    def __len__(self):
+        return len(self.live) + len(self.backfill)
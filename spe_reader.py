@@ -0,0 +1,122 @@
+"""Reads Princeton Instruments / Lightfield .spe images (file format 2.x and 3.0) as NumPy memory maps.
+
+Frames are views into the file, nothing is read until pixels are accessed, so a preview or an analysis of a marquee box
+only reads the pages it needs:
+
+    with SpeFile(filepath) as spe:
+        atoms = spe.frame(0, roi=[100, 50, 200, 150])  # [x, y, width, height], 1-based like MATLAB rectangles
+        od = np.log(spe.frames[1] / spe.frames[0])
+"""
+
+import numpy as np
+import xml.etree.ElementTree as ElementTree
+
+HEADER_SIZE = 4100
+XDIM_OFFSET = 42
+DATATYPE_OFFSET = 108
+YDIM_OFFSET = 656
+XML_FOOTER_OFFSET = 678
+NUMFRAMES_OFFSET = 1446
+FILE_HEADER_VER_OFFSET = 1992
+DATATYPES = {0: np.float32, 1: np.int32, 2: np.int16, 3: np.uint16,
+             5: np.float64, 6: np.uint8, 8: np.uint32}
+PIXEL_FORMATS = {'MonochromeUnsigned16': np.uint16, 'MonochromeUnsigned32': np.uint32,
+                 'MonochromeFloating32': np.float32}
+
+
+def box_slices(box, shape):
+    """Converts a [x, y, width, height] box to (row slice, column slice), clipped to the image shape."""
+    if box is None:
+        return slice(0, shape[0]), slice(0, shape[1])
+    x, y, width, height = [int(round(value)) for value in box]
+    return (slice(max(y - 1, 0), min(y - 1 + height, shape[0])),
+            slice(max(x - 1, 0), min(x - 1 + width, shape[1])))
+
+
+class SpeFile():
+    """SpeFile parses the header of a .spe file and maps its frames as a read-only (frames, ydim, xdim) array, see frames.
+
+    For 3.0 files, frame dimensions, pixel format and the frame stride (which includes per-frame metadata such as time
+    stamps) are read from the XML footer. Files with several regions of interest per frame are not supported."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as spe_file:
+            header = spe_file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(filepath + ' is too short for a .spe file.')
+        self.xdim = int(np.frombuffer(header, np.uint16, 1, XDIM_OFFSET)[0])
+        self.ydim = int(np.frombuffer(header, np.uint16, 1, YDIM_OFFSET)[0])
+        self.num_frames = int(np.frombuffer(
+            header, np.int32, 1, NUMFRAMES_OFFSET)[0])
+        self.dtype = np.dtype(DATATYPES[int(np.frombuffer(
+            header, np.int16, 1, DATATYPE_OFFSET)[0])])
+        self.file_header_ver = float(np.frombuffer(
+            header, np.float32, 1, FILE_HEADER_VER_OFFSET)[0])
+        self.frame_stride = self.xdim * self.ydim * self.dtype.itemsize
+        self.xml_footer = None
+        if self.file_header_ver >= 3:
+            self.read_xml_footer(
+                int(np.frombuffer(header, np.uint64, 1, XML_FOOTER_OFFSET)[0]))
+        self.frames = self.map_frames()
+
+    def read_xml_footer(self, footer_offset):
+        with open(self.filepath, 'rb') as spe_file:
+            spe_file.seek(footer_offset)
+            self.xml_footer = spe_file.read().decode('utf-8', errors='replace')
+        root = ElementTree.fromstring(self.xml_footer)
+        for element in root.iter():
+            if not element.tag.endswith('DataBlock'):
+                continue
+            if element.get('type') == 'Frame':
+                self.num_frames = int(element.get('count', self.num_frames))
+                self.dtype = np.dtype(PIXEL_FORMATS.get(
+                    element.get('pixelFormat'), self.dtype))
+                self.frame_stride = int(element.get(
+                    'stride', self.frame_stride))
+                regions = [child for child in element
+                           if child.tag.endswith('DataBlock') and child.get('type') == 'Region']
+                if len(regions) > 1:
+                    raise ValueError(
+                        self.filepath + ' has several regions of interest per frame, which are not supported.')
+                if len(regions) == 1:
+                    self.xdim = int(regions[0].get('width', self.xdim))
+                    self.ydim = int(regions[0].get('height', self.ydim))
+
+    def map_frames(self):
+        frame_size = self.xdim * self.ydim * self.dtype.itemsize
+        if self.frame_stride == frame_size:
+            return np.memmap(self.filepath, dtype=self.dtype, mode='r', offset=HEADER_SIZE,
+                             shape=(self.num_frames, self.ydim, self.xdim))
+        # frames followed by metadata: a strided view over the raw bytes, still without copying
+        raw = np.memmap(self.filepath, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                        shape=(self.num_frames * self.frame_stride,))
+        return np.ndarray(shape=(self.num_frames, self.ydim, self.xdim), dtype=self.dtype, buffer=raw,
+                          strides=(self.frame_stride, self.xdim * self.dtype.itemsize, self.dtype.itemsize))
+
+    def frame(self, idx, roi=None):
+        """Returns a view of frame idx, cropped to roi, a [x, y, width, height] box, if given."""
+        rows, cols = box_slices(roi, (self.ydim, self.xdim))
+        return self.frames[idx, rows, cols]
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def close(self):
+        """Drops this object's reference to the memory map. The file is unmapped once no views of it remain, which on
+        Windows is needed before the file can be moved or deleted."""
+        self.frames = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_spe_frames(filepath):
+    """Returns the frames of the .spe file at filepath as a memory mapped (frames, ydim, xdim) array."""
+    return SpeFile(filepath).frames
@@ -0,0 +1,78 @@
+"""Stand-ins for the MATLAB engine API, see matlab_engine_server.MatlabEngineBackend."""
+
+from concurrent.futures import Future
+
+
+class StubEngine():
+    """Stands in for a MATLAB engine in tests. Records eval commands, tracks the folder of the last cd, answers health
+    checks and calls the functions passed in by name, e.g. StubEngine({'getYcamAnalysis': fake_ycam_analysis})."""
+
+    def __init__(self, functions=None):
+        self.functions = functions or {}
+        self.commands = []
+        self.cwd = None
+        self.alive = True
+        self.responding = True
+
+    def check(self):
+        if not self.alive:
+            raise RuntimeError('MATLAB session is closed.')
+
+    def eval(self, command, nargout=0):
+        self.check()
+        self.commands.append(command)
+        if command.startswith('cd '):
+            self.cwd = command[3:].strip()
+        elif command == 'exit':
+            self.alive = False
+
+    def plus(self, a, b, background=False):
+        self.check()
+        future = Future()
+        if self.responding:
+            future.set_result(a + b)
+        return future if background else future.result()
+
+    def feature(self, name):
+        return id(self)  # 'getpid', see StubEngineBackend.kill
+
+    def quit(self):
+        self.alive = False
+
+    def __getattr__(self, name):
+        functions = self.__dict__.get('functions', {})
+        if name in functions:
+            self.check()
+            return functions[name]
+        raise AttributeError(name)
+
+
+class StubEngineBackend():
+    """Shares StubEngines by name, in place of MatlabEngineBackend."""
+
+    def __init__(self, functions=None):
+        self.functions = functions
+        self.sessions = {}
+        self.launched = []
+        self.started = 0
+
+    def find(self):
+        return [name for name, eng in self.sessions.items() if eng.alive]
+
+    def connect(self, name):
+        if name not in self.find():
+            raise RuntimeError('No shared MATLAB session named ' + name)
+        return self.sessions[name]
+
+    def start(self):
+        self.started += 1
+        return StubEngine(self.functions)
+
+    def launch(self, name):
+        self.launched.append(name)
+        self.sessions[name] = StubEngine(self.functions)
+
+    def kill(self, pid):
+        for eng in self.sessions.values():
+            if id(eng) == pid:
+                eng.alive = False
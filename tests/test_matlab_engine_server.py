@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from matlab_engine_server import MatlabEngineServer, connect_engine, release_engine, engine_name, SETTINGS_ENGINE_INDEX
+from matlab_stubs import StubEngineBackend
+
+
+def started_server(num_engines=2, settings_engine=False, ping_timeout=0.2):
+    backend = StubEngineBackend()
+    server = MatlabEngineServer(num_engines=num_engines, settings_engine=settings_engine, backend=backend,
+                                analysis_library_path='analysis_library', ping_timeout=ping_timeout)
+    server.ensure_engines()  # launches
+    server.ensure_engines()  # connects and warms up
+    return server, backend
+
+
+def test_sessions_are_warmed_up_and_shared():
+    server, backend = started_server()
+    assert server.missing_engines() == []
+    assert all(eng.cwd == 'analysis_library' for eng in server.engines.values())
+    eng = connect_engine(0, backend=backend)
+    assert eng is backend.sessions[engine_name(0)]
+    release_engine(eng)
+    assert eng.alive
+
+
+def test_hung_sessions_are_pinged_concurrently_and_relaunched():
+    server, backend = started_server(num_engines=3)
+    for idx in [0, 1]:
+        backend.sessions[engine_name(idx)].responding = False
+    start_time = time.monotonic()
+    server.check_health()
+    assert time.monotonic() - start_time < 2 * server.ping_timeout
+    assert server.missing_engines() == [engine_name(0), engine_name(1)]
+    server.ensure_engines()
+    assert backend.launched.count(engine_name(0)) == 2
+
+
+def test_busy_settings_session_is_kept():
+    server, backend = started_server(num_engines=1, settings_engine=True)
+    settings_name = engine_name(SETTINGS_ENGINE_INDEX)
+    backend.sessions[settings_name].responding = False
+    server.check_health()
+    assert settings_name in server.engines
+    backend.sessions[settings_name].quit()
+    server.check_health()
+    assert settings_name not in server.engines
@@ -0,0 +1,47 @@
+import os
+import sys
+import datetime
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../..')))
+
+from recent_runs import RecentRunsIndex, RUNTIME_FMT
+
+START_TIME = datetime.datetime(2020, 10, 21, 12, 0, 0)
+
+
+def run_dict(run_id, seconds):
+    return {'run_id': run_id, 'runtime': (START_TIME + datetime.timedelta(seconds=seconds)).strftime(RUNTIME_FMT)}
+
+
+def image_time(seconds):
+    return START_TIME + datetime.timedelta(seconds=seconds)
+
+
+def test_two_runs_in_the_same_second_are_matched_in_order():
+    recent_runs = RecentRunsIndex()
+    # added newest first, so the index order doesn't decide
+    recent_runs.add(run_dict(8, 1))
+    recent_runs.add(run_dict(7, 1))
+    first_match = recent_runs.match(image_time(1.6))
+    assert first_match['run_id'] == 7
+    recent_runs.mark_matched(7)
+    assert recent_runs.match(image_time(2.1))['run_id'] == 8
+
+
+def test_older_unmatched_run_is_matched_before_a_newer_one():
+    recent_runs = RecentRunsIndex()
+    for run_id, seconds in [(6, 0), (7, 1), (8, 2)]:
+        recent_runs.add(run_dict(run_id, seconds))
+    recent_runs.mark_matched(6)
+    # shot 7's images arrive after run 8 started
+    assert recent_runs.match(image_time(2.5))['run_id'] == 7
+    recent_runs.mark_matched(7)
+    assert recent_runs.match(image_time(3))['run_id'] == 8
+
+
+def test_runs_outside_the_window_are_not_matched():
+    recent_runs = RecentRunsIndex()
+    recent_runs.add(run_dict(1, 0))
+    assert recent_runs.match(image_time(6), max_time_diff_in_sec=5) is None
+    assert recent_runs.match(image_time(0.5), min_time_diff_in_sec=1) is None
+    recent_runs.mark_matched(1)
+    assert recent_runs.match(image_time(2)) is None
@@ -84,12 +84,19 @@ def fancy_plot(x, y, fmt='', **kwargs):
     return plt.errorbar(final_x_values, final_y_values, final_error_values, fmt=fmt, **kwargs)
 
 
-def load_breadboard_client():
+_breadboard_client = None
+
+
+def load_breadboard_client(use_shared_transport=True):
     """Wraps the breadboard import process
 
     Uses a system-specific .json config file, stored in the working directory, to import breadboard
     without hard-coded paths.
 
+    The client is created once per process and its requests go through a pooled, keep-alive
+    BreadboardTransport (see breadboard_transport.py), using api_url and api_key of the breadboard API config.
+    Set use_shared_transport to False for a fresh client using breadboard's own HTTP calls.
+
     Returns:
         BreadboardClient object; see breadboard documentation
 
@@ -102,6 +109,9 @@ def load_breadboard_client():
     import json
     import sys
     import os
+    global _breadboard_client
+    if use_shared_transport and _breadboard_client is not None:
+        return _breadboard_client
     with open(os.path.join(os.path.dirname(__file__), "breadboard_path_config.json")) as my_file:
         breadboard_dict = json.load(my_file)
         breadboard_repo_path = breadboard_dict.get("breadboard_repo_path")
@@ -120,40 +130,100 @@ def load_breadboard_client():
             raise ValueError(
                 "Unable to import breadboard using specified value of breadboard_repo_path")
         bc = BreadboardClient(breadboard_API_config_path)
+    if use_shared_transport:
+        from breadboard_transport import BreadboardTransport
+        with open(breadboard_API_config_path) as api_config_file:
+            api_config = json.load(api_config_file)
+        api_url = api_config.get('api_url', getattr(bc, 'api_url', None))
+        api_key = api_config.get('api_key', getattr(bc, 'api_key', None))
+        if api_url is None:
+            raise KeyError(
+                "The breadboard API config does not contain variable api_url")
+        _breadboard_client = BreadboardTransport(api_url, api_key).attach(bc)
+        return _breadboard_client
     return bc
 
 
-def get_newest_run_dict(bc, max_retries=10):
-    """Gets newest run dictionary containing runtime, run_id, and parameters via breadboard client bc
+def clean_run_dict(run_dict):
+    """Flattens a run dictionary as returned by the breadboard API into a dictionary of runtime, run_id and parameters
     """
+    return {'runtime': run_dict['runtime'],
+            'run_id': run_dict['id'],
+            **run_dict['parameters']}
+
+
+def get_recent_run_dicts(bc, limit=1, max_retries=10):
+    """Gets the limit newest run dictionaries (see clean_run_dict), newest first, via breadboard client bc
+    """
+    from metrics import BREADBOARD_REQUEST_SECONDS, BREADBOARD_RETRIES
     retries = 0
     while retries < max_retries:
+        start_time = time.monotonic()
         try:
             resp = bc._send_message(
-                'get', '/runs/', params={'lab': 'fermi1', 'limit': 1})
+                'get', '/runs/', params={'lab': 'fermi1', 'limit': limit})
+            BREADBOARD_REQUEST_SECONDS.observe(
+                time.monotonic() - start_time, request='recent_runs')
             if resp.status_code != 200:
                 retries += 1
+                BREADBOARD_RETRIES.inc(request='recent_runs')
                 time.sleep(0.3)
                 continue
-            new_run_dict = resp.json()['results'][0]
+            new_run_dicts = resp.json()['results']
             break
         except JSONDecodeError:
             time.sleep(0.3)
             retries += 1
+            BREADBOARD_RETRIES.inc(request='recent_runs')
+
+    return [clean_run_dict(run_dict) for run_dict in new_run_dicts]
 
-    new_run_dict_clean = {'runtime': new_run_dict['runtime'],
-                          'run_id': new_run_dict['id'],
-                          **new_run_dict['parameters']}
-    return new_run_dict_clean
 
-def get_newest_value(bc, key, max_tries_this_level = 6, delay_seconds = 5):
+def get_newest_run_dict(bc, max_retries=10):
+    """Gets newest run dictionary containing runtime, run_id, and parameters via breadboard client bc
+    """
+    return get_recent_run_dicts(bc, limit=1, max_retries=max_retries)[0]
+
+def get_runs_in_time_range(bc, start_time, end_time, page_size=100, max_pages=50):
+    """Gets run dictionaries (see clean_run_dict) with runtimes between the datetimes start_time and end_time, newest first.
+    Pages backwards through /runs/ until the runs are older than start_time.
+    """
+    import datetime
+    run_dicts = []
+    for page in range(max_pages):
+        resp = bc._send_message(
+            'get', '/runs/', params={'lab': 'fermi1', 'limit': page_size, 'offset': page * page_size})
+        if resp.status_code != 200:
+            raise ValueError('Breadboard error while fetching runs: ' + resp.text)
+        results = resp.json()['results']
+        for run_dict in results:
+            runtime = datetime.datetime.strptime(
+                run_dict['runtime'], "%Y-%m-%dT%H:%M:%SZ")
+            if runtime < start_time:
+                return run_dicts
+            if runtime <= end_time:
+                run_dicts.append(clean_run_dict(run_dict))
+        if len(results) < page_size:
+            break
+    return run_dicts
+
+
+def get_newest_value(bc, key, max_tries_this_level = 6, delay_seconds = 5, run_feed = None):
+    """Returns the value of key in the newest run dictionary, or None if key doesn't show up within the allowed tries.
+    The newest run comes from run_feed, by default the run feed shared in this process (see run_feed.py), instead of
+    querying breadboard through bc. Each try waits up to delay_seconds for a new run.
+    """
+    if run_feed is None:
+        from run_feed import load_shared_run_feed
+        run_feed = load_shared_run_feed(bc)
     tries = 0
+    newest_run_dict = run_feed.newest_run_dict()
     while (tries < max_tries_this_level):
-        newest_run_dict = get_newest_run_dict(bc)
-        if(key in newest_run_dict):
+        if(newest_run_dict is not None and key in newest_run_dict):
             return newest_run_dict[key] 
         else:
-            time.sleep(delay_seconds) 
+            run_id = -1 if newest_run_dict is None else newest_run_dict['run_id']
+            newest_run_dict = run_feed.wait_for_new_run(run_id, timeout=delay_seconds)
             tries += 1
     return None
         
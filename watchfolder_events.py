@@ -0,0 +1,122 @@
+import os
+import time
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:  # polling in ImageWatchdog.getFileList is used instead
+    Observer = None
+    FileSystemEventHandler = object
+    WATCHDOG_AVAILABLE = False
+
+
+class _WatchfolderEventHandler(FileSystemEventHandler):
+    """Forwards watchdog file system events for files directly inside the watchfolder to WatchfolderEvents."""
+
+    def __init__(self, watchfolder_events):
+        super().__init__()
+        self.watchfolder_events = watchfolder_events
+
+    def _filename(self, path):
+        if os.path.dirname(os.path.abspath(path)) != self.watchfolder_events.watchfolder:
+            return None
+        return os.path.basename(path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watchfolder_events.touch(self._filename(event.src_path))
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watchfolder_events.touch(self._filename(event.src_path))
+
+    def on_closed(self, event):
+        # only emitted on platforms with inotify IN_CLOSE_WRITE support
+        if not event.is_directory:
+            self.watchfolder_events.touch(
+                self._filename(event.src_path), closed=True)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.watchfolder_events.discard([self._filename(event.src_path)])
+
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        self.watchfolder_events.discard([self._filename(event.src_path)])
+        self.watchfolder_events.touch(self._filename(event.dest_path))
+
+
+class WatchfolderEvents():
+    """WatchfolderEvents keeps track of files in a watchfolder using file system notifications (inotify on Linux,
+    ReadDirectoryChangesW on Windows) instead of repeatedly listing the folder.
+    Files are debounced: a file counts as arrived once it was closed after writing or has seen no events for debounce_time."""
+
+    def __init__(self, watchfolder, debounce_time=0.05):
+        if not WATCHDOG_AVAILABLE:
+            raise ImportError(
+                'The watchdog package is required for event-driven watchfolder notifications.')
+        self.watchfolder = os.path.abspath(watchfolder)
+        self.debounce_time = debounce_time
+        self.last_event_times = {}  # filename: time.monotonic() of last event
+        self.closed_filenames = set()
+        self.condition = threading.Condition()
+        self.observer = None
+
+    def start(self):
+        """Records files already in the watchfolder and starts listening for events."""
+        with self.condition:
+            for filename in os.listdir(self.watchfolder):
+                if os.path.isfile(os.path.join(self.watchfolder, filename)):
+                    self.last_event_times[filename] = time.monotonic()
+        self.observer = Observer()
+        self.observer.schedule(_WatchfolderEventHandler(
+            self), self.watchfolder, recursive=False)
+        self.observer.daemon = True
+        self.observer.start()
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def touch(self, filename, closed=False):
+        if filename is None:
+            return
+        with self.condition:
+            self.last_event_times[filename] = time.monotonic()
+            if closed:
+                self.closed_filenames.add(filename)
+            self.condition.notify_all()
+
+    def discard(self, filenames):
+        """Forget about filenames, e.g. after they have been moved out of the watchfolder."""
+        with self.condition:
+            for filename in filenames:
+                self.last_event_times.pop(filename, None)
+                self.closed_filenames.discard(filename)
+
+    def settled_filenames(self):
+        """Returns filenames which are done changing, sorted in the same (reverse) order as ImageWatchdog.getFileList."""
+        now = time.monotonic()
+        settled = [filename for filename, last_event_time in self.last_event_times.items()
+                   if filename in self.closed_filenames or now - last_event_time >= self.debounce_time]
+        return sorted(settled, reverse=True)
+
+    def wait_for_shot(self, num_images_per_shot, timeout):
+        """Blocks until at least num_images_per_shot files have settled or timeout (in sec) expires.
+        Returns the list of settled filenames, which may be shorter than num_images_per_shot on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                settled = self.settled_filenames()
+                remaining = deadline - time.monotonic()
+                if len(settled) >= num_images_per_shot or remaining <= 0:
+                    return settled
+                if len(self.last_event_times) >= num_images_per_shot:
+                    # enough files have arrived, wake up again once the newest one could be debounced
+                    remaining = min(remaining, self.debounce_time)
+                self.condition.wait(remaining)
@@ -0,0 +1,98 @@
+import os
+import time
+import collections
+
+
+class WriteCompletionDetector():
+    """WriteCompletionDetector waits until a set of files (e.g. all images of one shot) has finished being written to disk.
+
+    A file counts as complete once a close-write event was seen for it (if a WatchfolderEvents object is passed in) or,
+    as a fallback, once its size and mtime have stayed the same for quiet_time. Close-write events are only emitted on
+    Linux, so on the lab computers the fallback decides. quiet_time adapts to the longest stall seen between two writes
+    of a file, and files whose mtime is already quiet_time in the past, e.g. a backlog, are complete at once. Empty files
+    never count as complete, as they were just created. All files are checked in the same loop, so a triple imaging shot
+    costs one quiescence period instead of three sequential sleeps."""
+
+    def __init__(self, file_events=None, min_quiet_time=0.2, max_quiet_time=2, stall_factor=2, stall_history=50,
+                 min_poll_interval=0.005, max_poll_interval=0.05, timeout=30):
+        """
+        Args:
+            - file_events: optional WatchfolderEvents object, whose close-write events mark files as complete immediately.
+            - min_quiet_time, max_quiet_time: bounds in sec of quiet_time, the time without size or mtime changes after
+              which a file is considered complete.
+            - stall_factor: quiet_time is stall_factor times the longest stall between two writes of a file seen in the
+              last stall_history stalls, within its bounds.
+            - min_poll_interval, max_poll_interval: the stat polling interval is reset to min_poll_interval whenever a file
+              changes and otherwise backs off geometrically to max_poll_interval.
+            - timeout: sec after which waiting is given up on and the files are treated as complete.
+        """
+        self.file_events = file_events
+        self.min_quiet_time = min_quiet_time
+        self.max_quiet_time = max_quiet_time
+        self.stall_factor = stall_factor
+        self.stalls = collections.deque(maxlen=stall_history)
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+
+    @property
+    def quiet_time(self):
+        longest_stall = max(self.stalls, default=0)
+        return min(max(self.stall_factor * longest_stall, self.min_quiet_time), self.max_quiet_time)
+
+    def _closed(self, filepath):
+        file_events = self.file_events
+        if file_events is None:
+            return False
+        if os.path.dirname(os.path.abspath(filepath)) != file_events.watchfolder:
+            return False
+        with file_events.condition:
+            return os.path.basename(filepath) in file_events.closed_filenames
+
+    def wait(self, filepaths):
+        """Blocks until every file in filepaths is complete. Returns a dictionary of filepath: time in sec the file took to settle."""
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        start_time = time.monotonic()
+        last_stats = {}  # filepath: ((size, mtime), time.monotonic() the stat was first seen)
+        settle_times = {}
+        poll_interval = self.min_poll_interval
+        while len(settle_times) < len(filepaths):
+            now = time.monotonic()
+            quiet_time = self.quiet_time
+            changed = False
+            for filepath in filepaths:
+                if filepath in settle_times:
+                    continue
+                try:
+                    stat = os.stat(filepath)
+                    size_mtime = (stat.st_size, stat.st_mtime_ns)
+                except FileNotFoundError:
+                    size_mtime = None
+                if size_mtime is None or size_mtime[0] == 0:
+                    pass  # not created or just created
+                elif self._closed(filepath):
+                    settle_times[filepath] = now - start_time
+                    continue
+                elif filepath not in last_stats and time.time() - stat.st_mtime >= quiet_time:
+                    settle_times[filepath] = now - start_time  # last written long ago
+                    continue
+                if filepath not in last_stats or last_stats[filepath][0] != size_mtime:
+                    if filepath in last_stats and last_stats[filepath][0] is not None and last_stats[filepath][0][0] > 0:
+                        self.stalls.append(now - last_stats[filepath][1])
+                    last_stats[filepath] = (size_mtime, now)
+                    changed = True
+                elif size_mtime is not None and size_mtime[0] > 0 and now - last_stats[filepath][1] >= quiet_time:
+                    settle_times[filepath] = now - start_time
+            if len(settle_times) == len(filepaths):
+                break
+            if now - start_time > self.timeout:
+                for filepath in filepaths:
+                    settle_times.setdefault(filepath, now - start_time)
+                break
+            if changed:
+                poll_interval = self.min_poll_interval
+            else:
+                poll_interval = min(2 * poll_interval, self.max_poll_interval)
+            time.sleep(poll_interval)
+        return settle_times